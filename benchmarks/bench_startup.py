@@ -0,0 +1,144 @@
+"""
+Measures the startup time of `mindwavelsl`: importing the package,
+its lightweight modules, `MindwaveLSL`, and running `--help`. Each
+case runs in a new interpreter, so that nothing is cached in
+`sys.modules`. Example:
+
+	python benchmarks/bench_startup.py --runs 20 --importtime
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+CASES = [
+	("import mindwavelsl", ["-c", "import mindwavelsl"]),
+	("import parser", ["-c", "import mindwavelsl.parser"]),
+	("mindwavelsl --help", ["-m", "mindwavelsl.mindwavelsl", "--help"]),
+	("import MindwaveLSL", ["-c", "from mindwavelsl import MindwaveLSL"]),
+]
+
+# Modules that should only be loaded once an outlet or a connector
+# that needs them is set up
+HEAVY_MODULES = ["numpy", "pylsl", "serial", "asyncio", "http.server", "scipy"]
+
+
+def run_case(arguments, runs):
+	"""
+	Runs the interpreter with the given arguments and returns the wall
+	time of each run, in milliseconds.
+	"""
+	times = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		subprocess.run(
+			[sys.executable] + arguments,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+			check=True
+		)
+		times.append((time.perf_counter() - start) * 1000)
+	return sorted(times)
+
+
+def loaded_modules(arguments):
+	"""
+	Returns the heavy modules that are loaded by the given case.
+	"""
+	if arguments[0] != "-c":
+		return None
+	code = arguments[1] + (
+		"\nimport sys\nprint(','.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+	)
+	output = subprocess.run(
+		[sys.executable, "-c", code], stdout=subprocess.PIPE, check=True
+	).stdout.decode().strip()
+	return output.split(",") if output else []
+
+
+def import_times(arguments, top):
+	"""
+	Returns the modules with the largest cumulative import times, in
+	milliseconds, from the output of `python -X importtime`.
+	"""
+	result = subprocess.run(
+		[sys.executable, "-X", "importtime"] + arguments,
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.PIPE,
+		check=True
+	)
+
+	modules = []
+	for line in result.stderr.decode().splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		_, cumulative, name = line[len("import time:"):].split("|")
+		# Only keep the top-level imports, and those of this package
+		# and of the heavy modules wherever they are imported from
+		nested = name.startswith("  ")
+		name = name.strip()
+		if nested and not name.startswith("mindwavelsl") and name not in HEAVY_MODULES:
+			continue
+		modules.append((int(cumulative) / 1000.0, name))
+	return sorted(modules, reverse=True)[:top]
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Benchmark the startup time of mindwavelsl."
+	)
+	parser.add_argument('--runs', type=int, default=10,
+						help="Number of runs of each case.")
+	parser.add_argument('--importtime', action="store_true", default=False,
+						help="Set this to show the slowest imports of each case.")
+	parser.add_argument('--top', type=int, default=8,
+						help="Number of imports shown with --importtime.")
+	parser.add_argument('--json', type=str, default='',
+						help="Path to a JSON file to save the results to.")
+	args = parser.parse_args()
+
+	# Run against this checkout, rather than an installed version
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	os.environ["PYTHONPATH"] = os.pathsep.join(
+		filter(None, [root, os.environ.get("PYTHONPATH")])
+	)
+
+	baseline = run_case(["-c", "pass"], args.runs)
+	baseline_ms = baseline[len(baseline) // 2]
+
+	results = []
+	print("%-20s %9s %9s %9s   %s" % ("case", "p50 ms", "min ms", "+python", "heavy modules"))
+	for name, arguments in CASES:
+		times = run_case(arguments, args.runs)
+		modules = loaded_modules(arguments)
+		result = {
+			"case": name,
+			"p50_ms": times[len(times) // 2],
+			"min_ms": times[0],
+			"over_python_ms": times[len(times) // 2] - baseline_ms,
+			"heavy_modules": modules,
+		}
+		results.append(result)
+		print(
+			"%-20s %9.1f %9.1f %9.1f   %s" % (
+				name,
+				result["p50_ms"],
+				result["min_ms"],
+				result["over_python_ms"],
+				"-" if modules is None else (", ".join(modules) or "none"),
+			)
+		)
+
+		if args.importtime:
+			for cumulative, module in import_times(arguments, args.top):
+				print("%20s %9.1f   %s" % ("", cumulative, module))
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"python_ms": baseline_ms, "cases": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+	main()
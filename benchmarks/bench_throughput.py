@@ -0,0 +1,233 @@
+"""
+Runs `MindwaveLSL` against simulated ThinkGear Connectors and reports
+its throughput, CPU usage, end-to-end latency, and dropped frames.
+
+The simulators run in a separate process so that the CPU time of this
+process is only spent by `mindwavelsl`. Example:
+
+	python benchmarks/bench_throughput.py --headsets 1 4 8 --speeds 1 10 50
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import numpy as np
+import pylsl as lsl
+import threading
+import time
+
+from mindwavelsl import MindwaveLSL
+from mindwavelsl.constants import EXPECTED_FIELDS, RAW_OUTPUT_CONFIG, RAW_SRATE
+from mindwavelsl.simulator import ThinkGearSimulator
+
+RAW_INDEX = EXPECTED_FIELDS.index("rawEeg")
+
+
+def simulate(count, speed, ports, started, sent, pause, done):
+	"""
+	Runs the simulators in a child process. The start time and the
+	number of raw frames sent by each one are shared with the parent.
+	"""
+	simulators = []
+	for ind in range(count):
+		simulator = ThinkGearSimulator(port=0, speed=speed, seed=ind)
+		ports.put((ind, simulator.start()))
+		simulators.append(simulator)
+
+	def _share():
+		for ind, simulator in enumerate(simulators):
+			started[ind] = simulator.started or 0
+			sent[ind] = simulator.raw_sent
+
+	while not pause.is_set():
+		_share()
+		time.sleep(0.05)
+
+	# Stop sending, but keep the connections open until the
+	# clients are done reading
+	for simulator in simulators:
+		simulator.paused = True
+	time.sleep(0.1)
+	_share()
+
+	done.wait()
+	for simulator in simulators:
+		simulator.stop()
+
+
+class LatencyProbe(object):
+	"""
+	Outlet that counts the samples it receives, and records the time
+	at which each raw frame reached the outlets.
+	"""
+	def __init__(self):
+		self.samples = 0
+		self.arrivals = []
+
+	def push_sample(self, sample, timestamp=0.0):
+		self.samples += 1
+
+		raw = sample[RAW_INDEX]
+		if raw == raw:
+			self.arrivals.append(lsl.local_clock())
+
+	def push_chunk(self, samples, timestamps):
+		now = lsl.local_clock()
+		self.samples += len(samples)
+
+		count = int((~np.isnan(np.asarray(samples)[:, RAW_INDEX])).sum())
+		self.arrivals.extend([now] * count)
+
+	def latencies(self, started, speed):
+		"""
+		Returns the time between the moment each raw frame was due to be
+		sent by the simulator and the moment it reached the outlets.
+		"""
+		due = started + np.arange(1, len(self.arrivals) + 1) / (RAW_SRATE * speed)
+		return np.array(self.arrivals) - due
+
+
+def run_case(headsets, speed, args):
+	"""
+	Runs one benchmark case and returns its results.
+	"""
+	ctx = multiprocessing.get_context("spawn")
+	ports = ctx.Queue()
+	started = ctx.Array('d', headsets)
+	sent = ctx.Array('q', headsets)
+	pause = ctx.Event()
+	done = ctx.Event()
+
+	process = ctx.Process(
+		target=simulate, args=(headsets, speed, ports, started, sent, pause, done)
+	)
+	process.start()
+	port_list = [0] * headsets
+	for _ in range(headsets):
+		ind, port = ports.get(timeout=30)
+		port_list[ind] = port
+
+	probes = []
+	instances = []
+	for ind, port in enumerate(port_list):
+		probe = LatencyProbe()
+		mwlsl = MindwaveLSL(
+			'localhost',
+			port,
+			run_lsl=args.lsl,
+			multi_stream=args.multi_stream,
+			chunk_size=args.chunk_size,
+			threaded=args.threaded,
+			stream_name="MindwaveBench%s" % ind
+		)
+		mwlsl.add_outlet(probe)
+		mwlsl.setup()
+		mwlsl.write(RAW_OUTPUT_CONFIG)
+		probes.append(probe)
+		instances.append(mwlsl)
+
+	threads = [
+		threading.Thread(target=mwlsl.run, daemon=True) for mwlsl in instances
+	]
+	cpu = time.process_time()
+	wall = time.perf_counter()
+	for thread in threads:
+		thread.start()
+
+	time.sleep(args.duration)
+
+	pause.set()
+	time.sleep(args.drain)
+	cpu = time.process_time() - cpu
+	wall = time.perf_counter() - wall
+
+	# The connections are closed once the instances stop, hide
+	# the errors this causes
+	logging.disable(logging.CRITICAL)
+	for mwlsl in instances:
+		mwlsl.stop()
+	done.set()
+	for thread in threads:
+		thread.join(5)
+	process.join(5)
+	logging.disable(logging.NOTSET)
+
+	latencies = np.concatenate([
+		probe.latencies(started[ind], speed) for ind, probe in enumerate(probes)
+	])
+	percentiles = (
+		np.percentile(latencies, [50, 95, 99]) * 1000
+		if len(latencies) else [np.nan] * 3
+	)
+	total_sent = sum(sent)
+	total_raw = sum(len(probe.arrivals) for probe in probes)
+
+	return {
+		"headsets": headsets,
+		"speed": speed,
+		"samples_per_s": sum(probe.samples for probe in probes) / wall,
+		"cpu_per_headset": 100 * cpu / wall / headsets,
+		"latency_p50_ms": percentiles[0],
+		"latency_p95_ms": percentiles[1],
+		"latency_p99_ms": percentiles[2],
+		"raw_sent": total_sent,
+		"dropped": max(total_sent - total_raw, 0),
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Benchmark mindwavelsl against simulated ThinkGear Connectors."
+	)
+	parser.add_argument('--headsets', type=int, nargs='+', default=[1, 2, 4],
+						help="Numbers of simulated headsets to run at once.")
+	parser.add_argument('--speeds', type=float, nargs='+', default=[1, 10, 50],
+						help="Data rate multipliers to run the simulators at.")
+	parser.add_argument('--duration', type=float, default=10,
+						help="Duration of each case, in seconds.")
+	parser.add_argument('--drain', type=float, default=1,
+						help="Time given to read the remaining data after each case.")
+	parser.add_argument('--no-lsl', dest='lsl', action="store_false", default=True,
+						help="Set this to benchmark without the LSL outlets.")
+	parser.add_argument('--multi-stream', action="store_true", default=False,
+						help="Set this to use the multi-stream LSL outlets.")
+	parser.add_argument('--chunk-size', type=int, default=0,
+						help="Chunk size of the LSL outlets.")
+	parser.add_argument('--threaded', action="store_true", default=False,
+						help="Set this to use the threaded pipeline.")
+	parser.add_argument('--json', type=str, default='',
+						help="Path to a JSON file to save the results to.")
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+
+	results = []
+	header = (
+		"%8s %6s %12s %10s %9s %9s %9s %9s" %
+		("headsets", "speed", "samples/s", "cpu/hs %", "p50 ms", "p95 ms", "p99 ms", "dropped")
+	)
+	print(header)
+	for headsets in args.headsets:
+		for speed in args.speeds:
+			result = run_case(headsets, speed, args)
+			results.append(result)
+			print(
+				"%8d %6g %12.0f %10.1f %9.2f %9.2f %9.2f %9d" % (
+					result["headsets"],
+					result["speed"],
+					result["samples_per_s"],
+					result["cpu_per_headset"],
+					result["latency_p50_ms"],
+					result["latency_p95_ms"],
+					result["latency_p99_ms"],
+					result["dropped"],
+				)
+			)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+	main()
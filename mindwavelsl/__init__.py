@@ -1,3 +1,10 @@
-from mindwavelsl.outlet import MindwaveLSL
-
 __all__ = ['MindwaveLSL']
+
+
+def __getattr__(name):
+	# MindwaveLSL is imported on first use so that importing the
+	# package, or its lightweight modules, doesn't load pylsl and numpy
+	if name == 'MindwaveLSL':
+		from mindwavelsl.outlet import MindwaveLSL
+		return MindwaveLSL
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
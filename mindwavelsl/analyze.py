@@ -0,0 +1,569 @@
+"""
+Offline analysis of recordings: the effective sampling rate, the
+dropouts and timing jitter of each segment, and the band power and
+spectrogram of the raw data. Recordings are read in blocks, so files
+larger than the memory can be analyzed.
+"""
+import argparse
+import itertools
+import json
+import numpy as np
+import os
+
+from mindwavelsl.binary import load_binary
+from mindwavelsl.compression import read_frames, read_header, split_codec
+from mindwavelsl.constants import DEFAULT_BANDS, RAW_SRATE, channel_label, parse_bands
+from mindwavelsl.logger import MindwaveLogger, setup_logging
+from mindwavelsl.xdf import read_samples
+
+log = MindwaveLogger("mindwave-analyze")
+
+# Number of rows read at once from the CSV and binary files
+BLOCK_SIZE = 65536
+
+
+def _labels(fields):
+	"""
+	Returns the channel labels of the fields of a CSV or binary file.
+	"""
+	return [channel_label(field) for field in fields]
+
+
+def _select(labels, fields, channels):
+	"""
+	Returns the column of each channel, given by its label or by
+	the name of its field.
+	"""
+	columns = []
+	for channel in channels:
+		if channel in labels:
+			columns.append(labels.index(channel))
+		elif channel in fields:
+			columns.append(fields.index(channel))
+		else:
+			raise Exception(
+				"Channel %s not found, the channels are: %s" % (channel, ", ".join(labels))
+			)
+	return columns
+
+
+def read_csv(path, channels, block_size=BLOCK_SIZE):
+	"""
+	Reads the timestamps and the given channels of a CSV file written
+	by `mindwavelsl`, one block of rows at a time. Compressed files
+	are read one frame at a time.
+	:return: Generator of (timestamps, values) for each block.
+	"""
+	if split_codec(path)[1]:
+		fields = read_header(path)[1:]
+		columns = [col + 1 for col in _select(_labels(fields), fields, channels)]
+		for rows in read_frames(path):
+			yield rows[:, 0], rows[:, columns]
+		return
+
+	with open(path) as f:
+		fields = f.readline().strip().split(",")[1:]
+		columns = [col + 1 for col in _select(_labels(fields), fields, channels)]
+		while True:
+			lines = list(itertools.islice(f, block_size))
+			if not lines:
+				return
+			rows = np.loadtxt(lines, delimiter=",", ndmin=2)
+			yield rows[:, 0], rows[:, columns]
+
+
+def read_npy(path, channels, block_size=BLOCK_SIZE):
+	"""
+	Reads the timestamps and the given channels of a binary file
+	written by `mindwavelsl`, memory-mapped one block at a time.
+	:return: Generator of (timestamps, values) for each block.
+	"""
+	data, metadata = load_binary(path)
+	fields = list(data.dtype.names[1:])
+	labels = [chan["label"] for chan in metadata.get("channels", [])] or _labels(fields)
+	columns = [col + 1 for col in _select(labels, fields, channels)]
+
+	values = data.view(np.float64).reshape(len(data), -1)
+	for start in range(0, len(values), block_size):
+		block = values[start:start + block_size]
+		yield np.array(block[:, 0]), block[:, columns]
+
+
+def read_xdf(path, channels, stream=''):
+	"""
+	Reads the timestamps and the given channels of an XDF file, one
+	Samples chunk at a time. The channels are read from the first
+	stream that has all of them, or from the stream with the given
+	name.
+	:return: Generator of (timestamps, values) for each chunk.
+	"""
+	selected = []
+
+	def select(info):
+		if selected or (stream and info["name"] != stream):
+			return False
+		# The streams only have labels, the field names are given by
+		# the label of their channel
+		columns = []
+		for channel in channels:
+			for label in (channel, channel_label(channel)):
+				if label in info["labels"]:
+					columns.append(info["labels"].index(label))
+					break
+		if len(columns) == len(channels):
+			selected.append(columns)
+			return True
+		return False
+
+	for _, timestamps, values in read_samples(path, select):
+		yield timestamps, values[:, selected[0]]
+
+	if not selected:
+		raise Exception(
+			"No stream of %s has the channels %s" % (path, ", ".join(channels))
+		)
+
+
+def read_recording(path, channels, stream=''):
+	"""
+	Reads the timestamps and the given channels of a recording in
+	blocks, with the reader of its format.
+	"""
+	ext = os.path.splitext(split_codec(path)[0])[1]
+	if ext == ".xdf":
+		return read_xdf(path, channels, stream)
+	if ext == ".npy":
+		return read_npy(path, channels)
+	return read_csv(path, channels)
+
+
+class Analyzer(object):
+	"""
+	Gathers the statistics of one channel over fixed-length segments,
+	as blocks of samples are added. The rows where the channel has no
+	value (NaN) are skipped, e.g. the low-rate packets of the single
+	stream output.
+
+	Timestamps that go back (e.g. files given out of order, or a clock
+	reset) are counted as out of order, and the samples before the
+	first one are put in the first segment.
+	"""
+	def __init__(
+			self,
+			srate=RAW_SRATE,
+			segment=60.0,
+			window=2.0,
+			bands=DEFAULT_BANDS,
+			max_freq=60.0,
+			gap=0.1
+		):
+		"""
+		Initializes the Analyzer.
+
+		:param float srate: Nominal sampling rate of the channel.
+		:param float segment: Length of the segments, in seconds.
+		:param float window: Length, in seconds, of the windows used
+			for the power spectra. Windows overlap by half.
+		:param list bands: (name, low, high) of each band in Hz.
+		:param float max_freq: Highest frequency, in Hz, kept in the
+			spectrogram.
+		:param float gap: Time, in seconds, between two samples above
+			which they are separated by a gap.
+		"""
+		self.srate = srate
+		self.segment = segment
+		self.bands = bands
+		self.gap = gap
+
+		self._length = int(round(window * srate))
+		self._hop = self._length // 2
+		self._taper = np.hanning(self._length)
+		self._scale = 2.0 / (srate * np.sum(self._taper ** 2))
+
+		self.freqs = np.fft.rfftfreq(self._length, 1.0 / srate)
+		self._kept = self.freqs <= max_freq
+
+		self.first = None
+		self.last = None
+		self.end = None
+		self._values = np.empty(0)
+		self._timestamps = np.empty(0)
+
+		# Sums of each segment, grown as segments are added
+		self._samples = np.zeros(0)
+		self._intervals = np.zeros(0)
+		self._squares = np.zeros(0)
+		self._regular = np.zeros(0)
+		self._longest = np.zeros(0)
+		self._gaps = np.zeros(0)
+		self._gap_time = np.zeros(0)
+		self._backwards = np.zeros(0)
+		self._windows = np.zeros(0)
+		self._power = np.zeros((0, int(np.sum(self._kept))))
+
+	def _grow(self, count):
+		"""
+		Makes room for the sums of `count` segments.
+		"""
+		missing = count - len(self._samples)
+		if missing <= 0:
+			return
+		for name in (
+			"_samples", "_intervals", "_squares", "_regular",
+			"_longest", "_gaps", "_gap_time", "_backwards", "_windows"
+		):
+			setattr(self, name, np.concatenate([getattr(self, name), np.zeros(missing)]))
+		self._power = np.concatenate([
+			self._power, np.zeros((missing, self._power.shape[1]))
+		])
+
+	def _segments(self, timestamps):
+		"""
+		Returns the segment of each timestamp, the first one for the
+		timestamps before the first sample.
+		"""
+		return np.maximum((timestamps - self.first) // self.segment, 0).astype(np.int64)
+
+	def add(self, timestamps, values):
+		"""
+		Adds a block of samples of the channel.
+		:param np.ndarray timestamps: Timestamp of each row.
+		:param np.ndarray values: Value of the channel in each row.
+		"""
+		present = ~np.isnan(values)
+		timestamps = np.asarray(timestamps, dtype=np.float64)[present]
+		values = np.asarray(values, dtype=np.float64)[present]
+		if not len(values):
+			return
+
+		if self.first is None:
+			self.first = timestamps[0]
+			previous = timestamps[:1]
+		else:
+			previous = np.array([self.last])
+		intervals = np.diff(np.concatenate([previous, timestamps]))
+		self.last = timestamps[-1]
+		self.end = max(timestamps.max(), self.end if self.end is not None else self.first)
+
+		segments = self._segments(timestamps)
+		self._grow(segments.max() + 1)
+		count = len(self._samples)
+
+		# Intervals longer than `gap` are gaps, negative ones are out of
+		# order, and the others are used for the timing jitter
+		gaps = intervals > self.gap
+		backwards = intervals < 0
+		regular = ~gaps & ~backwards
+		self._samples += np.bincount(segments, minlength=count)
+		self._regular += np.bincount(segments, weights=regular, minlength=count)
+		self._intervals += np.bincount(segments, weights=intervals * regular, minlength=count)
+		self._squares += np.bincount(segments, weights=intervals ** 2 * regular, minlength=count)
+		self._gaps += np.bincount(segments, weights=gaps, minlength=count)
+		self._gap_time += np.bincount(segments, weights=intervals * gaps, minlength=count)
+		self._backwards += np.bincount(segments, weights=backwards, minlength=count)
+		np.maximum.at(self._longest, segments, intervals)
+
+		self._add_windows(timestamps, values)
+
+	def _add_windows(self, timestamps, values):
+		"""
+		Adds the power spectra of the complete windows. The windows
+		that span a gap, or timestamps out of order, are skipped.
+		"""
+		self._values = np.concatenate([self._values, values])
+		self._timestamps = np.concatenate([self._timestamps, timestamps])
+		if len(self._values) < self._length:
+			return
+
+		count = (len(self._values) - self._length) // self._hop + 1
+		starts = np.arange(count) * self._hop
+		ends = starts + self._length - 1
+
+		windows = np.lib.stride_tricks.sliding_window_view(
+			self._values, self._length
+		)[starts]
+		spans = self._timestamps[ends] - self._timestamps[starts]
+		backwards = np.concatenate(([0], np.cumsum(np.diff(self._timestamps) < 0)))
+		complete = (spans <= 1.5 * self._length / self.srate) & \
+			(backwards[ends] == backwards[starts])
+
+		if complete.any():
+			windows = windows[complete]
+			windows = (windows - windows.mean(axis=1, keepdims=True)) * self._taper
+			power = np.abs(np.fft.rfft(windows, axis=1)) ** 2 * self._scale
+			power[:, 0] /= 2
+			if self._length % 2 == 0:
+				power[:, -1] /= 2
+
+			centers = (self._timestamps[starts] + self._timestamps[ends])[complete] / 2
+			segments = np.minimum(self._segments(centers), len(self._windows) - 1)
+			self._windows += np.bincount(segments, minlength=len(self._windows))
+			np.add.at(self._power, segments, power[:, self._kept])
+
+		self._values = self._values[count * self._hop:]
+		self._timestamps = self._timestamps[count * self._hop:]
+
+	def spectrogram(self):
+		"""
+		Returns the mean power spectrum of each segment, in units^2/Hz,
+		and its frequencies. Segments without a complete window are NaN.
+		"""
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return self._power / self._windows[:, None], self.freqs[self._kept]
+
+	def band_power(self):
+		"""
+		Returns the power of each band in each segment, in units^2.
+		"""
+		spectrogram, freqs = self.spectrogram()
+		step = freqs[1] - freqs[0]
+		return np.stack([
+			spectrogram[:, (freqs >= low) & (freqs < high)].sum(axis=1) * step
+			for _, low, high in self.bands
+		], axis=1)
+
+	def segments(self):
+		"""
+		Returns the statistics of each segment: its start, relative to
+		the first sample, its number of samples, effective rate, dropout
+		(the share of the expected samples that are missing), gaps,
+		timestamps out of order, timing jitter, longest interval, and
+		band power.
+		"""
+		if self.first is None:
+			return []
+
+		starts = np.arange(len(self._samples)) * self.segment
+		durations = np.full(len(starts), self.segment)
+		durations[-1] = max(self.end - self.first - starts[-1], 1.0 / self.srate)
+
+		with np.errstate(invalid="ignore", divide="ignore"):
+			means = self._intervals / self._regular
+			jitter = np.sqrt(np.maximum(self._squares / self._regular - means ** 2, 0))
+		powers = self.band_power()
+
+		rows = []
+		for ind in range(len(starts)):
+			row = {
+				"start": float(starts[ind]),
+				"timestamp": float(self.first + starts[ind]),
+				"samples": int(self._samples[ind]),
+				"srate": float(self._samples[ind] / durations[ind]),
+				"dropout": float(max(1 - self._samples[ind] / (durations[ind] * self.srate), 0)),
+				"gaps": int(self._gaps[ind]),
+				"gap_time": float(self._gap_time[ind]),
+				"out_of_order": int(self._backwards[ind]),
+				"jitter_ms": float(jitter[ind] * 1000),
+				"longest_ms": float(self._longest[ind] * 1000),
+			}
+			for (name, _, _), power in zip(self.bands, powers[ind]):
+				row[name] = float(power)
+			rows.append(row)
+		return rows
+
+	def summary(self):
+		"""
+		Returns the statistics of the whole recording.
+		"""
+		if self.first is None:
+			return {"samples": 0}
+
+		samples = int(self._samples.sum())
+		duration = self.end - self.first
+		regular = self._regular.sum()
+		mean = self._intervals.sum() / regular if regular else 0.0
+		jitter = np.sqrt(max(self._squares.sum() / regular - mean ** 2, 0)) if regular else 0.0
+		return {
+			"samples": samples,
+			"duration": float(duration),
+			"srate": float((samples - 1) / duration) if duration else 0.0,
+			"dropout": float(max(1 - samples / (duration * self.srate + 1), 0)) if duration else 0.0,
+			"gaps": int(self._gaps.sum()),
+			"gap_time": float(self._gap_time.sum()),
+			"out_of_order": int(self._backwards.sum()),
+			"jitter_ms": float(jitter * 1000),
+			"longest_ms": float(self._longest.max() * 1000),
+		}
+
+
+def _plot(label, analyzer):
+	"""
+	Plots the spectrogram and the band power of each segment.
+	"""
+	try:
+		from matplotlib import pyplot as plt
+	except ImportError:
+		raise Exception(
+			"`matplotlib` is needed for --plot, it can be installed "
+			"with `pip install matplotlib`."
+		)
+
+	spectrogram, freqs = analyzer.spectrogram()
+	starts = np.arange(len(spectrogram)) * analyzer.segment / 60.0
+
+	fig, (top, bottom) = plt.subplots(2, 1, sharex=True)
+	fig.suptitle(label)
+	with np.errstate(divide="ignore"):
+		top.pcolormesh(
+			np.append(starts, starts[-1] + analyzer.segment / 60.0),
+			freqs,
+			10 * np.log10(spectrogram.T),
+			shading="auto"
+		)
+	top.set_ylabel("Frequency (Hz)")
+	for (name, _, _), power in zip(analyzer.bands, analyzer.band_power().T):
+		bottom.semilogy(starts, power, label=name)
+	bottom.set_xlabel("Time (min)")
+	bottom.set_ylabel("Band power")
+	bottom.legend()
+
+
+def main():
+	"""
+	Analyzes recordings written by `mindwavelsl`, or by LabRecorder.
+	"""
+	parser = argparse.ArgumentParser(
+		description="Report the sampling rate, dropouts, timing jitter, and band "
+		"power of mindwavelsl recordings (CSV, compressed CSV, .npy, or .xdf). "
+		"Files are read in blocks, so they can be larger than the memory."
+	)
+	parser.add_argument('paths', type=str, nargs='+',
+						help="Recordings to analyze. Multiple files, e.g. rotated CSV "
+						"files, are analyzed as one recording, in the given order.")
+	parser.add_argument('--channels', type=str, nargs='+', default=["Fp1"],
+						help="Labels, or field names, of the channels to analyze. By "
+						"default, the raw data (Fp1).")
+	parser.add_argument('--stream', type=str, default='',
+						help="Name of the XDF stream to read. By default, the first "
+						"stream that has the channels is read.")
+	parser.add_argument('--srate', type=float, default=RAW_SRATE,
+						help="Nominal sampling rate of the channels, in Hz.")
+	parser.add_argument('--segment', type=float, default=60.0,
+						help="Length, in seconds, of the segments that the statistics "
+						"are reported for.")
+	parser.add_argument('--window', type=float, default=2.0,
+						help="Length, in seconds, of the windows of the power spectra.")
+	parser.add_argument('--gap', type=float, default=0.1,
+						help="Time, in seconds, between two samples above which they "
+						"are counted as a gap.")
+	parser.add_argument('--bands', type=parse_bands, default=DEFAULT_BANDS,
+						help="Bands given as name:low-high pairs in Hz separated by "
+						"commas. By default, the bands of the ThinkGear eegPower values.")
+	parser.add_argument('--max-freq', type=float, default=60.0,
+						help="Highest frequency, in Hz, kept in the spectrogram.")
+	parser.add_argument('--csv', type=str, default='',
+						help="Path to a CSV file to save the statistics of each segment "
+						"to. With multiple channels, the label of each one is added to "
+						"the file name.")
+	parser.add_argument('--spectrogram', type=str, default='',
+						help="Path to an `.npz` file to save the spectrogram of each "
+						"channel to, with its frequencies and segment starts.")
+	parser.add_argument('--json', action="store_true", default=False,
+						help="Set this to print the results as JSON.")
+	parser.add_argument('--plot', action="store_true", default=False,
+						help="Set this to plot the spectrogram and band power of each "
+						"channel. This needs `matplotlib`.")
+	args = parser.parse_args()
+	setup_logging("WARNING" if args.json else "INFO")
+
+	analyzers = [
+		Analyzer(
+			args.srate,
+			args.segment,
+			args.window,
+			args.bands,
+			args.max_freq,
+			args.gap
+		)
+		for _ in args.channels
+	]
+	for path in args.paths:
+		log.info("Reading %s...", path)
+		for timestamps, values in read_recording(path, args.channels, args.stream):
+			for ind, analyzer in enumerate(analyzers):
+				analyzer.add(timestamps, values[:, ind])
+
+	results = {}
+	for channel, analyzer in zip(args.channels, analyzers):
+		results[channel] = {
+			"summary": analyzer.summary(),
+			"segments": analyzer.segments(),
+		}
+
+		if args.csv and results[channel]["segments"]:
+			path = args.csv
+			if len(args.channels) > 1:
+				root, ext = os.path.splitext(args.csv)
+				path = "%s-%s%s" % (root, channel, ext)
+			segments = results[channel]["segments"]
+			with open(path, "w") as f:
+				f.write(",".join(segments[0].keys()) + "\n")
+				for row in segments:
+					f.write(",".join("%.10g" % value for value in row.values()) + "\n")
+
+	if args.spectrogram:
+		arrays = {}
+		for channel, analyzer in zip(args.channels, analyzers):
+			spectrogram, freqs = analyzer.spectrogram()
+			arrays[channel] = spectrogram
+			arrays["%s-starts" % channel] = np.arange(len(spectrogram)) * analyzer.segment
+			arrays["freqs"] = freqs
+		np.savez(args.spectrogram, **arrays)
+
+	if args.json:
+		print(json.dumps(results, indent=4))
+	else:
+		for channel, result in results.items():
+			summary = result["summary"]
+			if not summary["samples"]:
+				print("%s: no samples" % channel)
+				continue
+			print(
+				"%s: %d samples over %.1fs, %.2f Hz effective rate, %.2f%% dropout, "
+				"%d gaps (%.1fs), %.3f ms jitter, longest interval %.1f ms" % (
+					channel,
+					summary["samples"],
+					summary["duration"],
+					summary["srate"],
+					summary["dropout"] * 100,
+					summary["gaps"],
+					summary["gap_time"],
+					summary["jitter_ms"],
+					summary["longest_ms"],
+				)
+			)
+			if summary["out_of_order"]:
+				print(
+					"%s: %d timestamps out of order (inputs not in time order, "
+					"or clock reset)" % (channel, summary["out_of_order"])
+				)
+			names = [name for name, _, _ in args.bands]
+			print(
+				"%8s %8s %9s %8s %5s %9s %8s " % (
+					"start s", "samples", "rate Hz", "dropout", "gaps", "jitter ms", "max ms"
+				) + " ".join("%10s" % name[:10] for name in names)
+			)
+			for row in result["segments"]:
+				print(
+					"%8.0f %8d %9.2f %7.2f%% %5d %9.3f %8.1f " % (
+						row["start"],
+						row["samples"],
+						row["srate"],
+						row["dropout"] * 100,
+						row["gaps"],
+						row["jitter_ms"],
+						row["longest_ms"],
+					) + " ".join("%10.4g" % row[name] for name in names)
+				)
+
+	if args.plot:
+		from matplotlib import pyplot as plt
+
+		for channel, analyzer in zip(args.channels, analyzers):
+			if analyzer.first is not None:
+				_plot(channel, analyzer)
+		plt.show()
+
+
+if __name__ == "__main__":
+	main()
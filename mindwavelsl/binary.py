@@ -0,0 +1,286 @@
+"""
+Binary file output in the NumPy `.npy` format. The files can be
+memory-mapped with `numpy.load(path, mmap_mode='r')` for analysis.
+"""
+import argparse
+import json
+import numpy as np
+import os
+import time
+
+from mindwavelsl.logger import MindwaveLogger
+
+log = MindwaveLogger("mindwave-binary")
+
+# Size reserved for the `.npy` header so that it can be rewritten
+# in place with the new number of records after each block.
+HEADER_SIZE = 4096
+
+# Name of the timestamp field that is added before the data fields
+TIMESTAMP_FIELD = "timestamp"
+
+
+def metadata_path(path):
+	"""
+	Returns the path of the JSON file holding the channel metadata
+	of a binary file.
+	:param str path: Path to the `.npy` file.
+	"""
+	return os.path.splitext(path)[0] + ".json"
+
+
+def load_binary(path):
+	"""
+	Memory-maps a binary file and returns it with its metadata. The
+	records have a `timestamp` field followed by a field per channel.
+	:param str path: Path to the `.npy` file.
+	"""
+	data = np.load(path, mmap_mode='r')
+
+	metadata = {}
+	if os.path.exists(metadata_path(path)):
+		with open(metadata_path(path)) as f:
+			metadata = json.load(f)
+
+	return data, metadata
+
+
+def binary_to_csv(path, csv_path='', block_size=65536):
+	"""
+	Converts a binary file to CSV, one block of records at a time.
+	:param str path: Path to the `.npy` file.
+	:param str csv_path: Path to the CSV file, by default it's
+		next to the binary file.
+	:param int block_size: Number of records converted at once.
+	"""
+	if not csv_path:
+		csv_path = os.path.splitext(path)[0] + ".csv"
+
+	data, _ = load_binary(path)
+	values = data.view(np.float64).reshape(len(data), -1)
+
+	with open(csv_path, "w") as f:
+		f.write(",".join(data.dtype.names) + "\n")
+		for start in range(0, len(values), block_size):
+			np.savetxt(
+				f, values[start:start + block_size], fmt="%.15g", delimiter=","
+			)
+
+	return csv_path
+
+
+class BinaryFileOutlet(object):
+	"""
+	Used to output gathered data to a `.npy` file of float64 records
+	with a timestamp for each sample. Records are gathered in a
+	preallocated block and appended to the file once it's full, or
+	once they have been waiting for `flush_interval`.
+	"""
+	def __init__(self, path, block_size=4096, flush_interval=1.0):
+		"""
+		Initialize the BinaryFileOutlet.
+
+		:param str path: Path to the output location.
+		:param int block_size: Number of records written at once.
+		:param float flush_interval: Maximum time, in seconds, that
+			records are kept in memory before they are written.
+		"""
+		self.path = path
+		self.file = 'mindwave-output.npy'
+		self.block_size = block_size
+		self.flush_interval = flush_interval
+
+		self._header = []
+		self._channels = []
+		self._filehandler = None
+		self._block = None
+		self._count = 0
+		self._written = 0
+		self._last_flush = 0
+
+	def _make_dirs(self):
+		"""
+		Makes the output directory.
+		"""
+		if self.path.endswith('.npy'):
+			path, file = os.path.split(self.path)
+			self.path = path
+			self.file = file
+		os.makedirs(self.path or '.', exist_ok=True)
+
+	def _dtype(self):
+		"""
+		Returns the record type of the file.
+		"""
+		return np.dtype(
+			[(TIMESTAMP_FIELD, '<f8')] + [(field, '<f8') for field in self._header]
+		)
+
+	def _write_header(self):
+		"""
+		Writes the `.npy` header with the current number of records.
+		"""
+		header = {
+			'descr': np.lib.format.dtype_to_descr(self._dtype()),
+			'fortran_order': False,
+			'shape': (self._written,),
+		}
+		header = repr(header).encode('latin1')
+
+		# Magic string, version 1.0, and the length of the header
+		preamble = b'\x93NUMPY\x01\x00'
+		length = HEADER_SIZE - len(preamble) - 2
+		if len(header) + 1 > length:
+			raise Exception("Too many channels for the binary file header.")
+		header = header.ljust(length - 1) + b'\n'
+
+		self._filehandler.seek(0)
+		self._filehandler.write(preamble)
+		self._filehandler.write(np.uint16(length).tobytes())
+		self._filehandler.write(header)
+		self._filehandler.seek(0, os.SEEK_END)
+
+	def _write_metadata(self, path):
+		"""
+		Writes the channel metadata next to the binary file.
+		"""
+		metadata = {
+			"fields": [TIMESTAMP_FIELD] + list(self._header),
+			"channels": [
+				{
+					"metric": chan.metric,
+					"label": chan.label,
+					"type": chan.metatype,
+					"unit": chan.unit,
+				}
+				for chan in self._channels
+			],
+		}
+		with open(metadata_path(path), "w") as f:
+			json.dump(metadata, f, indent=4)
+
+	def set_header(self, header):
+		"""
+		Sets up the names of the data fields.
+		:param list header: Name of each of the data columns.
+		"""
+		self._header = header
+
+	def set_channels(self, channels):
+		"""
+		Sets the `_Channel` objects describing each data field.
+		:param list channels: Channel for each data column.
+		"""
+		self._channels = channels
+
+	def setup_outlet(self):
+		"""
+		Sets up the file that data will be written to. An existing
+		file is overwritten.
+		"""
+		if not self._header:
+			raise Exception("BinaryFileOutlet header is empty.")
+
+		self._make_dirs()
+		path = os.path.join(self.path, self.file)
+
+		self._block = np.empty(
+			(self.block_size, len(self._header) + 1), dtype=np.float64
+		)
+		self._filehandler = open(path, "w+b")
+		self._write_header()
+		self._write_metadata(path)
+		self._last_flush = time.monotonic()
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Push a sample that conforms to the given header.
+		:param list sample: Data sample to write.
+		:param float timestamp: Time at which the sample was read.
+		"""
+		row = self._block[self._count]
+		row[0] = timestamp
+		row[1:] = sample
+		self._count += 1
+
+		if (
+			self._count == self.block_size
+			or time.monotonic() - self._last_flush >= self.flush_interval
+		):
+			self.flush()
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Push multiple samples that conform to the given header.
+		:param np.ndarray samples: Data samples to write.
+		:param list timestamps: Time at which each sample was read.
+		"""
+		samples = np.asarray(samples, dtype=np.float64)
+		timestamps = np.asarray(timestamps, dtype=np.float64)
+
+		start = 0
+		while start < len(samples):
+			count = min(self.block_size - self._count, len(samples) - start)
+			block = self._block[self._count:self._count + count]
+			block[:, 0] = timestamps[start:start + count]
+			block[:, 1:] = samples[start:start + count]
+
+			self._count += count
+			start += count
+			if self._count == self.block_size:
+				self.flush()
+
+		self.poll()
+
+	def poll(self):
+		"""
+		Writes the gathered records if they have been waiting for too long.
+		"""
+		if self._count and time.monotonic() - self._last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		"""
+		Appends the gathered records to the file and updates
+		the record count in its header.
+		"""
+		self._last_flush = time.monotonic()
+		if not self._count:
+			return
+
+		self._filehandler.write(self._block[:self._count].tobytes())
+		self._written += self._count
+		self._count = 0
+
+		self._write_header()
+		self._filehandler.flush()
+
+	def close(self):
+		"""
+		Writes the remaining records and closes the file.
+		"""
+		if self._filehandler is None:
+			return
+		self.flush()
+		self._filehandler.close()
+		self._filehandler = None
+
+
+def main():
+	"""
+	Converts binary files from `mindwavelsl` to CSV files.
+	"""
+	parser = argparse.ArgumentParser(
+		description="Convert the binary `.npy` files written by mindwavelsl to CSV."
+	)
+	parser.add_argument('paths', type=str, nargs='+',
+						help="Binary files to convert, each one is converted to a "
+						"CSV file next to it.")
+	args = parser.parse_args()
+
+	for path in args.paths:
+		log.info("Converted %s to %s", path, binary_to_csv(path))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,151 @@
+"""
+Compressed CSV output. The rows are compressed in independent frames,
+one per batch, and an index next to the file holds the position and
+the time range of each frame so that parts of a recording can be read
+without decompressing the whole file.
+"""
+import io
+import numpy as np
+import os
+
+# Extensions of the compressed files, and the module each codec needs
+CODECS = {
+	".gz": "gzip",
+	".zst": "zstandard",
+	".lz4": "lz4",
+}
+
+# Columns of the frame index
+INDEX_HEADER = "offset,size,rows,first_timestamp,last_timestamp"
+
+
+def split_codec(path):
+	"""
+	Splits the extension of a codec from a path, e.g. `data.csv.zst`
+	returns `data.csv` and `.zst`. The extension is empty for paths
+	that aren't compressed.
+	:param str path: Path to split.
+	"""
+	root, ext = os.path.splitext(path)
+	if ext in CODECS:
+		return root, ext
+	return path, ''
+
+
+def index_path(path):
+	"""
+	Returns the path of the frame index of a compressed file.
+	:param str path: Path to the compressed file.
+	"""
+	return path + ".idx"
+
+
+def _import_codec(ext):
+	"""
+	Imports the module of a codec. `zstandard` and `lz4` are only
+	needed by the files that use them.
+	"""
+	name = CODECS[ext]
+	try:
+		if name == "gzip":
+			import gzip
+			return gzip
+		if name == "zstandard":
+			import zstandard
+			return zstandard
+		import lz4.frame
+		return lz4.frame
+	except ImportError:
+		raise Exception(
+			"`%s` is needed to write and read `%s` files, it can be "
+			"installed with `pip install %s`." % (name, ext, name)
+		)
+
+
+class Codec(object):
+	"""
+	Compresses and decompresses independent frames with the codec
+	of a file extension.
+	"""
+	def __init__(self, ext, level=None):
+		"""
+		:param str ext: Extension of the codec, one of `CODECS`.
+		:param int level: Compression level, the default of the
+			codec is used if not set.
+		"""
+		self.ext = ext
+		self._module = _import_codec(ext)
+
+		if ext == ".gz":
+			level = 6 if level is None else level
+			self.compress = lambda data: self._module.compress(data, compresslevel=level)
+			self.decompress = self._module.decompress
+		elif ext == ".zst":
+			compressor = self._module.ZstdCompressor(level=3 if level is None else level)
+			decompressor = self._module.ZstdDecompressor()
+			self.compress = compressor.compress
+			self.decompress = decompressor.decompress
+		else:
+			self.compress = lambda data: self._module.compress(
+				data, compression_level=level or 0
+			)
+			self.decompress = self._module.decompress
+
+
+def read_index(path):
+	"""
+	Returns the frame index of a compressed file as an array of
+	records with the fields of `INDEX_HEADER`.
+	:param str path: Path to the compressed file.
+	"""
+	return np.atleast_1d(np.genfromtxt(
+		index_path(path), delimiter=",", names=True, dtype=None
+	))
+
+
+def read_frames(path, start=None, end=None):
+	"""
+	Reads the frames of a compressed CSV file that overlap a time
+	range, one at a time. Only those frames are decompressed.
+
+	:param str path: Path to the compressed file.
+	:param float start: Start of the time range, from the beginning
+		of the file if not set.
+	:param float end: End of the time range, up to the end of the
+		file if not set.
+	:return: Generator of the rows of each frame, with the timestamp
+		in the first column.
+	"""
+	codec = Codec(split_codec(path)[1])
+	index = read_index(path)
+
+	with open(path, "rb") as f:
+		for frame in index:
+			if start is not None and frame["last_timestamp"] < start:
+				continue
+			if end is not None and frame["first_timestamp"] > end:
+				continue
+			f.seek(int(frame["offset"]))
+			data = codec.decompress(f.read(int(frame["size"])))
+			rows = np.loadtxt(io.BytesIO(data), delimiter=",", ndmin=2)
+			if start is not None or end is not None:
+				keep = np.ones(len(rows), dtype=bool)
+				if start is not None:
+					keep &= rows[:, 0] >= start
+				if end is not None:
+					keep &= rows[:, 0] <= end
+				rows = rows[keep]
+			yield rows
+
+
+def read_header(path):
+	"""
+	Returns the CSV header of a compressed file, which is stored in
+	its own frame at the start of the file.
+	:param str path: Path to the compressed file.
+	"""
+	codec = Codec(split_codec(path)[1])
+	index = read_index(path)
+	with open(path, "rb") as f:
+		data = f.read(int(index[0]["offset"]) if len(index) else -1)
+	return codec.decompress(data).decode().strip().split(",")
@@ -1,24 +1,61 @@
 import collections
+import collections.abc
+import itertools
 import json
-from telnetlib import Telnet
-
-try:
-	import mindwavelsl.vendor.mindwave as mindwave
-except:
-	pass
+import logging
+import numpy as np
+import os
+import pylsl as lsl
+import queue
+import socket
+import threading
+import time
 
+from mindwavelsl.binary import load_binary
+from mindwavelsl.compression import read_frames, read_header, split_codec
+from mindwavelsl.constants import (
+	EXPECTED_FIELDS,
+	MINDWAVEPYTHON_MAPPINGS,
+	RAW_SRATE,
+	channel_label,
+	get_wave_value
+)
+from mindwavelsl.decoder import SampleBuilder, ThinkGearDecoder
 from mindwavelsl.logger import MindwaveLogger
-from mindwavelsl.constants import EXPECTED_FIELDS, MINDWAVEPYTHON_MAPPINGS
+from mindwavelsl.xdf import read_samples
 
 log = MindwaveLogger('mindwave-connector')
 
+# Extensions of the captures of the ThinkGear Connector stream that
+# can be replayed
+CAPTURE_EXTENSIONS = ["", ".json", ".txt", ".log"]
+
+
+class EndOfStream(Exception):
+	"""
+	Raised by connectors that have no more data to read.
+	"""
+	pass
+
 
 class MindwavePythonWrapper(object):
 	"""
 	Wrapper class for the `mindwave` module. Not fully tested.
+
+	Samples are queued by the `mindwave.Headset` handlers as soon as
+	their packets are decoded, so each one is read exactly once.
 	"""
 
-	def __init__(self, device, headset_id, open_serial):
+	# Handler lists of mindwave.Headset for each attribute it sets
+	HANDLERS = {
+		"raw_value": ["raw_value_handlers"],
+		"attention": ["attention_handlers"],
+		"meditation": ["meditation_handlers"],
+		"blink": ["blink_handlers"],
+		"poor_signal": ["signal_handlers"],
+	}
+
+	def __init__(self, device, headset_id, open_serial, timeout=1.0, queue_size=4096):
 		"""
 		Initializes the MindwavePythonWrapper.
 
@@ -26,39 +63,125 @@ class MindwavePythonWrapper(object):
 		:param str headset_id: ID of the headset.
 		:param bool open_serial: If set to false then,
 			the serial connection won't be opened.
+		:param float timeout: Maximum time, in seconds, that `read`
+			waits for a new sample.
+		:param int queue_size: Number of decoded samples that can wait
+			to be read before new ones are dropped.
 		"""
 		self._device = device
 		self._headset_id = headset_id
 		self._open_serial = open_serial
 
 		self.headset = None
+		self.waves_builder = None
+		self.timeout = timeout
+		self.timestamp = None
+		self.dropped = 0
+
+		self._queue = queue.Queue(queue_size)
+		self._empty = [float("nan")] * len(EXPECTED_FIELDS)
 
 	def setup(self):
 		"""
 		Sets up the mindwave.Headset object.
 		"""
+		import mindwavelsl.vendor.mindwave as mindwave
+
 		log.info("Connecting to headset using mindwave-python...")
+
+		# The serial listener is started once the handlers are
+		# registered so that no packet is missed
 		self.headset = mindwave.Headset(
 			self._device,
 			headset_id=self._headset_id,
-			open_serial=self._open_serial
+			open_serial=False
 		)
+		self._register_handlers()
+		if self._open_serial:
+			self.headset.serial_open()
 		self.headset.connect()
 		log.info("Connected to headset through mindwave-python")
 
-	def read(self):
+	def alive(self):
+		"""
+		Returns False once the serial listener of the headset has stopped.
+		"""
+		listener = getattr(self.headset, "listener", None)
+		return listener is None or listener.is_alive()
+
+	def close(self):
+		"""
+		Stops the headset and closes its serial connection.
 		"""
-		Reads from the connection. Returns a sample whose ordering is based
-		on the `constants.EXPECTED_FIELDS` list.
+		if self.headset is None:
+			return
+		self.headset.stop()
+		try:
+			self.headset.serial_close()
+		except Exception:
+			pass
+		self.headset = None
+
+	def _register_handlers(self):
+		"""
+		Registers handlers on the headset that queue a sample for each
+		decoded packet, using `constants.MINDWAVEPYTHON_MAPPINGS` to find
+		the field of each value.
 		"""
-		def _default_val(headset, field):
-			return np.nan
+		wave_fields = {}
+		for field, (func, name) in MINDWAVEPYTHON_MAPPINGS.items():
+			if func is get_wave_value:
+				wave_fields[name] = field
+				continue
 
-		sample = []
-		for field in EXPECTED_FIELDS:
-			func, field = MINDWAVEPYTHON_MAPPINGS.get(field, (_default_val, ""))
-			sample.append(func(self.headset, field))
+			handler = self._make_value_handler(EXPECTED_FIELDS.index(field))
+			for handlers in self.HANDLERS.get(name, []):
+				getattr(self.headset, handlers).append(handler)
 
+		self.waves_builder = SampleBuilder(EXPECTED_FIELDS, keys=wave_fields)
+		self.headset.waves_handlers.append(self._make_waves_handler())
+
+	def _make_value_handler(self, ind):
+		"""
+		Returns a handler that queues a sample with a single value.
+		"""
+		def handler(headset, value):
+			sample = self._empty[:]
+			sample[ind] = value
+			self._queue_sample(sample)
+		return handler
+
+	def _make_waves_handler(self):
+		"""
+		Returns a handler that queues a sample with the band powers. The
+		bands that aren't part of the fields are counted in
+		`waves_builder.unknown`.
+		"""
+		def handler(headset, waves):
+			sample = self.waves_builder.build(waves)
+			if sample is not None:
+				self._queue_sample(sample)
+		return handler
+
+	def _queue_sample(self, sample):
+		"""
+		Queues a sample with the time at which it was decoded.
+		"""
+		try:
+			self._queue.put_nowait((sample, lsl.local_clock()))
+		except queue.Full:
+			self.dropped += 1
+
+	def read(self):
+		"""
+		Waits for the next decoded sample and returns it. The sample is
+		ordered like `constants.EXPECTED_FIELDS`, and its decoding time is
+		stored in `timestamp`. Returns None if no sample arrived in time.
+		"""
+		try:
+			sample, self.timestamp = self._queue.get(timeout=self.timeout)
+		except queue.Empty:
+			return None
 		return sample
 
 	def write(self, data):
@@ -70,34 +193,55 @@ class MindwavePythonWrapper(object):
 
 class TelnetConnector(object):
 	"""
-	Used to connect, and read/write with the Telnet connection.
+	Used to connect, and read/write with the ThinkGear Connector socket.
 	"""
-	def __init__(self, host, port):
+	def __init__(self, host, port, read_size=4096, timeout=None):
 		"""
 		Initializes the connector.
 		:param str host: Host to connect to.
 		:param int port: Port to connect to on host.
+		:param int read_size: Maximum number of bytes to read from
+			the socket at once.
+		:param float timeout: If set, reading raises `socket.timeout`
+			when no data arrived for this many seconds.
 		"""
 		self.host = host
 		self.port = port
+		self.read_size = read_size
+		self.timeout = timeout
 		self.connection = None
+		self.timestamp = None
+
+		self.decoder = ThinkGearDecoder(EXPECTED_FIELDS)
+		self._samples = collections.deque()
 
 	def setup(self):
 		"""
-		Starts the telnet connection.
+		Starts the socket connection.
 		"""
 		log.info("Connecting to ThinkGear Connector...")
-		self.connection = Telnet(self.host, self.port)
-		log.info("Connected with telnet")
+		self.connection = socket.create_connection((self.host, self.port), self.timeout)
+		self.decoder.reset()
+		self._samples.clear()
+		log.info("Connected to ThinkGear Connector")
 
 	def read(self):
 		"""
-		Read from the connection until `\\r` is found.
+		Returns the next sample, ordered like `constants.EXPECTED_FIELDS`.
+		The socket is read in large chunks, and all the frames found
+		in a chunk are decoded at once. The time at which the chunk
+		arrived is stored in `timestamp`.
 		"""
-		return flatten(json.loads(
-			self.connection.read_until(b"\r")
-		))
+		while not self._samples:
+			data = self.connection.recv(self.read_size)
+			arrival = lsl.local_clock()
+			if not data:
+				raise EOFError("Connection closed by the ThinkGear Connector")
+			for sample in self.decoder.feed(data):
+				self._samples.append((sample, arrival))
 
+		sample, self.timestamp = self._samples.popleft()
+		return sample
 
 	def write(self, data):
 		"""
@@ -105,7 +249,481 @@ class TelnetConnector(object):
 		"""
 		if type(data) == dict:
 			data = json.dumps(data)
-		self.connection.write(str.encode(data))
+		self.connection.sendall(str.encode(data))
+
+	def close(self):
+		"""
+		Closes the connection.
+		"""
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+
+class AsyncThinkGearConnector(object):
+	"""
+	Used to connect, and read/write with the ThinkGear Connector
+	socket from an asyncio event loop.
+	"""
+	def __init__(self, host, port, read_size=4096, timeout=None):
+		"""
+		Initializes the connector.
+		:param str host: Host to connect to.
+		:param int port: Port to connect to on host.
+		:param int read_size: Maximum number of bytes to read from
+			the socket at once.
+		:param float timeout: If set, reading raises `asyncio.TimeoutError`
+			when no data arrived for this many seconds.
+		"""
+		self.host = host
+		self.port = port
+		self.read_size = read_size
+		self.timeout = timeout
+		self.timestamp = None
+
+		self._reader = None
+		self._writer = None
+		self.decoder = ThinkGearDecoder(EXPECTED_FIELDS)
+		self._samples = collections.deque()
+
+	async def setup(self):
+		"""
+		Starts the socket connection.
+		"""
+		import asyncio
+
+		log.info("Connecting to ThinkGear Connector at %s:%s...", self.host, self.port)
+		self._reader, self._writer = await asyncio.open_connection(
+			self.host, self.port
+		)
+		self.decoder.reset()
+		self._samples.clear()
+		log.info("Connected to ThinkGear Connector at %s:%s", self.host, self.port)
+
+	async def read(self):
+		"""
+		Returns the next sample, ordered like `constants.EXPECTED_FIELDS`.
+		The time at which its data arrived is stored in `timestamp`.
+		"""
+		import asyncio
+
+		while not self._samples:
+			data = await asyncio.wait_for(
+				self._reader.read(self.read_size), self.timeout
+			)
+			arrival = lsl.local_clock()
+			if not data:
+				raise EOFError("Connection closed by the ThinkGear Connector")
+			for sample in self.decoder.feed(data):
+				self._samples.append((sample, arrival))
+
+		sample, self.timestamp = self._samples.popleft()
+		return sample
+
+	async def write(self, data):
+		"""
+		Writes to the connection.
+		"""
+		if type(data) == dict:
+			data = json.dumps(data)
+		self._writer.write(str.encode(data))
+		await self._writer.drain()
+
+	async def close(self):
+		"""
+		Closes the connection.
+		"""
+		if self._writer is not None:
+			self._writer.close()
+			await self._writer.wait_closed()
+			self._writer = None
+
+
+class Backoff(object):
+	"""
+	Exponentially growing delays between reconnection attempts.
+	"""
+	def __init__(self, initial=0.1, maximum=2.0, factor=2.0):
+		"""
+		Initializes the Backoff.
+
+		:param float initial: First delay, in seconds.
+		:param float maximum: Maximum delay, in seconds.
+		:param float factor: Growth of the delay after each attempt.
+		"""
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.reset()
+
+	def reset(self):
+		"""
+		Starts again from the first delay.
+		"""
+		self.delay = self.initial
+
+	def next(self):
+		"""
+		Returns the delay before the next attempt.
+		"""
+		delay = self.delay
+		self.delay = min(self.delay * self.factor, self.maximum)
+		return delay
+
+
+class ReconnectingConnector(object):
+	"""
+	Supervises a `TelnetConnector` or a `MindwavePythonWrapper`. When
+	the connection fails, or no data arrives for too long, it reconnects
+	with exponential backoff and sends again the data that was written
+	to it (e.g. the raw output config). Once data arrives again, the
+	gap is reported through `on_gap`.
+
+	Other attributes, like `decoder`, are taken from the connector.
+	"""
+	def __init__(self, connector, stale_timeout=5.0, backoff=None, on_gap=None):
+		"""
+		Initializes the ReconnectingConnector.
+
+		:param object connector: Connector to supervise.
+		:param float stale_timeout: Time, in seconds, without data after
+			which the connection is considered lost.
+		:param Backoff backoff: Delays between the attempts.
+		:param callable on_gap: Called with the time of the last sample
+			before a gap, and of the first sample after it.
+		"""
+		self.connector = connector
+		self.stale_timeout = stale_timeout
+		self.backoff = backoff or Backoff()
+		self.on_gap = on_gap
+		self.reconnects = 0
+		self.timestamp = None
+
+		self._writes = []
+		self._stop = threading.Event()
+
+		# Time of the last sample, and of the last sample or connection
+		# for the stale check, so that a connection that never sends
+		# anything is caught as well
+		self._last_sample = None
+		self._last_data = None
+		self._gap_start = None
+
+	def __getattr__(self, name):
+		return getattr(self.connector, name)
+
+	def setup(self):
+		"""
+		Connects, retrying until it works or `stop` is called.
+		"""
+		self._connect()
+
+	def _connect(self):
+		"""
+		Tries to connect with a growing delay between the attempts.
+		"""
+		self.backoff.reset()
+		while not self._stop.is_set():
+			try:
+				self.connector.setup()
+				for data in self._writes:
+					self.connector.write(data)
+				self._last_data = lsl.local_clock()
+				return
+			except Exception as e:
+				delay = self.backoff.next()
+				log.limited(
+					logging.WARNING,
+					"Could not connect, retrying in %.1fs: %s - %s",
+					delay, e.__class__.__name__, e
+				)
+				self._close()
+				self._stop.wait(delay)
+
+		raise EndOfStream("Stopped while reconnecting")
+
+	def _reconnect(self, reason):
+		"""
+		Reconnects after the connection was lost.
+		"""
+		start = lsl.local_clock()
+		log.warning("Connection lost (%s), reconnecting...", reason)
+		if self._gap_start is None:
+			self._gap_start = self._last_sample if self._last_sample is not None else start
+
+		self.reconnects += 1
+		self._close()
+		self._connect()
+		log.info("Reconnected after %.2fs", lsl.local_clock() - start)
+
+	def _close(self):
+		if hasattr(self.connector, "close"):
+			try:
+				self.connector.close()
+			except Exception:
+				pass
+
+	def read(self):
+		"""
+		Returns the next sample of the connector, or None while
+		reconnecting.
+		"""
+		try:
+			sample = self.connector.read()
+		except (OSError, EOFError) as e:
+			self._reconnect("%s - %s" % (e.__class__.__name__, e))
+			return None
+
+		now = lsl.local_clock()
+		if sample is None:
+			alive = getattr(self.connector, "alive", None)
+			if alive is not None and not alive():
+				self._reconnect("the listener stopped")
+			elif self._last_data is not None and now - self._last_data > self.stale_timeout:
+				self._reconnect("no data for %.1fs" % (now - self._last_data))
+			return None
+
+		self.timestamp = getattr(self.connector, "timestamp", None) or now
+		self._last_sample = now
+		self._last_data = now
+		if self._gap_start is not None:
+			if self.on_gap is not None:
+				self.on_gap(self._gap_start, self.timestamp)
+			self._gap_start = None
+		return sample
+
+	def write(self, data):
+		"""
+		Writes to the connector, and again after each reconnection.
+		"""
+		if data not in self._writes:
+			self._writes.append(data)
+		self.connector.write(data)
+
+	def stop(self):
+		"""
+		Stops the reconnection attempts.
+		"""
+		self._stop.set()
+
+	def close(self):
+		"""
+		Stops the reconnection attempts and closes the connector.
+		"""
+		self.stop()
+		self._close()
+
+
+class ReplayConnector(object):
+	"""
+	Used to replay a recording as if it was coming from a headset.
+	It reads the CSV (compressed or not), `.npy`, and `.xdf` files
+	written by the file outlets, or captures of the raw ThinkGear
+	Connector JSON stream.
+	"""
+	def __init__(self, path, speed=1.0, read_size=65536):
+		"""
+		Initializes the connector.
+		:param str path: Path to the recording.
+		:param float speed: Replay speed relative to real time, set
+			to 0 to replay as fast as possible.
+		:param int read_size: Number of bytes read at once from JSON
+			captures.
+		"""
+		self.path = path
+		self.speed = speed
+		self.read_size = read_size
+		self.timestamp = None
+
+		self._samples = None
+		self._file = None
+		self._start = None
+		self._clock_start = None
+
+	def setup(self):
+		"""
+		Opens the recording.
+		"""
+		log.info("Replaying %s...", self.path)
+		root, codec = split_codec(self.path)
+		ext = os.path.splitext(root)[1]
+		if codec and ext != '.csv':
+			raise ValueError(
+				"Only CSV recordings can be replayed compressed, got: %s" % self.path
+			)
+
+		if ext == '.npy':
+			self._samples = self._read_binary()
+		elif ext == '.csv':
+			self._samples = self._read_csv()
+		elif ext == '.xdf':
+			self._samples = self._read_xdf()
+		elif ext in CAPTURE_EXTENSIONS:
+			self._samples = self._read_capture()
+		else:
+			raise ValueError(
+				"Cannot replay %s, recordings must be CSV (optionally compressed), "
+				"`.npy`, or `.xdf` files, or captures with one of these extensions: %s" % (
+					self.path, ", ".join(ext or "none" for ext in CAPTURE_EXTENSIONS)
+				)
+			)
+
+	def _field_indices(self, fields):
+		"""
+		Returns the (column, index) pairs that map the columns of
+		a recording to the `constants.EXPECTED_FIELDS` ordering.
+		"""
+		return [
+			(column, EXPECTED_FIELDS.index(field))
+			for column, field in enumerate(fields)
+			if field in EXPECTED_FIELDS
+		]
+
+	def _raw_timestamps(self, samples):
+		"""
+		Adds timestamps to samples from a recording without them. The raw
+		samples are spaced at the nominal rate, and the other samples take
+		the time of the last raw sample.
+		"""
+		raw_index = EXPECTED_FIELDS.index("rawEeg")
+		timestamp = 0.0
+		for sample in samples:
+			raw = sample[raw_index]
+			# NaN is the only value that isn't equal to itself
+			if raw == raw:
+				timestamp += 1.0 / RAW_SRATE
+			yield sample, timestamp
+
+	def _read_rows(self, fields, rows):
+		"""
+		Converts the rows of a recording into samples. Uses the timestamp
+		column when there is one.
+		"""
+		empty = [float("nan")] * len(EXPECTED_FIELDS)
+		indices = self._field_indices(fields)
+		timestamp_column = fields.index("timestamp") if "timestamp" in fields else None
+
+		def _samples():
+			for row in rows:
+				sample = empty[:]
+				for column, ind in indices:
+					sample[ind] = row[column]
+				if timestamp_column is None:
+					yield sample
+				else:
+					yield sample, row[timestamp_column]
+
+		if timestamp_column is None:
+			return self._raw_timestamps(_samples())
+		return _samples()
+
+	def _read_csv(self):
+		"""
+		Reads the samples of a CSV recording. Compressed recordings are
+		read one frame at a time.
+		"""
+		if split_codec(self.path)[1]:
+			rows = (row.tolist() for frame in read_frames(self.path) for row in frame)
+			return self._read_rows(read_header(self.path), rows)
+
+		self._file = open(self.path)
+		fields = self._file.readline().strip().split(",")
+		rows = (
+			[float(value) for value in line.split(",")]
+			for line in self._file if line.strip()
+		)
+		return self._read_rows(fields, rows)
+
+	def _read_binary(self):
+		"""
+		Reads the samples of a memory-mapped `.npy` recording.
+		"""
+		data, _ = load_binary(self.path)
+		values = data.view(np.float64).reshape(len(data), -1)
+		return self._read_rows(list(data.dtype.names), (row.tolist() for row in values))
+
+	def _read_xdf(self):
+		"""
+		Reads the samples of the first stream of an `.xdf` recording
+		that has the raw data.
+		"""
+		fields = {channel_label(field): field for field in EXPECTED_FIELDS}
+		streams = []
+
+		def select(info):
+			if streams or channel_label("rawEeg") not in info["labels"]:
+				return False
+			streams.append(["timestamp"] + [fields.get(label, label) for label in info["labels"]])
+			return True
+
+		chunks = read_samples(self.path, select)
+		first = next(chunks, None)
+		if first is None:
+			raise ValueError("%s has no stream with the raw data to replay" % self.path)
+
+		def _rows():
+			for _, timestamps, values in itertools.chain([first], chunks):
+				for timestamp, row in zip(timestamps.tolist(), values.tolist()):
+					yield [timestamp] + row
+
+		return self._read_rows(streams[0], _rows())
+
+	def _read_capture(self):
+		"""
+		Reads the samples of a capture of the ThinkGear Connector stream.
+		"""
+		self._file = open(self.path, "rb")
+		decoder = ThinkGearDecoder(EXPECTED_FIELDS)
+
+		def _samples():
+			data = self._file.read(self.read_size)
+			while data:
+				for sample in decoder.feed(data):
+					yield sample
+				data = self._file.read(self.read_size)
+			for sample in decoder.feed(b"\r"):
+				yield sample
+
+		return self._raw_timestamps(_samples())
+
+	def read(self):
+		"""
+		Returns the next sample of the recording, ordered like
+		`constants.EXPECTED_FIELDS`, once it's time to replay it.
+		"""
+		try:
+			sample, recorded = next(self._samples)
+		except StopIteration:
+			raise EndOfStream("Finished replaying %s" % self.path)
+
+		now = lsl.local_clock()
+		if self._start is None:
+			self._start = recorded
+			self._clock_start = now
+
+		if self.speed:
+			delay = (recorded - self._start) / self.speed - (now - self._clock_start)
+			# Sleeping is only worth it for longer delays
+			if delay > 0.001:
+				time.sleep(delay)
+				now = lsl.local_clock()
+
+		self.timestamp = now
+		return sample
+
+	def write(self, data):
+		"""
+		Writing is ignored when replaying a recording.
+		"""
+		log.debug("Ignoring write to replay connection: %s", data)
+
+	def close(self):
+		"""
+		Closes the recording.
+		"""
+		if self._file is not None:
+			self._file.close()
+			self._file = None
 
 
 def flatten(d, parent_key='', sep='.'):
@@ -116,7 +734,7 @@ def flatten(d, parent_key='', sep='.'):
 	items = []
 	for k, v in d.items():
 		new_key = parent_key + sep + k if parent_key else k
-		if isinstance(v, collections.MutableMapping):
+		if isinstance(v, collections.abc.MutableMapping):
 			items.extend(flatten(v, new_key, sep=sep).items())
 		else:
 			items.append((new_key, v))
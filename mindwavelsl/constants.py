@@ -1,9 +1,10 @@
-import numpy as np
-
 # Links to mindwave-python variants
 MINDWAVE_PYTHON_ORIG = "https://github.com/BarkleyUS/mindwave-python"
 MINDWAVE_PYTHON_FORK = "https://github.com/faturita/python-mindwave"
 
+# Configuration sent to the ThinkGear Connector to get the raw data in JSON
+RAW_OUTPUT_CONFIG = '{"enableRawOutput": true, "format": "Json"}'
+
 # This list holds the ordering of the samples pushed to LSL
 EXPECTED_FIELDS = [
 	"rawEegMulti.ch1",
@@ -31,6 +32,65 @@ EXPECTED_FIELDS = [
 	"eegPower.highGamma",
 ]
 
+# Nominal sampling rate of the `rawEeg` and `rawEegMulti` fields
+RAW_SRATE = 512.0
+
+# Rate used for the once-per-second eSense and eegPower packets
+LOW_SRATE = 1.0
+
+# Outputs of the filter stage: an extra stream with the filtered
+# values, or the filtered values in place of the raw ones
+FILTER_PAIR = "pair"
+FILTER_REPLACE = "filtered"
+FILTER_OUTPUTS = [FILTER_PAIR, FILTER_REPLACE]
+
+# Number of samples that are filtered or decimated at once
+# when they are pushed one at a time
+FILTER_BATCH_SIZE = 32
+
+# Frequency bands (in Hz) of the ThinkGear eegPower values
+DEFAULT_BANDS = [
+	("delta", 0.5, 2.75),
+	("theta", 3.5, 6.75),
+	("lowAlpha", 7.5, 9.25),
+	("highAlpha", 10.0, 11.75),
+	("lowBeta", 13.0, 16.75),
+	("highBeta", 18.0, 29.75),
+	("lowGamma", 31.0, 39.75),
+	("midGamma", 41.0, 49.75),
+]
+
+
+# Groups of fields that are pushed to their own LSL stream when
+# running in multi-stream mode. Each entry holds the stream name suffix,
+# the stream type, the nominal rate (0 for irregular), and the fields.
+STREAM_GROUPS = [
+	("Raw", "EEG", RAW_SRATE, ["rawEeg"]),
+	("RawMulti", "EEG", RAW_SRATE, [
+		"rawEegMulti.ch%s" % i for i in range(1, 9)
+	]),
+	("eSense", "EEG", LOW_SRATE, [
+		"eSense.attention",
+		"eSense.meditation",
+		"familiarity",
+		"mentalEffort",
+	]),
+	("eegPower", "EEG", LOW_SRATE, [
+		"eegPower.delta",
+		"eegPower.theta",
+		"eegPower.lowAlpha",
+		"eegPower.highAlpha",
+		"eegPower.lowBeta",
+		"eegPower.highBeta",
+		"eegPower.lowGamma",
+		"eegPower.highGamma",
+	]),
+	("Quality", "EEG", 0, [
+		"blinkStrength",
+		"poorSignalLevel",
+	]),
+]
+
 # Mapping from LSL names to mindwave-python names and functions to retrieve them.
 #
 # Missing the `familiarity`, `rawEegMulti.*`, and `mentalEffort`
@@ -40,14 +100,14 @@ def get_value(headset, field):
 	"""
 	Returns a value from a mindwave.Headset object.
 	"""
-	return getattr(headset, field, np.nan)
+	return getattr(headset, field, float("nan"))
 
 def get_wave_value(headset, field):
 	"""
 	Returns a value from the waves attribute in a
 	mindwave.Headset object.
 	"""
-	return headset.waves.get(field, np.nan)
+	return headset.waves.get(field, float("nan"))
 
 MINDWAVEPYTHON_MAPPINGS = {
 	"rawEeg": (get_value, "raw_value"),
@@ -64,3 +124,32 @@ MINDWAVEPYTHON_MAPPINGS = {
 	"eegPower.lowGamma": (get_wave_value, "low-gamma"),
 	"eegPower.highGamma": (get_wave_value, "high-gamma")
 }
+
+
+def channel_label(field):
+	"""
+	Returns the label of the channel of a field. The raw data is
+	labelled with the position of the sensor, `Fp1`, and the other
+	fields with the position followed by the field.
+	"""
+	if field == "rawEeg":
+		return "Fp1"
+	return "Fp1-%s" % field
+
+
+def parse_bands(value):
+	"""
+	Parses bands given as `name:low-high` pairs separated by commas,
+	e.g. `alpha:8-12,beta:13-30`.
+	"""
+	bands = []
+	for band in value.split(","):
+		name, _, limits = band.partition(":")
+		low, _, high = limits.partition("-")
+		try:
+			bands.append((name.strip(), float(low), float(high)))
+		except ValueError:
+			raise ValueError(
+				"Bands must be given as name:low-high pairs, got: %s" % band
+			)
+	return bands
@@ -0,0 +1,174 @@
+"""
+Incremental decoder for the JSON stream sent by the ThinkGear Connector.
+"""
+import collections
+import json
+import time
+
+from mindwavelsl.constants import EXPECTED_FIELDS
+
+# Start of the `{"rawEeg": N}` frames that make up most of the stream
+RAW_EEG_PREFIX = b'{"rawEeg":'
+
+
+class SampleBuilder(object):
+	"""
+	Writes the values of decoded packets into samples. The column of each
+	key is looked up once, when the builder is created, so a packet only
+	costs a dict lookup per value it holds. Keys that aren't part of the
+	samples are counted in `unknown`.
+	"""
+	def __init__(self, fields=EXPECTED_FIELDS, keys=None):
+		"""
+		Initializes the SampleBuilder.
+
+		:param list fields: Fields of the samples, the nested fields of a
+			packet are joined with a `.` (e.g. `eSense.attention`).
+		:param dict keys: Maps the keys of the packets to the fields, by
+			default the keys are the fields themselves.
+		"""
+		self.fields = fields
+		self.unknown = collections.Counter()
+
+		indices = {field: ind for ind, field in enumerate(fields)}
+		if keys is None:
+			self.indices = indices
+		else:
+			self.indices = {key: indices[field] for key, field in keys.items()}
+		self.empty = [float("nan")] * len(fields)
+
+	def fill(self, packet, row):
+		"""
+		Writes the values of a packet into a row and returns the number of
+		values written.
+		:param dict packet: Decoded packet, nested dicts are flattened.
+		:param list row: Row of the sample, e.g. a list, a NumPy row, or a
+			slot of a ring buffer.
+		"""
+		indices = self.indices
+		found = 0
+		for key, value in packet.items():
+			if isinstance(value, dict):
+				for subkey, subvalue in value.items():
+					ind = indices.get(key + "." + subkey)
+					if ind is None:
+						self.unknown[key + "." + subkey] += 1
+					else:
+						row[ind] = subvalue
+						found += 1
+			else:
+				ind = indices.get(key)
+				if ind is None:
+					self.unknown[key] += 1
+				else:
+					row[ind] = value
+					found += 1
+		return found
+
+	def build(self, packet):
+		"""
+		Returns a new sample with the values of a packet, or None if
+		the packet has none of the fields.
+		:param dict packet: Decoded packet, nested dicts are flattened.
+		"""
+		sample = self.empty[:]
+		if not self.fill(packet, sample):
+			return None
+		return sample
+
+
+class ThinkGearDecoder(object):
+	"""
+	Decodes the `\\r` separated JSON frames from the ThinkGear Connector
+	straight into samples ordered like the given fields. Data can be fed
+	in chunks of any size, incomplete frames are kept until the rest
+	of the frame arrives.
+	"""
+	def __init__(self, fields=EXPECTED_FIELDS):
+		"""
+		Initializes the ThinkGearDecoder.
+
+		:param list fields: Fields of the samples, the nested fields of a
+			packet are joined with a `.` (e.g. `eSense.attention`).
+		"""
+		self.fields = fields
+		self.garbled = 0
+		self.builder = SampleBuilder(fields)
+
+		# Histogram of the time spent decoding, set to enable the timing
+		self.decode_time = None
+
+		self._raw_index = self.builder.indices.get("rawEeg")
+		self._empty = self.builder.empty
+		self._buffer = bytearray()
+
+	def reset(self):
+		"""
+		Drops the incomplete frame that is waiting, e.g. after
+		reconnecting.
+		"""
+		del self._buffer[:]
+
+	def feed(self, data):
+		"""
+		Adds data to the decoder and returns the samples for all the
+		frames that were completed by it.
+		:param bytes data: Data read from the ThinkGear Connector.
+		"""
+		if self.decode_time is not None:
+			started = time.perf_counter()
+
+		buffer = self._buffer
+		buffer += data
+
+		samples = []
+		start = 0
+		end = buffer.find(b"\r")
+		while end != -1:
+			sample = self._decode(buffer, start, end)
+			if sample is not None:
+				samples.append(sample)
+			start = end + 1
+			end = buffer.find(b"\r", start)
+
+		del buffer[:start]
+
+		if self.decode_time is not None:
+			self.decode_time.since(started)
+		return samples
+
+	def _decode(self, buffer, start, end):
+		"""
+		Decodes the frame found between `start` and `end`. Returns None if
+		the frame is empty, garbled, or has none of the fields. The keys
+		that aren't part of the fields are counted in `builder.unknown`.
+		"""
+		# Fast path for the frames holding only a raw value
+		if (
+			self._raw_index is not None
+			and buffer.startswith(RAW_EEG_PREFIX, start, end)
+			and buffer[end - 1] == 125  # "}"
+		):
+			try:
+				value = int(buffer[start + len(RAW_EEG_PREFIX):end - 1])
+			except ValueError:
+				pass
+			else:
+				sample = self._empty[:]
+				sample[self._raw_index] = value
+				return sample
+
+		frame = bytes(buffer[start:end])
+		if not frame.strip():
+			return None
+
+		try:
+			packet = json.loads(frame)
+		except ValueError:
+			self.garbled += 1
+			return None
+		if not isinstance(packet, dict):
+			self.garbled += 1
+			return None
+
+		return self.builder.build(packet)
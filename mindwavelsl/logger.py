@@ -1,4 +1,9 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
+import time
 
 logging.basicConfig(
 	level=logging.INFO,
@@ -6,19 +11,168 @@ logging.basicConfig(
 	datefmt='%H:%M:%S'
 )
 
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_listener = None
+
+
+def setup_logging(level="INFO", background=True):
+	"""
+	Sets the log level, and moves the output of the log handlers to
+	a background thread so that a slow terminal can't stall the
+	acquisition loop.
+
+	:param str level: One of `LOG_LEVELS`.
+	:param bool background: If set to False, the handlers are left
+		on the threads that log.
+	"""
+	global _listener
+
+	root = logging.getLogger()
+	root.setLevel(getattr(logging, level.upper()))
+	if not background or _listener is not None:
+		return
+
+	handlers = root.handlers[:]
+	records = queue.SimpleQueue()
+	for handler in handlers:
+		root.removeHandler(handler)
+	root.addHandler(logging.handlers.QueueHandler(records))
+
+	_listener = logging.handlers.QueueListener(
+		records, *handlers, respect_handler_level=True
+	)
+	_listener.start()
+	atexit.register(stop_logging)
+
+
+def stop_logging():
+	"""
+	Writes the remaining log records and stops the background thread.
+	"""
+	global _listener
+
+	if _listener is not None:
+		_listener.stop()
+		_listener = None
+
+
 class MindwaveLogger():
+	"""
+	Wraps a logger so that messages are only formatted when their
+	level is enabled. Arguments are formatted with `%` like
+	`logging`, e.g. `log.debug("Sample: %s", sample)`.
+	"""
 
 	def __init__(self, name, level=logging.INFO):
 		self.logger = logging.getLogger(name)
 
-	def debug(self, msg):
-		self.logger.debug(msg)
+		# Message -> [time of the last output, number of suppressed
+		# messages, interval, level]
+		self._limited = {}
+		self._lock = threading.Lock()
+		self._timer = None
+
+	def enabled(self, level):
+		return self.logger.isEnabledFor(level)
+
+	def debug(self, msg, *args):
+		if self.logger.isEnabledFor(logging.DEBUG):
+			self.logger.debug(msg, *args)
+
+	def info(self, msg, *args):
+		if self.logger.isEnabledFor(logging.INFO):
+			self.logger.info(msg, *args)
+
+	def warning(self, msg, *args):
+		if self.logger.isEnabledFor(logging.WARNING):
+			self.logger.warning(msg, *args)
+
+	def error(self, msg, *args):
+		if self.logger.isEnabledFor(logging.ERROR):
+			self.logger.error(msg, *args)
+
+	def limited(self, level, msg, *args, interval=5.0):
+		"""
+		Logs a message at most once per interval. Repeats of the same
+		message (before formatting) are counted, and their number is
+		added to the next message that gets logged, or logged on its
+		own once the interval has passed if the message doesn't come
+		back.
+
+		:param int level: Level of the message, e.g. `logging.WARNING`.
+		:param str msg: Message, formatted with `args`.
+		:param float interval: Minimum time, in seconds, between two
+			outputs of the message.
+		"""
+		if not self.logger.isEnabledFor(level):
+			return
+
+		now = time.monotonic()
+		with self._lock:
+			state = self._limited.get(msg)
+			if state is None:
+				state = self._limited[msg] = [now, 0, interval, level]
+			elif now - state[0] < interval:
+				state[1] += 1
+				self._schedule(state[0] + interval - now)
+				return
+			else:
+				suppressed = state[1]
+				state[0] = now
+				state[1] = 0
+				if suppressed:
+					msg += " (suppressed %s similar messages)" % suppressed
+
+		self.logger.log(level, msg, *args)
+
+	def _schedule(self, delay):
+		"""
+		Starts a timer that logs the suppressed messages once their
+		interval has passed. Must be called with the lock held.
+		"""
+		if self._timer is not None:
+			return
+		self._timer = threading.Timer(delay, self._summarize_due)
+		self._timer.daemon = True
+		self._timer.start()
+
+	def _summarize_due(self):
+		"""
+		Logs the number of suppressed messages whose interval has
+		passed, and waits for the others.
+		"""
+		now = time.monotonic()
+		pending = []
+		with self._lock:
+			self._timer = None
+			delays = []
+			for msg, state in self._limited.items():
+				if not state[1]:
+					continue
+				if now - state[0] >= state[2]:
+					pending.append((msg, state[1], state[3]))
+					state[0] = now
+					state[1] = 0
+				else:
+					delays.append(state[0] + state[2] - now)
+			if delays:
+				self._schedule(min(delays))
 
-	def info(self, msg):
-		self.logger.info(msg)
+		for msg, suppressed, level in pending:
+			self.logger.log(level, "Suppressed %s messages: %s", suppressed, msg)
 
-	def warning(self, msg):
-		self.logger.warning(msg)
+	def summarize(self, level=logging.WARNING):
+		"""
+		Logs the number of messages that were suppressed since
+		their last output, e.g. when stopping.
+		"""
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			pending = [(msg, state[1]) for msg, state in self._limited.items() if state[1]]
+			self._limited.clear()
 
-	def error(self, msg):
-		self.logger.error(msg)
+		for msg, suppressed in pending:
+			self.logger.log(level, "Suppressed %s messages: %s", suppressed, msg)
@@ -0,0 +1,459 @@
+"""
+Runtime metrics of the acquisition loop. They can be scraped from a
+local HTTP endpoint in the Prometheus text format, or pushed to an LSL
+diagnostics stream once per second.
+"""
+import bisect
+import collections
+import pylsl as lsl
+import threading
+import time
+
+from mindwavelsl.constants import EXPECTED_FIELDS
+from mindwavelsl.logger import MindwaveLogger
+
+log = MindwaveLogger("mindwave-metrics")
+
+PREFIX = "mindwavelsl_"
+
+# Upper bounds, in seconds, of the timing histogram buckets
+DEFAULT_BUCKETS = [
+	1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+	1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0,
+]
+
+# Description of each metric family
+DESCRIPTIONS = {
+	"stage_seconds": "Time spent in each stage of the acquisition loop.",
+	"samples_total": "Samples built from the responses.",
+	"field_values_total": "Values received for each field.",
+	"poor_signal_total": "Samples with a poor signal level of 200.",
+	"errors_total": "Errors caught in the acquisition loop.",
+	"garbled_frames_total": "Frames that could not be decoded.",
+	"dropped_samples_total": "Samples dropped because a queue was full.",
+	"unknown_keys_total": "Values received for keys that aren't fields.",
+	"dejitter_resets_total": "Restarts of the timestamp de-jittering.",
+	"reconnects_total": "Reconnections to the headset.",
+	"gaps_total": "Gaps in the data caused by lost connections.",
+	"queue_depth": "Samples waiting in a queue.",
+	"worker_up": "Workers that are running and reporting their health.",
+	"worker_restarts_total": "Restarts of the workers after a crash or a hang.",
+	"worker_heartbeat_age_seconds": "Time since the last health report of a worker.",
+	"headset_samples_total": "Samples pushed for each headset, as reported by its worker.",
+}
+
+# Channels of the diagnostics stream
+DIAGNOSTICS_CHANNELS = [
+	("samples", "Hz"),
+	("rawEeg", "Hz"),
+	("poorSignal", "Hz"),
+	("garbled", "Hz"),
+	("dropped", "Hz"),
+	("errors", "Hz"),
+	("readTime", "ms"),
+	("pushTime", "ms"),
+]
+
+
+def _format_labels(labels):
+	"""
+	Formats labels given as (name, value) pairs.
+	"""
+	if not labels:
+		return ""
+	return "{%s}" % ",".join(
+		'%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+		for name, value in labels
+	)
+
+
+def _format_value(value):
+	"""
+	Formats a value in the Prometheus text format.
+	"""
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_line(name, labels, value, suffix=""):
+	"""
+	Formats the line of a metric in the Prometheus text format.
+	:param str name: Name of the metric, without the prefix.
+	:param tuple labels: Labels as (name, value) pairs.
+	:param value: Value of the metric.
+	:param str suffix: Suffix of the name, e.g. `_bucket`.
+	"""
+	return "%s%s%s%s %s" % (
+		PREFIX, name, suffix, _format_labels(labels), _format_value(value)
+	)
+
+
+class Histogram(object):
+	"""
+	Counts observations in buckets. Each histogram is expected to be
+	updated by a single thread.
+	"""
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		"""
+		Initializes the Histogram.
+
+		:param list buckets: Sorted upper bounds of the buckets.
+		"""
+		self.buckets = list(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		"""
+		Adds an observation.
+		"""
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def since(self, start):
+		"""
+		Adds the time elapsed since `start`, a `time.perf_counter` value.
+		"""
+		self.observe(time.perf_counter() - start)
+
+
+class Metrics(object):
+	"""
+	Holds the metrics of one `MindwaveLSL` instance. Counters and
+	histograms are updated by the acquisition loop, while the values
+	kept by other objects (e.g. the number of garbled frames of the
+	decoder) are registered as functions read when rendering.
+	"""
+	def __init__(self, fields=EXPECTED_FIELDS, **labels):
+		"""
+		Initializes the Metrics.
+
+		:param list fields: Fields of the samples.
+		:param labels: Labels added to all the metrics, e.g. the name
+			of the stream.
+		"""
+		self.fields = fields
+		self.labels = tuple(sorted(labels.items()))
+		self.samples = 0
+		self.poor_signal = 0
+		self.field_counts = [0] * len(fields)
+		self.errors = collections.Counter()
+
+		self._histograms = collections.OrderedDict()
+		self._functions = []
+		self._lock = threading.Lock()
+
+	def histogram(self, name, **labels):
+		"""
+		Returns the histogram with the given name and labels,
+		creating it if needed.
+		"""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = Histogram()
+		return histogram
+
+	def register(self, name, func, kind="counter", **labels):
+		"""
+		Registers a function that returns the current value of a metric.
+		:param str name: Name of the metric.
+		:param callable func: Function returning the value.
+		:param str kind: Either `counter` or `gauge`.
+		"""
+		with self._lock:
+			self._functions.append((name, kind, tuple(sorted(labels.items())), func))
+
+	def count_sample(self, sample, poor_signal):
+		"""
+		Counts a sample and the values it holds.
+		:param list sample: Sample ordered like the fields.
+		:param bool poor_signal: True if the sample has a poor signal.
+		"""
+		self.samples += 1
+		if poor_signal:
+			self.poor_signal += 1
+		counts = self.field_counts
+		for ind, value in enumerate(sample):
+			# NaN is the only value that isn't equal to itself
+			if value == value:
+				counts[ind] += 1
+
+	def count_error(self, stage, error):
+		"""
+		Counts an error caught in a stage.
+		"""
+		self.errors[(stage, error.__class__.__name__)] += 1
+
+	def value(self, name):
+		"""
+		Returns the sum of the registered functions with this name.
+		"""
+		with self._lock:
+			functions = list(self._functions)
+		return sum(func() for fname, _, _, func in functions if fname == name)
+
+	def stage_totals(self, stage):
+		"""
+		Returns the total count and time of the histograms of a stage.
+		"""
+		count = 0
+		total = 0.0
+		with self._lock:
+			histograms = list(self._histograms.items())
+		for (name, labels), histogram in histograms:
+			if name == "stage_seconds" and dict(labels).get("stage") == stage:
+				count += histogram.count
+				total += histogram.sum
+		return count, total
+
+	def collect(self):
+		"""
+		Returns the metric families as a dict of name to (kind, lines).
+		"""
+		families = collections.OrderedDict()
+
+		def add(name, kind, labels, value, suffix=""):
+			family = families.setdefault(name, (kind, []))
+			family[1].append(format_line(name, self.labels + labels, value, suffix))
+
+		with self._lock:
+			histograms = list(self._histograms.items())
+			functions = list(self._functions)
+
+		for (name, labels), histogram in histograms:
+			cumulative = 0
+			for bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+				cumulative += count
+				add(name, "histogram", labels + (("le", _format_value(bound)),), cumulative, "_bucket")
+			add(name, "histogram", labels, histogram.sum, "_sum")
+			add(name, "histogram", labels, histogram.count, "_count")
+
+		add("samples_total", "counter", (), self.samples)
+		add("poor_signal_total", "counter", (), self.poor_signal)
+		for field, count in zip(self.fields, self.field_counts):
+			add("field_values_total", "counter", (("field", field),), count)
+		for (stage, error), count in list(self.errors.items()):
+			add("errors_total", "counter", (("stage", stage), ("type", error)), count)
+
+		for name, kind, labels, func in functions:
+			try:
+				value = func()
+			except Exception as e:
+				log.error("Unknow error occured while collecting %s", name)
+				log.error("%s - %s", e.__class__.__name__, e)
+				continue
+			add(name, kind, labels, value)
+
+		return families
+
+
+def render(metrics_list):
+	"""
+	Renders the metrics of multiple instances in the Prometheus text
+	format, with the lines of each family grouped together.
+	:param list metrics_list: `Metrics` of each instance.
+	"""
+	families = collections.OrderedDict()
+	for metrics in metrics_list:
+		for name, (kind, lines) in metrics.collect().items():
+			families.setdefault(name, (kind, []))[1].extend(lines)
+
+	output = []
+	for name, (kind, lines) in families.items():
+		output.append("# HELP %s%s %s" % (PREFIX, name, DESCRIPTIONS.get(name, name)))
+		output.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+		output.extend(lines)
+	return "\n".join(output) + "\n"
+
+
+class TimedOutlet(object):
+	"""
+	Wraps an outlet to time its `push_sample` and `push_chunk` calls.
+	"""
+	def __init__(self, outlet, histogram):
+		"""
+		Initializes the TimedOutlet.
+
+		:param object outlet: Outlet to wrap.
+		:param Histogram histogram: Histogram of the push times.
+		"""
+		self.outlet = outlet
+		self.histogram = histogram
+
+	def push_sample(self, sample, timestamp=0.0):
+		start = time.perf_counter()
+		self.outlet.push_sample(sample, timestamp)
+		self.histogram.since(start)
+
+	def push_chunk(self, samples, timestamps):
+		start = time.perf_counter()
+		self.outlet.push_chunk(samples, timestamps)
+		self.histogram.since(start)
+
+	def poll(self):
+		if hasattr(self.outlet, "poll"):
+			self.outlet.poll()
+
+	def flush(self):
+		if hasattr(self.outlet, "flush"):
+			self.outlet.flush()
+
+
+class MetricsServer(object):
+	"""
+	Serves the metrics in the Prometheus text format on `/metrics`.
+	"""
+	def __init__(self, metrics_list, host="localhost", port=9108):
+		"""
+		Initializes the MetricsServer.
+
+		:param list metrics_list: `Metrics` of each instance to serve.
+		:param str host: Host to listen on.
+		:param int port: Port to listen on, 0 picks a free port.
+		"""
+		self.metrics_list = metrics_list
+		self.host = host
+		self.port = port
+		self._server = None
+		self._thread = None
+
+	def start(self):
+		"""
+		Starts serving on a background thread and returns the port.
+		"""
+		import http.server
+
+		metrics_list = self.metrics_list
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_error(404)
+					return
+				body = render(metrics_list).encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				log.debug(format, *args)
+
+		self._server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+		self._server.daemon_threads = True
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+
+		log.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+		return self.port
+
+	def stop(self):
+		"""
+		Stops serving.
+		"""
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._thread.join(1)
+			self._server = None
+
+
+class DiagnosticsOutlet(object):
+	"""
+	Outlet that pushes a summary of the metrics to an LSL stream once
+	per second: the rate of samples, raw values, poor signal samples,
+	garbled frames, dropped samples, and errors, along with the mean
+	read and push times.
+	"""
+	def __init__(self, metrics, source_id, name="MindwaveDiagnostics", interval=1.0):
+		"""
+		Initializes the DiagnosticsOutlet.
+
+		:param Metrics metrics: Metrics to summarize.
+		:param str source_id: Source ID of the stream.
+		:param str name: Name of the stream.
+		:param float interval: Time, in seconds, between two summaries.
+		"""
+		self.metrics = metrics
+		self.source_id = source_id
+		self.name = name
+		self.interval = interval
+		self.outlet = None
+
+		self._raw_index = metrics.fields.index("rawEeg")
+		self._next = 0
+		self._last = None
+		self._last_time = 0
+
+	def setup_outlet(self):
+		"""
+		Sets up the diagnostics stream.
+		"""
+		stream_info = lsl.StreamInfo(
+			name=self.name,
+			type="Diagnostics",
+			channel_count=len(DIAGNOSTICS_CHANNELS),
+			nominal_srate=1.0 / self.interval,
+			channel_format=lsl.cf_double64,
+			source_id=self.source_id,
+		)
+		stream_info.desc().append_child_value("mindwavelsl-version", "1.0")
+		channels = stream_info.desc().append_child("channels")
+		for label, unit in DIAGNOSTICS_CHANNELS:
+			chan = channels.append_child("channel")
+			chan.append_child_value("label", label)
+			chan.append_child_value("type", "Diagnostics")
+			chan.append_child_value("unit", unit)
+
+		self.outlet = lsl.StreamOutlet(stream_info)
+		return self.outlet
+
+	def _totals(self):
+		"""
+		Returns the current totals that the summary is made of.
+		"""
+		metrics = self.metrics
+		return (
+			metrics.samples,
+			metrics.field_counts[self._raw_index],
+			metrics.poor_signal,
+			metrics.value("garbled_frames_total"),
+			metrics.value("dropped_samples_total"),
+			sum(metrics.errors.values()),
+		) + metrics.stage_totals("read") + metrics.stage_totals("push")
+
+	def push_sample(self, sample, timestamp=0.0):
+		self.poll()
+
+	def push_chunk(self, samples, timestamps):
+		self.poll()
+
+	def poll(self):
+		"""
+		Pushes a summary if the interval has passed.
+		"""
+		now = lsl.local_clock()
+		if now < self._next:
+			return
+		self._next = now + self.interval
+
+		totals = self._totals()
+		if self._last is not None:
+			elapsed = now - self._last_time
+			delta = [new - old for new, old in zip(totals, self._last)]
+			rates = [value / elapsed for value in delta[:6]]
+			read_count, read_time, push_count, push_time = delta[6:]
+			self.outlet.push_sample(rates + [
+				1000.0 * read_time / read_count if read_count else 0.0,
+				1000.0 * push_time / push_count if push_count else 0.0,
+			], now)
+
+		self._last = totals
+		self._last_time = now
@@ -6,14 +6,20 @@ import json
 import sys
 import time
 
+from mindwavelsl.constants import RAW_OUTPUT_CONFIG
 from mindwavelsl.parser import mwparser
-from mindwavelsl.logger import MindwaveLogger
-from mindwavelsl import MindwaveLSL
+from mindwavelsl.logger import MindwaveLogger, setup_logging
 
 log = MindwaveLogger('mindwave-main')
 
 def main():
 	args = mwparser().parse_args()
+	setup_logging(args.log_level)
+
+	# Imported here so that `--help` and argument errors don't wait
+	# for pylsl and numpy to load, the modules of the other modes are
+	# imported when they are used
+	from mindwavelsl.outlet import MindwaveLSL
 
 	log.info("Checking args...")
 	if args.mindwave_python_connect:
@@ -22,21 +28,99 @@ def main():
 				"--device is required when using `mindwave` to connect. "
 				"You might also need to use --headset-id."
 			)
+	if args.workers and not args.endpoints:
+		raise Exception("--endpoints is required when using --workers.")
+
+	# Settings shared by the outlets of every headset
+	outlet_settings = dict(
+		file_outlet_path=args.output,
+		run_lsl=args.no_lsl,
+		multi_stream=args.multi_stream,
+		chunk_size=args.chunk_size,
+		chunk_latency=args.chunk_latency / 1000.0,
+		file_format=args.format,
+		flush_interval=args.flush_interval,
+		fsync=args.fsync,
+		rotate_size=int(args.rotate_size * 1024 * 1024),
+		rotate_interval=args.rotate_interval * 60,
+		dejitter=args.dejitter,
+		band_power=args.band_power,
+		band_power_window=args.band_power_window,
+		band_power_hop=args.band_power_hop / 1000.0,
+		filter_raw=args.filter,
+		bandpass=args.bandpass,
+		notch=args.notch,
+		filter_output=args.filter_output,
+		decimate=args.decimate,
+		file_decimate=args.output_decimate,
+		quality=args.quality,
+		metrics=bool(args.metrics_port),
+		diagnostics=args.diagnostics,
+		reconnect=args.reconnect,
+		stale_timeout=args.stale_timeout
+	)
+	if args.bands:
+		outlet_settings["bands"] = args.bands
+
+	if args.metrics_port:
+		from mindwavelsl.metrics import MetricsServer
+
+	if args.workers:
+		from mindwavelsl.supervisor import ShardSupervisor
+
+		supervisor = ShardSupervisor(args.endpoints, args.workers, **outlet_settings)
+		if args.metrics_port:
+			MetricsServer(
+				supervisor.metrics_list(),
+				args.metrics_host,
+				args.metrics_port
+			).start()
+
+		log.info(
+			"Running %s endpoints in %s workers...",
+			len(args.endpoints), len(supervisor.workers)
+		)
+		supervisor.run()
+		return
+
+	if args.endpoints:
+		from mindwavelsl.runner import MultiHeadsetRunner
+
+		runner = MultiHeadsetRunner(args.endpoints, **outlet_settings)
+
+		log.info("Setting up...")
+		runner.setup()
+		if args.metrics_port:
+			MetricsServer(
+				[mwlsl.metrics for mwlsl, _ in runner.headsets],
+				args.metrics_host,
+				args.metrics_port
+			).start()
+
+		log.info("Running %s endpoints...", len(args.endpoints))
+		runner.run()
+		return
 
 	mwlsl = MindwaveLSL(
 		args.host,
 		args.port,
-		file_outlet_path=args.output,
-		run_lsl=args.no_lsl,
 		mindwave_python_connect=args.mindwave_python_connect,
 		device=args.device,
 		headset_id=args.headset_id,
-		open_serial=args.no_open_serial
+		open_serial=args.no_open_serial,
+		threaded=args.threaded,
+		buffer_size=args.buffer_size,
+		overflow=args.overflow,
+		replay_path=args.replay,
+		replay_speed=args.replay_speed,
+		**outlet_settings
 	)
 
 	log.info("Setting up...")
 	mwlsl.setup()
-	mwlsl.write('{"enableRawOutput": true, "format": "Json"}')
+	mwlsl.write(RAW_OUTPUT_CONFIG)
+	if args.metrics_port:
+		MetricsServer([mwlsl.metrics], args.metrics_host, args.metrics_port).start()
 
 	log.info("Running...")
 	mwlsl.run()
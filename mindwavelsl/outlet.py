@@ -1,20 +1,55 @@
 import collections
 import json
+import logging
 import numpy as np
 import os
 import pylsl as lsl
+import queue
+import threading
+import time
 import uuid
 
-from mindwavelsl.connectors import TelnetConnector, MindwavePythonWrapper
+from mindwavelsl.binary import BinaryFileOutlet
+from mindwavelsl.compression import INDEX_HEADER, Codec, index_path, split_codec
+from mindwavelsl.connectors import (
+	EndOfStream,
+	MindwavePythonWrapper,
+	ReconnectingConnector,
+	ReplayConnector,
+	TelnetConnector
+)
 from mindwavelsl.constants import (
 	EXPECTED_FIELDS,
 	MINDWAVE_PYTHON_ORIG,
-	MINDWAVE_PYTHON_FORK
+	MINDWAVE_PYTHON_FORK,
+	RAW_SRATE,
+	STREAM_GROUPS,
+	channel_label
 )
+from mindwavelsl.decoder import SampleBuilder
 from mindwavelsl.logger import MindwaveLogger
+from mindwavelsl.metrics import DiagnosticsOutlet, Metrics, TimedOutlet
+from mindwavelsl.pipeline import Pipeline
+from mindwavelsl.stages import (
+	BandPowerStage,
+	DecimateStage,
+	DEFAULT_BANDS,
+	FILTER_BATCH_SIZE,
+	FILTER_PAIR,
+	FILTER_REPLACE,
+	FilterStage,
+	QualityStage,
+	design_filter,
+	make_stream_outlet
+)
+from mindwavelsl.timing import Dejitter
+from mindwavelsl.xdf import XdfFileOutlet
 
 log = MindwaveLogger("mindwave-outlet")
 
+POOR_SIGNAL_INDEX = EXPECTED_FIELDS.index("poorSignalLevel")
+RAW_INDEX = EXPECTED_FIELDS.index("rawEeg")
+
 
 class MindwaveLSL(object):
 	"""
@@ -31,7 +66,38 @@ class MindwaveLSL(object):
 			mindwave_python_connect=False,
 			device='',
 			headset_id='',
-			open_serial=True
+			open_serial=True,
+			multi_stream=False,
+			chunk_size=0,
+			chunk_latency=0.05,
+			stream_name="Mindwave",
+			threaded=False,
+			buffer_size=8192,
+			overflow="block",
+			file_format='',
+			flush_interval=1.0,
+			fsync=False,
+			rotate_size=0,
+			rotate_interval=0,
+			dejitter=False,
+			replay_path='',
+			replay_speed=1.0,
+			band_power=False,
+			band_power_window=1.0,
+			band_power_hop=0.1,
+			bands=DEFAULT_BANDS,
+			filter_raw=False,
+			bandpass=(1.0, 40.0),
+			notch=60.0,
+			filter_output=FILTER_PAIR,
+			decimate=0,
+			file_decimate=0,
+			quality=False,
+			metrics=False,
+			diagnostics=False,
+			reconnect=True,
+			stale_timeout=5.0,
+			source_id=''
 		):
 		"""
 		Initializes the MindwaveLSL outlet.
@@ -43,19 +109,131 @@ class MindwaveLSL(object):
 			saved.
 		:param bool run_lsl: If set to False, LSL outlet
 			won't be created during the setup step.
+		:param bool multi_stream: If set to True, the fields are split
+			into one LSL stream per rate group (see
+			`constants.STREAM_GROUPS`) instead of a single stream.
+		:param int chunk_size: If larger than 1, raw samples are
+			gathered and pushed to LSL in chunks of this size.
+		:param float chunk_latency: Maximum time, in seconds, that a
+			sample can wait in a chunk before it gets pushed.
+		:param str stream_name: Name of the LSL stream, or the prefix
+			of the stream names in multi-stream mode.
+		:param bool threaded: If set to True, `run` reads from the
+			connection on one thread and pushes to the outlets on others.
+		:param int buffer_size: Number of samples each outlet can fall
+			behind by in threaded mode.
+		:param str overflow: What to do when an outlet falls too far
+			behind in threaded mode (see `pipeline.OVERFLOW_POLICIES`).
+		:param str file_format: Format of the file output, either `csv`,
+			`npy`, or `xdf`. By default, it's based on the extension of the
+			file output path, and CSV is used for directories.
+		:param float flush_interval: Maximum time, in seconds, between
+			two writes to the CSV or XDF file.
+		:param bool fsync: If set to True, the CSV file is synced to
+			the disk after each write.
+		:param int rotate_size: If set, a new CSV file is started once
+			the current one is larger than this many bytes.
+		:param float rotate_interval: If set, a new CSV file is started
+			once the current one is older than this many seconds.
+		:param bool dejitter: If set to True, the timestamps of the raw
+			samples are smoothed with a running linear regression at
+			the nominal 512Hz rate.
+		:param str replay_path: If set, the data is replayed from this
+			recording instead of being read from a headset.
+		:param float replay_speed: Replay speed relative to real time,
+			0 replays as fast as possible.
+		:param bool band_power: If set to True, the power of the `bands`
+			in the raw data is pushed to an extra LSL stream.
+		:param float band_power_window: Length, in seconds, of the
+			window used to compute the band power.
+		:param float band_power_hop: Time, in seconds, between two
+			band power updates.
+		:param list bands: (name, low, high) of each band in Hz.
+		:param bool filter_raw: If set to True, the raw data is filtered
+			with the `bandpass` and `notch` filters.
+		:param tuple bandpass: Low and high cutoffs, in Hz, of the
+			bandpass filter. Either can be 0 to disable it.
+		:param float notch: Frequency, in Hz, of the notch filter, 0
+			to disable it.
+		:param str filter_output: Either `pair` to push the filtered data
+			to an extra LSL stream, or `filtered` to push it in place of
+			the raw data in the LSL stream. Files always get the raw data.
+		:param int decimate: If set, the raw data is decimated by this
+			factor and pushed to an extra LSL stream.
+		:param int file_decimate: If set, the raw data written to the
+			file output is decimated by this factor.
+		:param bool quality: If set to True, the artifacts in the raw
+			data are pushed to a marker stream, and a quality score to
+			an extra LSL stream once per second. The `notch` frequency
+			is used as the power line frequency.
+		:param bool metrics: If set to True, the time spent in each stage
+			and the counts of samples, values, and errors are kept in
+			`metrics` (see `metrics.Metrics`).
+		:param bool diagnostics: If set to True, a summary of the metrics
+			is pushed to an extra LSL stream once per second.
+		:param bool reconnect: If set to True, the connection to the
+			headset is restored when it fails, and the gaps in the data
+			are marked in an LSL marker stream. The outlets stay open.
+		:param float stale_timeout: Time, in seconds, without data
+			after which the connection is considered lost.
+		:param str source_id: Source ID of the LSL streams, a random one
+			is used if not set. LSL inlets resume a stream that comes
+			back with the same source ID, e.g. after a restart.
 		"""
 		self.host = host
 		self.port = port
 		self.outlet = None
 		self.file_outlet = None
+		self.marker_outlet = None
 		self.outlets = []
+		self.reconnect = reconnect
+		self.gaps = 0
 
 		# Standard settings
-		self._outlet_uuid = str(uuid.uuid4())
+		self._outlet_uuid = source_id or str(uuid.uuid4())
 		self._channels = []
+		self._builder = SampleBuilder(EXPECTED_FIELDS)
 		self._access_point = None
 		self._file_outlet_path = file_outlet_path
 		self._run_lsl = run_lsl
+		self._multi_stream = multi_stream
+		self._chunk_size = chunk_size
+		self._chunk_latency = chunk_latency
+		self._stream_name = stream_name
+		self._threaded = threaded
+		self._buffer_size = buffer_size
+		self._overflow = overflow
+		self._file_format = file_format
+		self._flush_interval = flush_interval
+		self._fsync = fsync
+		self._rotate_size = rotate_size
+		self._rotate_interval = rotate_interval
+		self._dejitter = Dejitter(RAW_SRATE) if dejitter else None
+		self._replay_path = replay_path
+		self._replay_speed = replay_speed
+		self._band_power = band_power
+		self._band_power_window = band_power_window
+		self._band_power_hop = band_power_hop
+		self._bands = bands
+		self._filter_raw = filter_raw
+		self._bandpass = bandpass
+		self._notch = notch
+		self._filter_output = filter_output
+		self._decimate = decimate
+		self._file_decimate = file_decimate
+		self._quality = quality
+		self._diagnostics = diagnostics
+		self.stale_timeout = stale_timeout
+		self._running = False
+
+		# Metrics, the timers are None when they are disabled
+		self.metrics = None
+		self._read_time = None
+		self._sample_time = None
+		if metrics or diagnostics:
+			self.metrics = Metrics(stream=stream_name)
+			self._read_time = self.metrics.histogram("stage_seconds", stage="read")
+			self._sample_time = self.metrics.histogram("stage_seconds", stage="make_sample")
 
 		# Mindwave-python settings
 		self._mindwave_python_connect = mindwave_python_connect
@@ -88,24 +266,14 @@ class MindwaveLSL(object):
 		if self.started():
 			return self._access_point
 
-		# Prepare outlet
-		log.info("Creating outlet and channels...")
-		self._setup_channels()
-		log.debug("Creating outlets...")
-
-		if self._run_lsl:
-			self._setup_lsl_outlet()
-		if self._file_outlet_path:
-			self._setup_file_outlet()
-
-		if not self.outlets:
-			raise Exception(
-				"Cannot run since no outlet was created.")
-		else:
-			log.info("Mindwave outlets created")
+		self.setup_outlets()
 
 		# Setup the Mindwave connector
-		if self._mindwave_python_connect:
+		if self._replay_path:
+			self._access_point = ReplayConnector(
+				self._replay_path, self._replay_speed
+			)
+		elif self._mindwave_python_connect:
 			try:
 				import mindwavelsl.vendor.mindwave as mindwave
 			except:
@@ -119,12 +287,140 @@ class MindwaveLSL(object):
 				self._device, self._headset_id, self._open_serial
 			)
 		else:
-			self._access_point = TelnetConnector(self.host, self.port)
+			self._access_point = TelnetConnector(
+				self.host,
+				self.port,
+				timeout=self.stale_timeout if self.reconnect else None
+			)
 
+		if self.reconnect and not self._replay_path:
+			self._access_point = ReconnectingConnector(
+				self._access_point,
+				stale_timeout=self.stale_timeout,
+				on_gap=self.mark_gap
+			)
+
+		if self.metrics is not None:
+			self.instrument(self._access_point)
 		self._access_point.setup()
 
 		return self._access_point
 
+	def setup_outlets(self):
+		"""
+		Prepares the outlets for the data without connecting to
+		the headset.
+		"""
+		if self._channels:
+			return self.outlets
+
+		log.info("Creating outlet and channels...")
+		self._setup_channels()
+		log.debug("Creating outlets...")
+
+		added = len(self.outlets)
+		if self._run_lsl:
+			self._setup_lsl_outlet()
+			self._setup_stages()
+		if self._file_outlet_path:
+			self._setup_file_outlet()
+		self.outlets[added:] = [
+			self._timed(outlet, ind)
+			for ind, outlet in enumerate(self.outlets[added:], added)
+		]
+
+		if self._run_lsl and self.reconnect:
+			self.marker_outlet = make_stream_outlet(
+				self._stream_name + "Markers",
+				"Markers",
+				["event"],
+				"",
+				lsl.IRREGULAR_RATE,
+				self._outlet_uuid + "-markers",
+				fmt=lsl.cf_string
+			)
+
+		if self._run_lsl and self._diagnostics:
+			diagnostics = DiagnosticsOutlet(
+				self.metrics,
+				self._outlet_uuid + "-diagnostics",
+				name=self._stream_name + "Diagnostics"
+			)
+			diagnostics.setup_outlet()
+			self.outlets.append(diagnostics)
+
+		if not self.outlets:
+			raise Exception(
+				"Cannot run since no outlet was created.")
+		else:
+			log.info("Mindwave outlets created")
+
+		return self.outlets
+
+	def add_outlet(self, outlet):
+		"""
+		Adds an outlet that receives all the samples, along with
+		the ones created during the setup.
+		:param object outlet: Object with `push_sample(sample, timestamp)`
+			and `push_chunk(samples, timestamps)` methods.
+		"""
+		self.outlets.append(self._timed(outlet))
+		return outlet
+
+	def _timed(self, outlet, index=None):
+		"""
+		Wraps an outlet to time its pushes when metrics are enabled.
+		:param object outlet: Outlet to wrap.
+		:param int index: Index of the outlet in `outlets`, by default
+			the outlet is expected to be added at the end.
+		"""
+		if self.metrics is None:
+			return outlet
+		return TimedOutlet(outlet, self.metrics.histogram(
+			"stage_seconds",
+			stage="push",
+			outlet=type(outlet).__name__,
+			index=len(self.outlets) if index is None else index
+		))
+
+	def instrument(self, connector):
+		"""
+		Registers the counters kept by a connector, and times the
+		decoding of its data.
+		:param object connector: Connector of this instance.
+		"""
+		metrics = self.metrics
+		decoder = getattr(connector, "decoder", None)
+		if decoder is not None:
+			decoder.decode_time = metrics.histogram("stage_seconds", stage="decode")
+			metrics.register("garbled_frames_total", lambda: decoder.garbled)
+		if hasattr(connector, "dropped"):
+			metrics.register(
+				"dropped_samples_total", lambda: connector.dropped, source="connector"
+			)
+		metrics.register(
+			"unknown_keys_total", lambda: sum(self.unknown_keys.values())
+		)
+		if self._dejitter is not None:
+			metrics.register("dejitter_resets_total", lambda: self._dejitter.resets)
+		if hasattr(connector, "reconnects"):
+			metrics.register("reconnects_total", lambda: connector.reconnects)
+		metrics.register("gaps_total", lambda: self.gaps)
+
+	def mark_gap(self, start, end):
+		"""
+		Records a gap in the data, caused by a lost connection, with a
+		marker at the time of the last sample before the gap.
+		:param float start: Time of the last sample before the gap.
+		:param float end: Time of the first sample after the gap.
+		"""
+		self.gaps += 1
+		log.warning("Gap of %.3fs in the data", end - start)
+		if self.marker_outlet is not None:
+			self.marker_outlet.push_sample(
+				[json.dumps({"event": "gap", "duration": end - start})], start
+			)
+
 	def _setup_channels(self):
 		"""
 		Sets up all the channels that will be recorded.
@@ -141,8 +437,21 @@ class MindwaveLSL(object):
 		"""
 		Sets up the LSL output for the telnet data.
 		"""
+		if self._multi_stream:
+			self.outlet = MultiStreamOutlet(
+				self._channels,
+				self._outlet_uuid,
+				name=self._stream_name,
+				chunk_size=self._chunk_size,
+				chunk_latency=self._chunk_latency
+			)
+			self.outlet.setup_outlet()
+
+			self.outlets.append(self.outlet)
+			return self.outlet
+
 		stream_info = lsl.StreamInfo(
-			name="Mindwave",
+			name=self._stream_name,
 			type="Gaze",
 			channel_count=len(self._channels),
 			channel_format=lsl.cf_double64,
@@ -154,21 +463,124 @@ class MindwaveLSL(object):
 			chan.append_to(xml_channels)
 
 		self.outlet = lsl.StreamOutlet(stream_info)
+		if self._chunk_size > 1:
+			self.outlet = ChunkedOutlet(
+				self.outlet,
+				len(self._channels),
+				self._chunk_size,
+				self._chunk_latency
+			)
 
 		self.outlets.append(self.outlet)
 		return self.outlet
 
+	def _setup_stages(self):
+		"""
+		Sets up the stages that process the raw data and push
+		their results to extra LSL streams.
+		"""
+		stages = []
+		if self._filter_raw:
+			sos = design_filter(
+				RAW_SRATE, self._bandpass[0], self._bandpass[1], self._notch
+			)
+			if self._filter_output == FILTER_REPLACE:
+				# The filtered samples go to the LSL outlet instead of the raw ones
+				self.outlets.remove(self.outlet)
+				stage = FilterStage(sos, outlet=self.outlet)
+			else:
+				stage = FilterStage(
+					sos,
+					self._outlet_uuid + "-filtered",
+					name=self._stream_name + "Filtered"
+				)
+			stage.setup_outlet()
+			stages.append(self._batched(stage))
+
+		if self._decimate:
+			stage = DecimateStage(
+				self._decimate,
+				self._outlet_uuid + "-decimated",
+				name=self._stream_name + "Decimated"
+			)
+			stage.setup_outlet()
+			stages.append(self._batched(stage))
+
+		if self._band_power:
+			stage = BandPowerStage(
+				self._outlet_uuid + "-bandpower",
+				name=self._stream_name + "BandPower",
+				bands=self._bands,
+				window=self._band_power_window,
+				hop=self._band_power_hop
+			)
+			stage.setup_outlet()
+			stages.append(stage)
+
+		if self._quality:
+			stage = QualityStage(
+				self._outlet_uuid + "-quality",
+				name=self._stream_name + "Quality",
+				line_freq=self._notch
+			)
+			stage.setup_outlet()
+			stages.append(self._batched(stage))
+
+		self.outlets.extend(stages)
+		return stages
+
+	def _batched(self, stage):
+		"""
+		Wraps a stage so that it runs on chunks, even when the
+		samples are pushed one at a time.
+		"""
+		return ChunkedOutlet(
+			stage,
+			len(self._channels),
+			max(self._chunk_size, FILTER_BATCH_SIZE),
+			self._chunk_latency
+		)
 
 	def _setup_file_outlet(self):
 		"""
-		Sets up the LSL output for the telnet data.
+		Sets up the file output for the telnet data.
 		"""
-		self.file_outlet = FileOutlet(self._file_outlet_path)
+		file_format = self._file_format
+		if not file_format:
+			file_format = os.path.splitext(self._file_outlet_path)[1][1:]
+
+		if file_format == 'npy':
+			self.file_outlet = BinaryFileOutlet(
+				self._file_outlet_path,
+				flush_interval=self._flush_interval
+			)
+			self.file_outlet.set_channels(self._channels)
+		elif file_format == 'xdf':
+			self.file_outlet = XdfFileOutlet(
+				self._file_outlet_path,
+				self._outlet_uuid,
+				name=self._stream_name,
+				flush_interval=self._flush_interval
+			)
+			self.file_outlet.set_channels(self._channels)
+		else:
+			self.file_outlet = FileOutlet(
+				self._file_outlet_path,
+				flush_interval=self._flush_interval,
+				fsync=self._fsync,
+				rotate_size=self._rotate_size,
+				rotate_interval=self._rotate_interval
+			)
 
 		self.file_outlet.set_header(EXPECTED_FIELDS)
 		self.file_outlet.setup_outlet()
 
-		self.outlets.append(self.file_outlet)
+		if self._file_decimate:
+			self.outlets.append(self._batched(
+				DecimateStage(self._file_decimate, outlet=self.file_outlet)
+			))
+		else:
+			self.outlets.append(self.file_outlet)
 		return self.file_outlet
 
 	def write(self, data):
@@ -184,10 +596,10 @@ class MindwaveLSL(object):
 		except Exception as e:
 			log.error(
 				"Unknow error occured while WRITING this response: "
-				"%s" % data
+				"%s", data
 			)
 			log.error(
-				"%s - %s" % (e.__class__.__name__, e)
+				"%s - %s", e.__class__.__name__, e
 			)
 
 	def read(self, read_until="\r"):
@@ -200,74 +612,201 @@ class MindwaveLSL(object):
 
 		response = None
 		try:
-			response = self._access_point.read()
-		except KeyboardInterrupt as e:
+			if self._read_time is None:
+				response = self._access_point.read()
+			else:
+				start = time.perf_counter()
+				response = self._access_point.read()
+				self._read_time.since(start)
+		except (KeyboardInterrupt, EndOfStream) as e:
 			raise e
 		except Exception as e:
+			if self.metrics is not None:
+				self.metrics.count_error("read", e)
 			log.error("Unknow error occured while READING")
 			log.error(
-				"%s - %s" % (e.__class__.__name__, e)
+				"%s - %s", e.__class__.__name__, e
 			)
 
 		return response
 
+	def read_timestamp(self):
+		"""
+		Returns the time at which the last read sample was acquired.
+		Connectors that track it store it in their `timestamp` attribute,
+		otherwise the current time is used.
+		"""
+		timestamp = getattr(self._access_point, "timestamp", None)
+		if timestamp is None:
+			timestamp = lsl.local_clock()
+		return timestamp
+
+	def correct_timestamp(self, sample, timestamp):
+		"""
+		Returns the timestamp to push a sample with. When de-jittering,
+		the timestamps of the raw samples are smoothed.
+		:param list sample: Sample built with `make_sample`.
+		:param float timestamp: Time at which the sample was acquired.
+		"""
+		if self._dejitter is not None:
+			raw = sample[RAW_INDEX]
+			# NaN is the only value that isn't equal to itself
+			if raw == raw:
+				return self._dejitter.update(timestamp)
+		return timestamp
+
 	def make_sample(self, response):
 		"""
 		Builds up a sample using the channels as a
 		reference for what fields we should look for.
+		The keys of the response that aren't channels
+		are counted in `unknown_keys`.
 		"""
+		if self._sample_time is not None:
+			start = time.perf_counter()
+
 		if type(response) == list:
-			# If the response is a list, then return it
-			# immediately because it's already in sample form.
-			return response
+			# If the response is a list, then it's
+			# already in sample form.
+			sample = response
+		else:
+			sample = self._builder.empty[:]
+			self._builder.fill(response, sample)
 
-		sample = []
-		for chan in self._channels:
-			sample.append(response.get(chan.metric, np.nan))
-		if response.get("poorSignalLevel", 0) == 200:
-			log.warning("Poor signal quality, check headset fitting...")
+		poor_signal = sample[POOR_SIGNAL_INDEX] == 200
+		if poor_signal:
+			log.limited(logging.WARNING, "Poor signal quality, check headset fitting...")
 		else:
-			log.debug(sample)
+			log.debug("%s", sample)
 
+		if self._sample_time is not None:
+			self.metrics.count_sample(sample, poor_signal)
+			self._sample_time.since(start)
 		return sample
 
+	@property
+	def unknown_keys(self):
+		"""
+		Number of times each unknown key was found in the responses.
+		"""
+		unknown = collections.Counter(self._builder.unknown)
+		decoder = getattr(self._access_point, "decoder", None)
+		if decoder is not None:
+			unknown.update(decoder.builder.unknown)
+		return unknown
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Pushes a sample to all the outlets.
+		:param list sample: Sample built with `make_sample`.
+		:param float timestamp: Time at which the sample was read.
+		"""
+		for outlet in self.outlets:
+			outlet.push_sample(sample, timestamp)
+
+	def poll(self):
+		"""
+		Gives the outlets that gather samples a chance to push
+		them if they have been waiting for too long.
+		"""
+		for outlet in self.outlets:
+			if hasattr(outlet, "poll"):
+				outlet.poll()
+
+	def flush(self):
+		"""
+		Pushes all the samples that are still waiting in the outlets.
+		"""
+		for outlet in self.outlets:
+			if hasattr(outlet, "flush"):
+				outlet.flush()
+
 	def run(self):
 		"""
-		Starts two threads here. 
+		Reads from the connection and pushes the samples to the
+		outlets until interrupted. In threaded mode, the reading and
+		the pushing happen on separate threads.
 		"""
-		# 2 threads, one manager, one pusher
-		while True:
+		self._running = True
+		try:
+			if self._threaded:
+				Pipeline(
+					self,
+					capacity=self._buffer_size,
+					overflow=self._overflow
+				).run()
+				return
+
+			self._run()
+		finally:
+			self._running = False
+			self.close()
+			log.summarize()
+
+	def _run(self):
+		"""
+		Reads and pushes the samples on the current thread.
+		"""
+		while self._running:
 			try:
 				response = self.read()
+				timestamp = self.read_timestamp()
 				if not response:
+					self.poll()
 					continue
 
 				sample = self.make_sample(response)
-
-				for outlet in self.outlets:
-					outlet.push_sample(sample)
+				self.push_sample(sample, self.correct_timestamp(sample, timestamp))
+			except EndOfStream as e:
+				log.info(str(e))
+				break
 			except KeyboardInterrupt as e:
+				self.flush()
 				raise e	
 			except Exception as e:
+				if self.metrics is not None:
+					self.metrics.count_error("run", e)
 				log.error("Unknow error occured while running")
 				log.error(
-					"%s - %s" % (e.__class__.__name__, e)
+					"%s - %s", e.__class__.__name__, e
 				)	
 
+		self.flush()
+
+	def close(self):
+		"""
+		Pushes the remaining samples, and closes the file output
+		so that its footer gets written.
+		"""
+		self.flush()
+		if hasattr(self.file_outlet, "close"):
+			self.file_outlet.close()
+
+	def stop(self):
+		"""
+		Stops `run` after the sample it's currently reading.
+		"""
+		self._running = False
+		if hasattr(self._access_point, "stop"):
+			self._access_point.stop()
+
+	def running(self):
+		"""
+		Returns true while `run` is running.
+		"""
+		return self._running
+
 class _Channel(object):
 	"""
 	Container class for each channel to simplify setup,
 	data parsing, and generation.
 	"""
 	def __init__(self, metric, metatype, unit):
-		self.label = "Fp1"
+		self.label = channel_label(metric)
 		self.metric = metric
 		self.metatype = metatype
 		self.unit = unit
 
-		if metric != "rawEeg":
-			self.label = "Fp1-%s" % metric
-
 	def append_to(self, channels):
 		chan = channels.append_child("channel")
 		chan.append_child_value("label", self.label)
@@ -275,20 +814,259 @@ class _Channel(object):
 		chan.append_child_value("unit", self.unit)
 
 
+class MultiStreamOutlet(object):
+	"""
+	Used to split the samples into multiple LSL streams, one per
+	group in `constants.STREAM_GROUPS`. A sample is only pushed to the
+	streams whose fields were present in the packet it came from, so the
+	512Hz raw data isn't padded with the low-rate fields.
+	"""
+	def __init__(
+			self,
+			channels,
+			source_id,
+			name="Mindwave",
+			chunk_size=0,
+			chunk_latency=0.05
+		):
+		"""
+		Initialize the MultiStreamOutlet.
+
+		:param list channels: The `_Channel` objects for each field
+			of a full sample.
+		:param str source_id: Prefix for the source ID of the streams.
+		:param str name: Prefix for the name of the streams.
+		:param int chunk_size: If larger than 1, the samples of the
+			raw streams are pushed in chunks of this size.
+		:param float chunk_latency: Maximum time, in seconds, that a
+			raw sample can wait in a chunk before it gets pushed.
+		"""
+		self.name = name
+		self.source_id = source_id
+		self.streams = []
+		self._channels = channels
+		self._chunk_size = chunk_size
+		self._chunk_latency = chunk_latency
+
+	def setup_outlet(self):
+		"""
+		Creates an LSL outlet for each group of fields.
+		"""
+		metrics = [chan.metric for chan in self._channels]
+		for suffix, stype, srate, fields in STREAM_GROUPS:
+			indices = [metrics.index(field) for field in fields]
+
+			stream_info = lsl.StreamInfo(
+				name=self.name + suffix,
+				type=stype,
+				channel_count=len(indices),
+				nominal_srate=srate,
+				channel_format=lsl.cf_double64,
+				source_id="%s-%s" % (self.source_id, suffix),
+			)
+			stream_info.desc().append_child_value("mindwavelsl-version", "1.0")
+			xml_channels = stream_info.desc().append_child("channels")
+			for ind in indices:
+				self._channels[ind].append_to(xml_channels)
+
+			outlet = lsl.StreamOutlet(stream_info)
+			if srate == RAW_SRATE and self._chunk_size > 1:
+				outlet = ChunkedOutlet(
+					outlet, len(indices), self._chunk_size, self._chunk_latency
+				)
+
+			self.streams.append((indices, outlet))
+
+		return self.streams
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Push the fields of a sample to the streams they belong to.
+		:param list sample: Data sample ordered like `EXPECTED_FIELDS`.
+		:param float timestamp: Timestamp of the sample, 0 to let
+			LSL stamp it.
+		"""
+		for indices, outlet in self.streams:
+			values = [sample[ind] for ind in indices]
+
+			# NaN is the only value that isn't equal to itself
+			if all(val != val for val in values):
+				continue
+			outlet.push_sample(values, timestamp)
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Push the fields of a chunk of samples to the streams they belong
+		to. Samples without any of the fields of a stream are skipped.
+		:param np.ndarray samples: Samples ordered like `EXPECTED_FIELDS`.
+		:param list timestamps: Timestamp of each sample.
+		"""
+		samples = np.asarray(samples, dtype=np.float64)
+		timestamps = np.asarray(timestamps, dtype=np.float64)
+		for indices, outlet in self.streams:
+			values = samples[:, indices]
+			present = ~np.isnan(values).all(axis=1)
+			if not present.any():
+				continue
+			outlet.push_chunk(values[present], timestamps[present].tolist())
+
+	def poll(self):
+		"""
+		Pushes the chunks of the raw streams that are past their deadline.
+		"""
+		for _, outlet in self.streams:
+			if hasattr(outlet, "poll"):
+				outlet.poll()
+
+	def flush(self):
+		"""
+		Pushes the samples that are waiting in the raw stream chunks.
+		"""
+		for _, outlet in self.streams:
+			if hasattr(outlet, "flush"):
+				outlet.flush()
+
+
+class ChunkedOutlet(object):
+	"""
+	Wraps an LSL outlet to gather samples in a preallocated buffer
+	and push them with `push_chunk` once the buffer is full, or once
+	the oldest sample has waited for longer than the latency allows.
+	"""
+	def __init__(self, outlet, channel_count, chunk_size, chunk_latency=0.05):
+		"""
+		Initialize the ChunkedOutlet.
+
+		:param lsl.StreamOutlet outlet: Outlet to push the chunks to.
+		:param int channel_count: Number of channels in a sample.
+		:param int chunk_size: Number of samples in a full chunk.
+		:param float chunk_latency: Maximum time, in seconds, that a
+			sample can wait before the chunk gets pushed.
+		"""
+		self.outlet = outlet
+		self.chunk_size = chunk_size
+		self.chunk_latency = chunk_latency
+
+		self._samples = np.empty((chunk_size, channel_count), dtype=np.float64)
+		self._timestamps = np.empty(chunk_size, dtype=np.float64)
+		self._count = 0
+		self._deadline = 0
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Adds a sample to the current chunk.
+		:param list sample: Data sample to push.
+		:param float timestamp: Time at which the sample was read.
+		"""
+		now = lsl.local_clock()
+		if not timestamp:
+			timestamp = now
+		if not self._count:
+			self._deadline = now + self.chunk_latency
+
+		self._samples[self._count] = sample
+		self._timestamps[self._count] = timestamp
+		self._count += 1
+
+		if self._count >= self.chunk_size or now >= self._deadline:
+			self._push()
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Pushes a chunk of samples after the samples already waiting.
+		:param np.ndarray samples: Samples to push.
+		:param list timestamps: Timestamp of each sample.
+		"""
+		self._push()
+		self.outlet.push_chunk(samples, list(timestamps))
+
+	def _push(self):
+		"""
+		Pushes the current chunk, with a timestamp for each sample.
+		"""
+		if not self._count:
+			return
+		self.outlet.push_chunk(
+			self._samples[:self._count],
+			self._timestamps[:self._count].tolist()
+		)
+		self._count = 0
+
+	def poll(self):
+		"""
+		Pushes the current chunk if its deadline has passed.
+		"""
+		if self._count and lsl.local_clock() >= self._deadline:
+			self._push()
+		if hasattr(self.outlet, "poll"):
+			self.outlet.poll()
+
+	def flush(self):
+		"""
+		Pushes the current chunk, and flushes the wrapped outlet.
+		"""
+		self._push()
+		if hasattr(self.outlet, "flush"):
+			self.outlet.flush()
+
+
 class FileOutlet(object):
 	"""
-	Used to output gathered data to a file.
+	Used to output gathered data to a CSV file. Samples are gathered in
+	memory and written in batches, and the file can be rotated once it
+	gets too large or too old.
+
+	When the file name ends with the extension of a codec in
+	`compression.CODECS` (e.g. `data.csv.zst`), each batch is
+	formatted and compressed as an independent frame by a background
+	thread, and the frames are listed in an index next to the file.
 	"""
-	def __init__(self, path):
+	def __init__(
+			self,
+			path,
+			flush_size=4096,
+			flush_interval=1.0,
+			fsync=False,
+			rotate_size=0,
+			rotate_interval=0
+		):
 		"""
 		Initialize the FileOutlet.
 
 		:param str path: Path to the output location.
+		:param int flush_size: Number of samples gathered before
+			they are written to the file.
+		:param float flush_interval: Maximum time, in seconds, between
+			two writes to the file.
+		:param bool fsync: If set to True, the file is synced to the
+			disk after each write.
+		:param int rotate_size: If set, a new file is started once the
+			current one is larger than this many bytes.
+		:param float rotate_interval: If set, a new file is started once
+			the current one is older than this many seconds.
 		"""
 		self.path = path
 		self.file = 'mindwave-output.csv'
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.fsync = fsync
+		self.rotate_size = rotate_size
+		self.rotate_interval = rotate_interval
+
+		self.codec = None
+
 		self._header = []
 		self._filehandler = None
+		self._index = None
+		self._rows = None
+		self._row_format = ''
+		self._count = 0
+		self._last_flush = 0
+		self._opened_at = 0
+		self._file_index = 0
+
+		self._frames = None
+		self._compressor = None
 
 	def _sample_to_csv(self, sample):
 		"""
@@ -301,11 +1079,71 @@ class FileOutlet(object):
 		"""
 		Makes the output directory.
 		"""
-		if self.path.endswith('.csv'):
+		if split_codec(self.path)[0].endswith('.csv'):
 			path, file = os.path.split(self.path)
 			self.path = path
 			self.file = file
-		os.makedirs(self.path, exist_ok=True)
+		os.makedirs(self.path or '.', exist_ok=True)
+
+	def _current_file(self):
+		"""
+		Returns the name of the file currently written to. When rotating,
+		an index is added to the name of each file.
+		"""
+		if not (self.rotate_size or self.rotate_interval):
+			return self.file
+		base, codec_ext = split_codec(self.file)
+		root, ext = os.path.splitext(base)
+		return "%s-%04d%s%s" % (root, self._file_index, ext, codec_ext)
+
+	def _open_file(self):
+		"""
+		Opens the current file, and writes the header if it's a new file.
+		The header of a compressed file is written in its own frame.
+		"""
+		path = os.path.join(self.path, self._current_file())
+		header = self._sample_to_csv(["timestamp"] + list(self._header)) + "\n"
+
+		if self.codec is None:
+			self._filehandler = open(path, "a")
+			if self._filehandler.tell() == 0:
+				self._filehandler.write(header)
+		else:
+			self._filehandler = open(path, "ab")
+			if self._filehandler.tell() == 0:
+				self._filehandler.write(self.codec.compress(header.encode()))
+			self._index = open(index_path(path), "a")
+			if self._index.tell() == 0:
+				self._index.write(INDEX_HEADER + "\n")
+		self._opened_at = time.monotonic()
+
+	def _close_file(self):
+		"""
+		Closes the current file, and its index.
+		"""
+		self._filehandler.close()
+		self._filehandler = None
+		if self._index is not None:
+			self._index.close()
+			self._index = None
+
+	def _rotate(self):
+		"""
+		Starts a new file if the current one is too large or too old.
+		"""
+		if not (
+			(self.rotate_size and self._filehandler.tell() >= self.rotate_size)
+			or (
+				self.rotate_interval
+				and time.monotonic() - self._opened_at >= self.rotate_interval
+			)
+		):
+			return
+
+		self._close_file()
+		self._file_index += 1
+		self._open_file()
+		log.info("Rotated output to %s", self._current_file())
 
 	def set_header(self, header):
 		"""
@@ -323,12 +1161,144 @@ class FileOutlet(object):
 
 		self._make_dirs()
 
-		self._filehandler = open(os.path.join(self.path, self.file), "a", 5)
-		self.push_sample(self._header)
+		columns = len(self._header) + 1
+		self._rows = np.empty((self.flush_size, columns), dtype=np.float64)
+		self._row_format = ",".join(["%.15g"] * columns) + "\n"
+
+		if split_codec(self.file)[1]:
+			self.codec = Codec(split_codec(self.file)[1])
+			self._frames = queue.SimpleQueue()
+			self._compressor = threading.Thread(target=self._compress, daemon=True)
+
+		self._open_file()
+		if self._compressor is not None:
+			self._compressor.start()
+		self._last_flush = time.monotonic()
+
+	def _compress(self):
+		"""
+		Writes the batches of rows as compressed frames until `None`
+		is queued.
+		"""
+		while True:
+			rows = self._frames.get()
+			if rows is None:
+				break
+			try:
+				self._write_frame(rows)
+			except Exception as e:
+				log.error("Unknow error occured while WRITING a compressed frame")
+				log.error(
+					"%s - %s", e.__class__.__name__, e
+				)
+
+	def _write_frame(self, rows):
+		"""
+		Formats and compresses a batch of rows, appends it to the file,
+		and adds it to the index.
+		:param np.ndarray rows: Rows to write, with the timestamp
+			in the first column.
+		"""
+		frame = self.codec.compress((
+			(self._row_format * len(rows)) % tuple(rows.ravel().tolist())
+		).encode())
+
+		offset = self._filehandler.tell()
+		self._filehandler.write(frame)
+		self._index.write("%d,%d,%d,%.15g,%.15g\n" % (
+			offset, len(frame), len(rows), rows[0, 0], rows[-1, 0]
+		))
 
-	def push_sample(self, sample):
+		self._filehandler.flush()
+		self._index.flush()
+		if self.fsync:
+			os.fsync(self._filehandler.fileno())
+			os.fsync(self._index.fileno())
+
+		self._rotate()
+
+	def push_sample(self, sample, timestamp=0.0):
 		"""
 		Push a sample that conforms to the given header.
 		:param list sample: Data sample to write.
+		:param float timestamp: Time at which the sample was read.
+		"""
+		row = self._rows[self._count]
+		row[0] = timestamp
+		row[1:] = sample
+		self._count += 1
+
+		if (
+			self._count == self.flush_size
+			or time.monotonic() - self._last_flush >= self.flush_interval
+		):
+			self.flush()
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Push multiple samples that conform to the given header.
+		:param np.ndarray samples: Data samples to write.
+		:param list timestamps: Time at which each sample was read.
+		"""
+		samples = np.asarray(samples, dtype=np.float64)
+		timestamps = np.asarray(timestamps, dtype=np.float64)
+
+		start = 0
+		while start < len(samples):
+			count = min(self.flush_size - self._count, len(samples) - start)
+			rows = self._rows[self._count:self._count + count]
+			rows[:, 0] = timestamps[start:start + count]
+			rows[:, 1:] = samples[start:start + count]
+
+			self._count += count
+			start += count
+			if self._count == self.flush_size:
+				self.flush()
+
+		self.poll()
+
+	def poll(self):
+		"""
+		Writes the gathered samples if they have been waiting for too long.
+		"""
+		if self._count and time.monotonic() - self._last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		"""
+		Writes the gathered samples to the file, formatting
+		all of them at once. For compressed files, a copy of the
+		samples is handed to the compression thread instead.
+		"""
+		if self.codec is not None:
+			if self._count:
+				self._frames.put(self._rows[:self._count].copy())
+				self._count = 0
+			self._last_flush = time.monotonic()
+			return
+
+		if self._count:
+			self._filehandler.write(
+				(self._row_format * self._count) %
+				tuple(self._rows[:self._count].ravel().tolist())
+			)
+			self._count = 0
+
+		self._filehandler.flush()
+		if self.fsync:
+			os.fsync(self._filehandler.fileno())
+		self._last_flush = time.monotonic()
+
+		self._rotate()
+
+	def close(self):
+		"""
+		Writes the remaining samples and closes the file.
 		"""
-		self._filehandler.write(self._sample_to_csv(sample) + "\n")
+		if self._filehandler is None:
+			return
+		self.flush()
+		if self._compressor is not None:
+			self._frames.put(None)
+			self._compressor.join()
+		self._close_file()
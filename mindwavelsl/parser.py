@@ -1,6 +1,33 @@
 import argparse
 
-from mindwavelsl.constants import MINDWAVE_PYTHON_ORIG, MINDWAVE_PYTHON_FORK
+from mindwavelsl.constants import (
+	FILTER_OUTPUTS,
+	FILTER_PAIR,
+	MINDWAVE_PYTHON_ORIG,
+	MINDWAVE_PYTHON_FORK,
+	parse_bands
+)
+from mindwavelsl.logger import LOG_LEVELS
+
+def endpoint(value):
+	"""
+	Parses a `host:port` pair for the `--endpoints` option.
+	"""
+	host, sep, port = value.rpartition(":")
+	if not sep or not host or not port.isdigit():
+		raise argparse.ArgumentTypeError(
+			"Endpoint must be given as host:port, got: %s" % value
+		)
+	return host, int(port)
+
+def bands(value):
+	"""
+	Parses the `name:low-high` pairs of the `--bands` option.
+	"""
+	try:
+		return parse_bands(value)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
 
 def mwparser():
 	"""
@@ -15,13 +42,142 @@ def mwparser():
 	parser.add_argument('--no-lsl', action="store_false", default=True,
 						help="Set this flag to disable LSL outlet.")
 	parser.add_argument('--output', type=str, default='',
-						help="Path to output data to, can include a CSV filename.")
+						help="Path to output data to, can include a CSV filename. CSV "
+						"files ending with .gz, .zst, or .lz4 are compressed in frames "
+						"that can be read separately (.zst and .lz4 need `zstandard` "
+						"and `lz4`).")
+	parser.add_argument('--format', type=str, default='', choices=['csv', 'npy', 'xdf'],
+						help="Format of the file output. By default, it's based on the "
+						"extension of --output. The `npy` format holds float64 records "
+						"with timestamps that can be memory-mapped with NumPy, and it can "
+						"be converted to CSV with `mindwavelsl-convert`. The `xdf` format "
+						"is the one written by LabRecorder, with a timestamp for each "
+						"sample, and it can be loaded with `pyxdf`.")
+	parser.add_argument('--flush-interval', type=float, default=1.0,
+						help="Maximum time, in seconds, that samples are kept in memory "
+						"before they are written to the CSV, NPY, or XDF file.")
+	parser.add_argument('--fsync', action="store_true", default=False,
+						help="Set this to sync the CSV file to the disk after each write.")
+	parser.add_argument('--rotate-size', type=float, default=0,
+						help="Set this to start a new CSV file once the current one is "
+						"larger than this many megabytes.")
+	parser.add_argument('--rotate-interval', type=float, default=0,
+						help="Set this to start a new CSV file once the current one is "
+						"older than this many minutes.")
+	parser.add_argument('--multi-stream', action="store_true", default=False,
+						help="Set this to split the data into multiple LSL streams, one for "
+						"the 512Hz raw data and others for the low-rate eSense, eegPower, "
+						"and signal quality fields.")
+	parser.add_argument('--chunk-size', type=int, default=0,
+						help="Set this to push the raw samples to LSL in chunks of this many "
+						"samples instead of one at a time.")
+	parser.add_argument('--chunk-latency', type=float, default=50,
+						help="Maximum time, in milliseconds, that a sample can wait before "
+						"its chunk is pushed when --chunk-size is set.")
+
+	parser.add_argument('--dejitter', action="store_true", default=False,
+						help="Set this to smooth the timestamps of the raw samples with a "
+						"running linear regression at the nominal 512Hz rate, removing the "
+						"jitter of the Bluetooth link and the ThinkGear Connector.")
+	parser.add_argument('--band-power', action="store_true", default=False,
+						help="Set this to compute the power of frequency bands in the raw "
+						"data and push it to an extra LSL stream, updated every "
+						"--band-power-hop milliseconds.")
+	parser.add_argument('--band-power-window', type=float, default=1.0,
+						help="Length, in seconds, of the window used to compute the band "
+						"power.")
+	parser.add_argument('--band-power-hop', type=float, default=100,
+						help="Time, in milliseconds, between two band power updates.")
+	parser.add_argument('--bands', type=bands, default=None,
+						help="Bands to compute with --band-power, given as name:low-high "
+						"pairs in Hz separated by commas, e.g. alpha:8-12,beta:13-30. By "
+						"default, the bands of the ThinkGear eegPower values are used.")
+	parser.add_argument('--filter', action="store_true", default=False,
+						help="Set this to filter the raw data with the --bandpass and --notch "
+						"filters. This needs `scipy`.")
+	parser.add_argument('--bandpass', type=float, nargs=2, default=[1.0, 40.0],
+						metavar=('LOW', 'HIGH'),
+						help="Cutoffs, in Hz, of the bandpass filter used with --filter. "
+						"Either can be 0 to disable it.")
+	parser.add_argument('--notch', type=float, default=60.0,
+						help="Frequency, in Hz, of the power line noise removed with "
+						"--filter, usually 50 or 60. Set it to 0 to disable the notch filter.")
+	parser.add_argument('--filter-output', type=str, default=FILTER_PAIR,
+						choices=FILTER_OUTPUTS,
+						help="Where the filtered data goes with --filter: `pair` pushes it to "
+						"an extra LSL stream next to the raw data, and `filtered` pushes it "
+						"in place of the raw data. Files always get the raw data.")
+	parser.add_argument('--decimate', type=int, default=0,
+						help="Set this to push the raw data, lowpass filtered and decimated by "
+						"this factor, to an extra LSL stream, e.g. 4 for 128Hz.")
+	parser.add_argument('--output-decimate', type=int, default=0,
+						help="Set this to decimate the raw data written to --output by this "
+						"factor. The other fields are all written.")
+	parser.add_argument('--quality', action="store_true", default=False,
+						help="Set this to detect clipping, flatlines, steps, eye blinks, and "
+						"power line noise (at the --notch frequency) in the raw data. The "
+						"artifacts are pushed as JSON events to a marker stream, and a "
+						"quality score between 0 and 1 is pushed to an extra LSL stream "
+						"once per second.")
+	parser.add_argument('--metrics-port', type=int, default=0,
+						help="Set this to serve metrics of the acquisition loop (stage timings, "
+						"rates of each field, poor signal samples, garbled frames, dropped "
+						"samples, and errors) in the Prometheus text format on "
+						"http://--metrics-host:PORT/metrics.")
+	parser.add_argument('--metrics-host', type=str, default='localhost',
+						help="Host to serve the metrics on with --metrics-port.")
+	parser.add_argument('--diagnostics', action="store_true", default=False,
+						help="Set this to push a summary of the metrics to an extra LSL "
+						"stream once per second.")
+	parser.add_argument('--log-level', type=str.upper, default="INFO", choices=LOG_LEVELS,
+						help="Level of the messages that get logged. Logging happens on a "
+						"background thread, and repeated warnings, like poor signal quality, "
+						"are logged at most once every 5 seconds.")
+	parser.add_argument('--threaded', action="store_true", default=False,
+						help="Set this to read from the connection on one thread and push "
+						"to each outlet on its own thread, so that a slow outlet doesn't "
+						"stall the connection.")
+	parser.add_argument('--buffer-size', type=int, default=8192,
+						help="Number of samples that an outlet can fall behind by when "
+						"--threaded is set.")
+	parser.add_argument('--overflow', type=str, default="block",
+						choices=["block", "drop-oldest", "drop"],
+						help="What to do with new samples when an outlet falls too far "
+						"behind with --threaded: block the reader, drop the oldest samples, "
+						"or drop the new samples. Dropped samples are counted.")
 
 	# Telnet connection parameters
 	parser.add_argument('--host', type=str, default='localhost',
 						help='The host for the ThinkGear Connector.')
 	parser.add_argument('--port', type=int, default=13854,
 						help="The port for the ThinkGear Connector.")
+	parser.add_argument('--no-reconnect', dest='reconnect', action="store_false",
+						default=True,
+						help="Set this to stop retrying when the connection to the headset "
+						"is lost. By default, it reconnects with a growing delay, keeps the "
+						"LSL streams open, and marks each gap in a `MindwaveMarkers` stream.")
+	parser.add_argument('--stale-timeout', type=float, default=5.0,
+						help="Time, in seconds, without data after which the connection "
+						"is considered lost.")
+	parser.add_argument('--endpoints', type=endpoint, nargs='+', default=[],
+						help="Set this to a list of host:port pairs to record multiple "
+						"ThinkGear Connectors at once in a single process. Each one gets "
+						"its own LSL stream, and its own file when --output is set.")
+	parser.add_argument('--workers', type=int, default=0,
+						help="Set this to split the --endpoints between this many worker "
+						"processes, e.g. the number of cores, instead of reading them all "
+						"in a single process. Workers that crash or hang are restarted, "
+						"and their health is served with --metrics-port.")
+
+	# Replay parameters
+	parser.add_argument('--replay', type=str, default='',
+						help="Set this to a recording to replay it instead of reading from a "
+						"headset. It can be a CSV (optionally compressed), `.npy`, or `.xdf` "
+						"file written with --output, or a capture of the ThinkGear Connector "
+						"JSON stream (with no extension, or `.json`, `.txt`, or `.log`).")
+	parser.add_argument('--replay-speed', type=float, default=1.0,
+						help="Replay speed relative to real time, e.g. 10 replays 10 times "
+						"faster. Set it to 0 to replay as fast as possible.")
 
 	# Mindwave-python connection parameters.
 	parser.add_argument('--mindwave-python-connect', action="store_true", default=False,
@@ -0,0 +1,296 @@
+"""
+Used to decouple reading from the headset and pushing to the outlets
+so that a slow outlet doesn't stall the connection.
+"""
+import numpy as np
+import threading
+import time
+
+from mindwavelsl.connectors import EndOfStream
+from mindwavelsl.logger import MindwaveLogger
+
+log = MindwaveLogger("mindwave-pipeline")
+
+# Block the reader until there's space in the buffer
+OVERFLOW_BLOCK = "block"
+# Overwrite the oldest sample in the buffer
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+# Drop the new sample
+OVERFLOW_DROP = "drop"
+
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP]
+
+
+class RingBuffer(object):
+	"""
+	Thread-safe, preallocated buffer of samples and their timestamps
+	with a single producer and a single consumer.
+	"""
+	def __init__(self, capacity, channel_count, overflow=OVERFLOW_BLOCK):
+		"""
+		Initializes the RingBuffer.
+
+		:param int capacity: Maximum number of samples in the buffer.
+		:param int channel_count: Number of channels in a sample.
+		:param str overflow: What to do with a new sample when the
+			buffer is full, one of `OVERFLOW_POLICIES`.
+		"""
+		if overflow not in OVERFLOW_POLICIES:
+			raise Exception(
+				"Unknown overflow policy `%s`, expected one of: %s" %
+				(overflow, ", ".join(OVERFLOW_POLICIES))
+			)
+
+		self.capacity = capacity
+		self.overflow = overflow
+		self.dropped = 0
+
+		self._samples = np.empty((capacity, channel_count), dtype=np.float64)
+		self._timestamps = np.empty(capacity, dtype=np.float64)
+		self._start = 0
+		self._count = 0
+		self._closed = False
+
+		self._lock = threading.Lock()
+		self._not_empty = threading.Condition(self._lock)
+		self._not_full = threading.Condition(self._lock)
+
+	def __len__(self):
+		return self._count
+
+	def put(self, sample, timestamp):
+		"""
+		Adds a sample to the buffer. Returns False if the sample
+		was dropped.
+		:param list sample: Sample to add.
+		:param float timestamp: Timestamp of the sample.
+		"""
+		with self._lock:
+			if self._count == self.capacity:
+				if self.overflow == OVERFLOW_BLOCK:
+					while self._count == self.capacity and not self._closed:
+						self._not_full.wait()
+					if self._closed:
+						return False
+				elif self.overflow == OVERFLOW_DROP_OLDEST:
+					self._start = (self._start + 1) % self.capacity
+					self._count -= 1
+					self.dropped += 1
+				else:
+					self.dropped += 1
+					return False
+
+			end = (self._start + self._count) % self.capacity
+			self._samples[end] = sample
+			self._timestamps[end] = timestamp
+			self._count += 1
+
+			self._not_empty.notify()
+		return True
+
+	def get(self, max_count, timeout=None):
+		"""
+		Removes up to `max_count` samples from the buffer and returns
+		copies of them with their timestamps. Waits up to `timeout`
+		seconds for a sample if the buffer is empty.
+		:param int max_count: Maximum number of samples to return.
+		:param float timeout: Time to wait for a sample.
+		"""
+		with self._lock:
+			if not self._count and not self._closed:
+				self._not_empty.wait(timeout)
+
+			count = min(self._count, max_count)
+			start = self._start
+			end = start + count
+			if end <= self.capacity:
+				samples = self._samples[start:end].copy()
+				timestamps = self._timestamps[start:end].copy()
+			else:
+				end -= self.capacity
+				samples = np.concatenate(
+					(self._samples[start:], self._samples[:end])
+				)
+				timestamps = np.concatenate(
+					(self._timestamps[start:], self._timestamps[:end])
+				)
+
+			self._start = end % self.capacity
+			self._count -= count
+			self._not_full.notify()
+
+		return samples, timestamps
+
+	def close(self):
+		"""
+		Wakes up the threads waiting on the buffer.
+		"""
+		with self._lock:
+			self._closed = True
+			self._not_empty.notify_all()
+			self._not_full.notify_all()
+
+
+class Pipeline(object):
+	"""
+	Reads from a `MindwaveLSL` connection on a reader thread and fills
+	one ring buffer per sink. Each sink thread drains its buffer in
+	batches to its outlets.
+	"""
+	def __init__(
+			self,
+			mwlsl,
+			capacity=8192,
+			overflow=OVERFLOW_BLOCK,
+			batch_size=256,
+			sinks=None
+		):
+		"""
+		Initializes the Pipeline.
+
+		:param MindwaveLSL mwlsl: Instance to read from, it must
+			already be setup.
+		:param int capacity: Number of samples that each sink can
+			fall behind by before the overflow policy applies.
+		:param str overflow: One of `OVERFLOW_POLICIES`.
+		:param int batch_size: Maximum number of samples pushed
+			to the outlets at once.
+		:param list sinks: Groups of outlets that get their own thread,
+			by default each outlet gets one.
+		"""
+		self.mwlsl = mwlsl
+		self.batch_size = batch_size
+		self.sinks = sinks or [[outlet] for outlet in mwlsl.outlets]
+		self.buffers = [
+			RingBuffer(capacity, len(mwlsl._channels), overflow)
+			for _ in self.sinks
+		]
+
+		self._running = False
+		self._threads = []
+		self._reader = None
+		self._last_drop_log = 0
+
+		self.metrics = mwlsl.metrics
+		if self.metrics is not None:
+			for ind, buffer in enumerate(self.buffers):
+				self.metrics.register(
+					"queue_depth", buffer.__len__, "gauge", source="sink-%s" % ind
+				)
+				self.metrics.register(
+					"dropped_samples_total",
+					lambda buffer=buffer: buffer.dropped,
+					source="sink-%s" % ind
+				)
+
+	@property
+	def dropped(self):
+		"""
+		Total number of samples dropped by all the buffers.
+		"""
+		return sum(buffer.dropped for buffer in self.buffers)
+
+	def _read(self):
+		"""
+		Reads samples and adds them to the buffer of each sink.
+		"""
+		while self._running and self.mwlsl.running():
+			try:
+				response = self.mwlsl.read()
+				timestamp = self.mwlsl.read_timestamp()
+				if not response:
+					continue
+
+				sample = self.mwlsl.make_sample(response)
+				timestamp = self.mwlsl.correct_timestamp(sample, timestamp)
+			except EndOfStream as e:
+				log.info(str(e))
+				return
+			except Exception as e:
+				if self.metrics is not None:
+					self.metrics.count_error("read", e)
+				log.error("Unknow error occured while reading")
+				log.error(
+					"%s - %s", e.__class__.__name__, e
+				)
+				continue
+
+			dropped = False
+			for buffer in self.buffers:
+				if not buffer.put(sample, timestamp):
+					dropped = True
+
+			if dropped and time.time() - self._last_drop_log > 1:
+				self._last_drop_log = time.time()
+				log.warning(
+					"Outlets are falling behind, %s samples dropped so far",
+					self.dropped
+				)
+
+	def _sink(self, buffer, outlets):
+		"""
+		Drains a buffer into its outlets.
+		"""
+		while self._running or len(buffer):
+			samples, timestamps = buffer.get(self.batch_size, timeout=0.01)
+			try:
+				if len(samples):
+					timestamps = timestamps.tolist()
+					for outlet in outlets:
+						outlet.push_chunk(samples, timestamps)
+				for outlet in outlets:
+					if hasattr(outlet, "poll"):
+						outlet.poll()
+			except Exception as e:
+				if self.metrics is not None:
+					self.metrics.count_error("push", e)
+				log.error("Unknow error occured while pushing")
+				log.error(
+					"%s - %s", e.__class__.__name__, e
+				)
+
+		for outlet in outlets:
+			if hasattr(outlet, "flush"):
+				outlet.flush()
+
+	def start(self):
+		"""
+		Starts the reader and sink threads.
+		"""
+		self._running = True
+		for buffer, outlets in zip(self.buffers, self.sinks):
+			thread = threading.Thread(
+				target=self._sink, args=(buffer, outlets), daemon=True
+			)
+			thread.start()
+			self._threads.append(thread)
+
+		# The reader can block on the connection, so it's left
+		# as a daemon thread when stopping.
+		self._reader = threading.Thread(target=self._read, daemon=True)
+		self._reader.start()
+
+	def stop(self):
+		"""
+		Stops the threads after the buffers are drained.
+		"""
+		self._running = False
+		for buffer in self.buffers:
+			buffer.close()
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+		if self.dropped:
+			log.warning("%s samples were dropped in total", self.dropped)
+
+	def run(self):
+		"""
+		Runs the pipeline until the reader stops or it's interrupted.
+		"""
+		self.start()
+		try:
+			while self._reader.is_alive():
+				self._reader.join(0.5)
+		finally:
+			self.stop()
@@ -0,0 +1,206 @@
+"""
+Used to record multiple ThinkGear Connectors from a single
+process with an asyncio event loop.
+"""
+import asyncio
+import logging
+import os
+import pylsl as lsl
+
+from mindwavelsl.compression import split_codec
+from mindwavelsl.connectors import AsyncThinkGearConnector, Backoff
+from mindwavelsl.constants import RAW_OUTPUT_CONFIG
+from mindwavelsl.logger import MindwaveLogger
+from mindwavelsl.outlet import MindwaveLSL
+
+log = MindwaveLogger("mindwave-runner")
+
+
+def endpoint_output_path(path, host, port, file_format=''):
+	"""
+	Returns the file output path of an endpoint so that each
+	endpoint writes to its own file.
+
+	:param str path: Path given through `--output`, it can be
+		a directory or a file.
+	:param str host: Host of the endpoint.
+	:param int port: Port of the endpoint.
+	:param str file_format: Format of the file output, used for
+		the extension when the path is a directory.
+	"""
+	if not path:
+		return ''
+
+	suffix = "%s-%s" % (host, port)
+	base, codec_ext = split_codec(path)
+	root, ext = os.path.splitext(base)
+	if ext in ('.csv', '.npy', '.xdf'):
+		return "%s-%s%s%s" % (root, suffix, ext, codec_ext)
+	return os.path.join(
+		path, "mindwave-output-%s.%s" % (suffix, file_format or 'csv')
+	)
+
+
+class MultiHeadsetRunner(object):
+	"""
+	Reads from many ThinkGear Connector endpoints in one event loop.
+	Each endpoint feeds its own `MindwaveLSL` outlets.
+	"""
+
+	def __init__(self, endpoints, file_outlet_path='', source_id='', **kwargs):
+		"""
+		Initializes the MultiHeadsetRunner.
+
+		:param list endpoints: List of (host, port) pairs.
+		:param str file_outlet_path: Path to where the data will be
+			output, each endpoint gets its own file in it.
+		:param str source_id: If set, the streams of each endpoint get
+			the source ID `<source_id>-<host>-<port>` instead of a
+			random one.
+		:param kwargs: Other settings for the `MindwaveLSL` outlets.
+		"""
+		self.endpoints = endpoints
+		self.headsets = []
+
+		self._file_outlet_path = file_outlet_path
+		self._source_id = source_id
+		self._kwargs = kwargs
+		self._poll_interval = kwargs.get("chunk_latency", 0.05) / 2
+
+	def setup(self):
+		"""
+		Prepares the outlets and the connector of each endpoint.
+		"""
+		if self.headsets:
+			return self.headsets
+
+		for host, port in self.endpoints:
+			mwlsl = MindwaveLSL(
+				host,
+				port,
+				file_outlet_path=endpoint_output_path(
+					self._file_outlet_path,
+					host,
+					port,
+					self._kwargs.get("file_format", '')
+				),
+				stream_name="Mindwave-%s-%s" % (host, port),
+				source_id="%s-%s-%s" % (self._source_id, host, port) if self._source_id else '',
+				**self._kwargs
+			)
+			mwlsl.setup_outlets()
+
+			connector = AsyncThinkGearConnector(
+				host,
+				port,
+				timeout=mwlsl.stale_timeout if mwlsl.reconnect else None
+			)
+			if mwlsl.metrics is not None:
+				mwlsl.instrument(connector)
+			self.headsets.append((mwlsl, connector))
+
+		return self.headsets
+
+	def _push(self, mwlsl, response, timestamp):
+		"""
+		Builds the sample of a response and pushes it to the outlets.
+		Errors are logged and the sample is skipped, like in
+		`MindwaveLSL.run`, so that an outlet error (e.g. a full disk)
+		isn't taken for a lost connection.
+		"""
+		try:
+			sample = mwlsl.make_sample(response)
+			mwlsl.push_sample(sample, mwlsl.correct_timestamp(sample, timestamp))
+		except Exception as e:
+			if mwlsl.metrics is not None:
+				mwlsl.metrics.count_error("run", e)
+			log.error("Unknow error occured while running")
+			log.error(
+				"%s - %s", e.__class__.__name__, e
+			)
+
+	async def _run_headset(self, mwlsl, connector):
+		"""
+		Reads from one endpoint and pushes its samples until the
+		connection fails. When reconnecting is enabled, the connection
+		is restored with a growing delay and the gaps are marked. Only
+		the errors of the connection lead to a reconnection.
+		"""
+		backoff = Backoff()
+		last_data = None
+		gap_start = None
+		try:
+			while True:
+				try:
+					await connector.setup()
+					await connector.write(RAW_OUTPUT_CONFIG)
+					backoff.reset()
+
+					while True:
+						response = await connector.read()
+						if gap_start is not None:
+							mwlsl.mark_gap(gap_start, connector.timestamp)
+							gap_start = None
+						last_data = connector.timestamp
+						self._push(mwlsl, response, connector.timestamp)
+				except (OSError, EOFError, asyncio.TimeoutError) as e:
+					if not mwlsl.reconnect:
+						raise
+					if gap_start is None:
+						gap_start = last_data if last_data is not None else lsl.local_clock()
+
+					delay = backoff.next()
+					log.limited(
+						logging.WARNING,
+						"Connection to %s:%s lost, reconnecting in %.1fs: %s - %s",
+						connector.host, connector.port, delay, e.__class__.__name__, e
+					)
+					try:
+						await connector.close()
+					except Exception:
+						pass
+					await asyncio.sleep(delay)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			if mwlsl.metrics is not None:
+				mwlsl.metrics.count_error("run", e)
+			log.error(
+				"Stopped reading from %s:%s", connector.host, connector.port
+			)
+			log.error(
+				"%s - %s", e.__class__.__name__, e
+			)
+		finally:
+			mwlsl.close()
+			await connector.close()
+
+	async def _poll_headsets(self):
+		"""
+		Periodically pushes the chunks that have been waiting for too long.
+		"""
+		while True:
+			await asyncio.sleep(self._poll_interval)
+			for mwlsl, _ in self.headsets:
+				mwlsl.poll()
+
+	async def run_async(self):
+		"""
+		Runs all the endpoints until they all stop.
+		"""
+		self.setup()
+
+		poller = asyncio.ensure_future(self._poll_headsets())
+		try:
+			await asyncio.gather(*[
+				self._run_headset(mwlsl, connector)
+				for mwlsl, connector in self.headsets
+			])
+		finally:
+			poller.cancel()
+
+	def run(self):
+		"""
+		Starts the event loop and runs all the endpoints.
+		"""
+		asyncio.run(self.run_async())
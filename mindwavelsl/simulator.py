@@ -0,0 +1,275 @@
+"""
+Local server that simulates the ThinkGear Connector, used to run and
+benchmark `mindwavelsl` without a headset.
+"""
+import argparse
+import json
+import numpy as np
+import pylsl as lsl
+import select
+import socket
+import threading
+import time
+
+from mindwavelsl.constants import LOW_SRATE, RAW_SRATE
+from mindwavelsl.logger import MindwaveLogger
+
+log = MindwaveLogger("mindwave-simulator")
+
+# Bands of the eegPower packets
+EEG_POWER_BANDS = [
+	"delta", "theta", "lowAlpha", "highAlpha",
+	"lowBeta", "highBeta", "lowGamma", "highGamma",
+]
+
+
+class SimulatedHeadset(object):
+	"""
+	Generates the data of one headset: an alpha rhythm with noise and
+	blinks for `rawEeg`, and random eSense and eegPower values.
+	"""
+	def __init__(self, seed=None, blink_rate=0.2):
+		"""
+		Initializes the SimulatedHeadset.
+
+		:param int seed: Seed of the random generator.
+		:param float blink_rate: Average number of blinks per second.
+		"""
+		self.blink_rate = blink_rate
+		self._rng = np.random.default_rng(seed)
+		self._index = 0
+		self._blink_left = 0
+		self._blink_shape = 400 * np.hanning(int(0.2 * RAW_SRATE))
+
+	def raw(self, count):
+		"""
+		Returns the next `count` raw values, and the strength of
+		the blinks that started in them.
+		"""
+		t = (self._index + np.arange(count)) / RAW_SRATE
+		values = (
+			40 * np.sin(2 * np.pi * 10 * t)
+			+ 15 * np.sin(2 * np.pi * 20 * t)
+			+ 10 * np.sin(2 * np.pi * 60 * t)
+			+ self._rng.normal(0, 20, count)
+		)
+
+		# Finish the blink that started in the previous values
+		blink_size = len(self._blink_shape)
+		if self._blink_left:
+			start = blink_size - self._blink_left
+			size = min(self._blink_left, count)
+			values[:size] += self._blink_shape[start:start + size]
+			self._blink_left -= size
+
+		blinks = []
+		onsets = np.flatnonzero(self._rng.random(count) < self.blink_rate / RAW_SRATE)
+		for onset in onsets:
+			size = min(blink_size, count - onset)
+			values[onset:onset + size] += self._blink_shape[:size]
+			self._blink_left = max(self._blink_left, blink_size - size)
+			blinks.append(int(self._rng.integers(30, 200)))
+
+		self._index += count
+		return np.clip(values, -2048, 2047).astype(int).tolist(), blinks
+
+	def low_rate_packet(self):
+		"""
+		Returns the once-per-second packet with eSense and eegPower values.
+		"""
+		return {
+			"eSense": {
+				"attention": int(self._rng.integers(0, 101)),
+				"meditation": int(self._rng.integers(0, 101)),
+			},
+			"eegPower": {
+				band: int(self._rng.integers(0, 1000000))
+				for band in EEG_POWER_BANDS
+			},
+			"poorSignalLevel": 0,
+		}
+
+
+class ThinkGearSimulator(object):
+	"""
+	TCP server that sends ThinkGear Connector JSON frames to each
+	client: `rawEeg` at 512Hz once raw output is enabled, eSense and
+	eegPower at 1Hz, and blink events. The rates can be multiplied
+	to stress the client.
+	"""
+	def __init__(self, host='localhost', port=0, speed=1.0, tick=0.002, seed=None):
+		"""
+		Initializes the ThinkGearSimulator.
+
+		:param str host: Host to listen on.
+		:param int port: Port to listen on, 0 picks a free port.
+		:param float speed: Multiplier of the data rates.
+		:param float tick: Time, in seconds, between two sends.
+		:param int seed: Seed of the simulated data.
+		"""
+		self.host = host
+		self.port = port
+		self.speed = speed
+		self.tick = tick
+		self.seed = seed
+
+		# Time at which the raw stream of the last client started, and
+		# the number of raw frames sent to it
+		self.started = None
+		self.raw_sent = 0
+
+		# When paused, the connections stay open but nothing is sent
+		self.paused = False
+
+		self._server = None
+		self._clients = []
+		self._running = False
+		self._threads = []
+
+	def start(self):
+		"""
+		Starts listening for clients.
+		"""
+		self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._server.bind((self.host, self.port))
+		self._server.listen()
+		self.port = self._server.getsockname()[1]
+
+		self._running = True
+		thread = threading.Thread(target=self._accept, daemon=True)
+		thread.start()
+		self._threads.append(thread)
+
+		log.info("Simulating a ThinkGear Connector on %s:%s", self.host, self.port)
+		return self.port
+
+	def stop(self):
+		"""
+		Stops sending data and closes all the connections.
+		"""
+		self._running = False
+		for sock in self._clients + [self._server]:
+			# Shutting down wakes up the threads blocked on the socket,
+			# closing it alone leaves the port bound until they return
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			try:
+				sock.close()
+			except OSError:
+				pass
+		for thread in self._threads:
+			thread.join(1)
+
+	def _accept(self):
+		"""
+		Accepts clients and starts a thread for each one.
+		"""
+		while self._running:
+			try:
+				client, _ = self._server.accept()
+			except OSError:
+				break
+			self._clients.append(client)
+			thread = threading.Thread(target=self._serve, args=(client,), daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	def _wait_for_config(self, client):
+		"""
+		Returns True once the client has enabled the raw output.
+		"""
+		readable, _, _ = select.select([client], [], [], 0)
+		if not readable:
+			return False
+
+		data = client.recv(4096)
+		if not data:
+			raise EOFError("Client disconnected")
+
+		try:
+			config = json.loads(data.decode(errors="ignore").strip().split("}")[0] + "}")
+		except ValueError:
+			return False
+		return bool(config.get("enableRawOutput"))
+
+	def _serve(self, client):
+		"""
+		Sends frames to a client until it disconnects.
+		"""
+		headset = SimulatedHeadset(self.seed)
+		raw_enabled = False
+		raw_sent = 0
+		low_sent = 0
+		start = lsl.local_clock()
+
+		try:
+			while self._running:
+				if self.paused:
+					time.sleep(self.tick)
+					continue
+
+				if not raw_enabled and self._wait_for_config(client):
+					raw_enabled = True
+					raw_sent = 0
+					start = lsl.local_clock()
+					self.started = start
+					self.raw_sent = 0
+
+				elapsed = (lsl.local_clock() - start) * self.speed
+				frames = []
+
+				if raw_enabled:
+					count = int(elapsed * RAW_SRATE) - raw_sent
+					if count > 0:
+						values, blinks = headset.raw(count)
+						frames.extend('{"rawEeg":%d}' % value for value in values)
+						frames.extend(
+							json.dumps({"blinkStrength": blink}) for blink in blinks
+						)
+						raw_sent += count
+
+				if int(elapsed * LOW_SRATE) >= low_sent:
+					frames.append(json.dumps(headset.low_rate_packet()))
+					low_sent += 1
+
+				if frames:
+					client.sendall(("\r".join(frames) + "\r").encode())
+					if raw_enabled:
+						self.raw_sent = raw_sent
+
+				time.sleep(self.tick)
+		except (OSError, EOFError):
+			pass
+		finally:
+			client.close()
+
+
+def main():
+	"""
+	Runs the simulator until interrupted.
+	"""
+	parser = argparse.ArgumentParser(
+		description="Simulate a ThinkGear Connector to run mindwavelsl without a headset."
+	)
+	parser.add_argument('--host', type=str, default='localhost',
+						help="The host to listen on.")
+	parser.add_argument('--port', type=int, default=13854,
+						help="The port to listen on.")
+	parser.add_argument('--speed', type=float, default=1.0,
+						help="Multiplier of the data rates.")
+	args = parser.parse_args()
+
+	simulator = ThinkGearSimulator(args.host, args.port, speed=args.speed)
+	simulator.start()
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		simulator.stop()
+
+
+if __name__ == "__main__":
+	main()
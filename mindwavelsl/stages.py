@@ -0,0 +1,1024 @@
+"""
+Processing stages that run on the `rawEeg` values. Each stage is an
+outlet, it receives the same samples as the other outlets and pushes
+its results to its own LSL stream.
+"""
+import abc
+import collections
+import json
+import numpy as np
+import pylsl as lsl
+
+from mindwavelsl.constants import (
+	DEFAULT_BANDS,
+	EXPECTED_FIELDS,
+	FILTER_BATCH_SIZE,
+	FILTER_OUTPUTS,
+	FILTER_PAIR,
+	FILTER_REPLACE,
+	RAW_SRATE,
+	parse_bands
+)
+
+RAW_INDEX = EXPECTED_FIELDS.index("rawEeg")
+BLINK_INDEX = EXPECTED_FIELDS.index("blinkStrength")
+POOR_SIGNAL_INDEX = EXPECTED_FIELDS.index("poorSignalLevel")
+
+# Channels of the quality stream: the score, and the share of each
+# second flagged by each artifact
+QUALITY_LABELS = ["quality", "clipping", "flatline", "steps", "blinks", "lineNoise"]
+
+def _import_signal():
+	"""
+	Imports `scipy.signal`, which is only needed by the filters.
+	"""
+	try:
+		import scipy.signal
+	except ImportError:
+		raise Exception(
+			"`scipy` is needed to filter the raw data, it can be "
+			"installed with `pip install scipy`."
+		)
+	return scipy.signal
+
+
+def design_filter(srate=RAW_SRATE, low=1.0, high=40.0, notch=60.0, order=4, quality=30.0):
+	"""
+	Returns the second-order sections of a Butterworth bandpass filter
+	followed by a notch filter.
+
+	:param float srate: Sampling rate of the raw values.
+	:param float low: Low cutoff in Hz, 0 for a lowpass filter.
+	:param float high: High cutoff in Hz, 0 for a highpass filter.
+	:param float notch: Frequency to remove in Hz, e.g. the 50Hz or
+		60Hz power line, 0 to disable it.
+	:param int order: Order of the Butterworth filter.
+	:param float quality: Quality factor of the notch filter.
+	"""
+	signal = _import_signal()
+
+	sections = []
+	if low and high:
+		sections.append(signal.butter(
+			order, [low, high], btype="bandpass", fs=srate, output="sos"
+		))
+	elif low:
+		sections.append(signal.butter(
+			order, low, btype="highpass", fs=srate, output="sos"
+		))
+	elif high:
+		sections.append(signal.butter(
+			order, high, btype="lowpass", fs=srate, output="sos"
+		))
+	if notch:
+		b, a = signal.iirnotch(notch, quality, fs=srate)
+		sections.append(signal.tf2sos(b, a))
+
+	if not sections:
+		raise Exception("The filter needs a bandpass or a notch frequency.")
+	return np.vstack(sections)
+
+
+def design_decimator(factor, taps_per_phase=16, cutoff=0.9):
+	"""
+	Returns the taps of a linear-phase FIR lowpass filter, windowed with
+	a Hamming window, used to remove the frequencies above the Nyquist
+	frequency of the decimated rate.
+
+	:param int factor: Decimation factor.
+	:param int taps_per_phase: Number of taps per output sample.
+	:param float cutoff: Cutoff, relative to the decimated Nyquist frequency.
+	"""
+	size = taps_per_phase * factor + 1
+	rel_cutoff = cutoff / factor
+	taps = rel_cutoff * np.sinc(rel_cutoff * (np.arange(size) - (size - 1) / 2.0))
+	taps *= np.hamming(size)
+	return taps / taps.sum()
+
+
+def make_stream_outlet(name, stype, labels, unit, srate, source_id, fmt=None):
+	"""
+	Creates an LSL outlet for the results of a stage.
+
+	:param str name: Name of the stream.
+	:param str stype: Type of the stream.
+	:param list labels: Label of each channel.
+	:param str unit: Unit of the channels.
+	:param float srate: Nominal rate of the stream, 0 if irregular.
+	:param str source_id: Source ID of the stream.
+	:param int fmt: LSL channel format, float64 by default.
+	"""
+	stream_info = lsl.StreamInfo(
+		name=name,
+		type=stype,
+		channel_count=len(labels),
+		nominal_srate=srate,
+		channel_format=lsl.cf_double64 if fmt is None else fmt,
+		source_id=source_id,
+	)
+	stream_info.desc().append_child_value("mindwavelsl-version", "1.0")
+	channels = stream_info.desc().append_child("channels")
+	for label in labels:
+		chan = channels.append_child("channel")
+		chan.append_child_value("label", label)
+		chan.append_child_value("type", stype)
+		chan.append_child_value("unit", unit)
+
+	return lsl.StreamOutlet(stream_info)
+
+
+class RawStage(abc.ABC):
+	"""
+	Base class of the stages, it extracts the raw values from the
+	samples it receives and passes them to `process` in batches.
+	Subclasses must implement `setup_outlet` and `process`.
+	"""
+	def __init__(self, column=RAW_INDEX):
+		"""
+		Initializes the RawStage.
+
+		:param int column: Column of the raw values in the samples.
+		"""
+		self.column = column
+		self.outlet = None
+
+	@abc.abstractmethod
+	def setup_outlet(self):
+		"""
+		Sets up the stream of the stage.
+		"""
+
+	@abc.abstractmethod
+	def process(self, values, timestamps):
+		"""
+		Processes a batch of raw values.
+		:param np.ndarray values: Raw values.
+		:param np.ndarray timestamps: Timestamp of each value.
+		"""
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Processes the raw value of a sample, if it has one.
+		"""
+		raw = sample[self.column]
+		# NaN is the only value that isn't equal to itself
+		if raw == raw:
+			self.process(
+				np.array([raw], dtype=np.float64),
+				np.array([timestamp], dtype=np.float64)
+			)
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Processes the raw values of a chunk of samples.
+		"""
+		values = np.asarray(samples, dtype=np.float64)[:, self.column]
+		present = ~np.isnan(values)
+		if present.any():
+			self.process(
+				values[present],
+				np.asarray(timestamps, dtype=np.float64)[present]
+			)
+
+	def poll(self):
+		"""
+		Polls the outlet that the stage pushes to.
+		"""
+		if hasattr(self.outlet, "poll"):
+			self.outlet.poll()
+
+	def flush(self):
+		"""
+		Flushes the outlet that the stage pushes to.
+		"""
+		if hasattr(self.outlet, "flush"):
+			self.outlet.flush()
+
+
+class BandPowerStage(RawStage):
+	"""
+	Computes the power of frequency bands over a sliding window of the
+	raw values. At each hop, the periodogram of the latest window is
+	averaged with the previous ones (Welch's method), and the band
+	powers are pushed to an LSL stream.
+	"""
+	def __init__(
+			self,
+			source_id,
+			name="MindwaveBandPower",
+			bands=DEFAULT_BANDS,
+			srate=RAW_SRATE,
+			window=1.0,
+			hop=0.1,
+			segments=4,
+			column=RAW_INDEX
+		):
+		"""
+		Initializes the BandPowerStage.
+
+		:param str source_id: Source ID of the stream.
+		:param str name: Name of the stream.
+		:param list bands: (name, low, high) of each band in Hz.
+		:param float srate: Sampling rate of the raw values.
+		:param float window: Length, in seconds, of each periodogram.
+		:param float hop: Time, in seconds, between two band power updates.
+		:param int segments: Number of periodograms that are averaged.
+		:param int column: Column of the raw values in the samples.
+		"""
+		super(BandPowerStage, self).__init__(column)
+		self.source_id = source_id
+		self.name = name
+		self.bands = bands
+		self.srate = srate
+		self.hop = hop
+		self.outlet = None
+
+		self._size = int(round(window * srate))
+		self._hop_size = max(int(round(hop * srate)), 1)
+		self._buffer = np.zeros(self._size, dtype=np.float64)
+		self._pos = 0
+		self._filled = 0
+		self._since = 0
+
+		# Everything that doesn't change between two windows is
+		# computed once: the taper, its scaling, and a matrix summing
+		# the PSD bins of each band.
+		self._taper = np.hanning(self._size)
+		self._scale = 2.0 / (srate * np.sum(self._taper ** 2))
+		freqs = np.fft.rfftfreq(self._size, 1.0 / srate)
+		step = srate / self._size
+		self._band_matrix = np.array([
+			((freqs >= low) & (freqs <= high)) * step
+			for _, low, high in bands
+		])
+
+		self._psds = np.zeros((max(segments, 1), len(freqs)), dtype=np.float64)
+		self._psd_sum = np.zeros(len(freqs), dtype=np.float64)
+		self._psd_index = 0
+		self._psd_count = 0
+
+	def setup_outlet(self):
+		"""
+		Sets up the band power stream.
+		"""
+		self.outlet = make_stream_outlet(
+			self.name,
+			"EEG",
+			[name for name, _, _ in self.bands],
+			"microvolts^2",
+			1.0 / self.hop,
+			self.source_id
+		)
+		return self.outlet
+
+	def _band_powers(self):
+		"""
+		Adds the periodogram of the current window to the average and
+		returns the band powers.
+		"""
+		window = np.concatenate(
+			(self._buffer[self._pos:], self._buffer[:self._pos])
+		)
+		window -= window.mean()
+		spectrum = np.fft.rfft(window * self._taper)
+		psd = (spectrum.real ** 2 + spectrum.imag ** 2) * self._scale
+
+		# Running sum of the last periodograms
+		oldest = self._psds[self._psd_index]
+		self._psd_sum += psd - oldest
+		self._psds[self._psd_index] = psd
+		self._psd_index = (self._psd_index + 1) % len(self._psds)
+		self._psd_count = min(self._psd_count + 1, len(self._psds))
+
+		return self._band_matrix @ (self._psd_sum / self._psd_count)
+
+	def process(self, values, timestamps):
+		"""
+		Adds raw values to the window and pushes the band powers of
+		each hop they complete.
+		"""
+		powers = []
+		stamps = []
+
+		start = 0
+		while start < len(values):
+			count = min(
+				self._hop_size - self._since,
+				self._size - self._pos,
+				len(values) - start
+			)
+			self._buffer[self._pos:self._pos + count] = values[start:start + count]
+			self._pos = (self._pos + count) % self._size
+			self._filled = min(self._filled + count, self._size)
+			self._since += count
+			start += count
+
+			if self._since >= self._hop_size:
+				self._since = 0
+				if self._filled == self._size:
+					powers.append(self._band_powers())
+					stamps.append(timestamps[start - 1])
+
+		if powers:
+			self.outlet.push_chunk(np.array(powers), stamps)
+
+
+class FilterStage(RawStage):
+	"""
+	Filters the raw values with second-order sections, keeping the
+	state of the filter from one chunk to the next. The filtered values
+	are either pushed to their own LSL stream, or put in place of the
+	raw values in the samples pushed to another outlet.
+
+	Filtering one sample at a time is slow, so this stage should be
+	given chunks, e.g. by wrapping it in a `ChunkedOutlet`.
+	"""
+	def __init__(
+			self,
+			sos,
+			source_id='',
+			name="MindwaveFiltered",
+			outlet=None,
+			srate=RAW_SRATE,
+			column=RAW_INDEX
+		):
+		"""
+		Initializes the FilterStage.
+
+		:param np.ndarray sos: Second-order sections of the filter,
+			see `design_filter`.
+		:param str source_id: Source ID of the filtered stream.
+		:param str name: Name of the filtered stream.
+		:param object outlet: If set, the samples are pushed to this
+			outlet with their raw values filtered, instead of pushing
+			the filtered values to their own stream.
+		:param float srate: Sampling rate of the raw values.
+		:param int column: Column of the raw values in the samples.
+		"""
+		super(FilterStage, self).__init__(column)
+		self.sos = np.asarray(sos, dtype=np.float64)
+		self.source_id = source_id
+		self.name = name
+		self.srate = srate
+		self.outlet = outlet
+		self.replace = outlet is not None
+
+		self._sosfilt = _import_signal().sosfilt
+		self._zi_step = _import_signal().sosfilt_zi(self.sos)
+		self._zi = None
+
+	def setup_outlet(self):
+		"""
+		Sets up the filtered stream, unless the samples are pushed
+		to another outlet.
+		"""
+		if not self.replace:
+			self.outlet = make_stream_outlet(
+				self.name,
+				"EEG",
+				["Fp1-filtered"],
+				"microvolts",
+				self.srate,
+				self.source_id
+			)
+		return self.outlet
+
+	def filter(self, values):
+		"""
+		Filters a batch of raw values, continuing from the previous ones.
+		:param np.ndarray values: Raw values.
+		"""
+		if self._zi is None:
+			# Start from the steady state of the first value
+			# to avoid a step at the start of the stream
+			self._zi = self._zi_step * values[0]
+		filtered, self._zi = self._sosfilt(self.sos, values, zi=self._zi)
+		return filtered
+
+	def process(self, values, timestamps):
+		"""
+		Pushes the filtered values to the filtered stream.
+		"""
+		self.outlet.push_chunk(
+			self.filter(values)[:, np.newaxis], timestamps.tolist()
+		)
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Filters the raw value of a sample, if it has one.
+		"""
+		if self.replace:
+			self.push_chunk([sample], [timestamp])
+		else:
+			super(FilterStage, self).push_sample(sample, timestamp)
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Filters the raw values of a chunk of samples.
+		"""
+		if not self.replace:
+			return super(FilterStage, self).push_chunk(samples, timestamps)
+
+		samples = np.array(samples, dtype=np.float64)
+		values = samples[:, self.column]
+		present = ~np.isnan(values)
+		if present.any():
+			samples[present, self.column] = self.filter(values[present])
+		self.outlet.push_chunk(samples, list(timestamps))
+
+
+class DecimateStage(RawStage):
+	"""
+	Lowers the rate of the raw values by an integer factor. The values
+	are filtered with an FIR lowpass filter first, but only the outputs
+	that are kept get computed, which is what a polyphase decimator does.
+	The filter history is kept from one chunk to the next.
+
+	The decimated values are either pushed to their own LSL stream, or
+	the samples are pushed to another outlet with only one raw value in
+	`factor` kept, while the samples without raw values are all kept.
+	The kept raw values are pushed with the delay of the filter removed
+	from their timestamps, so the other samples are held back until the
+	raw values have caught up with them, to push the samples in order.
+	"""
+	def __init__(
+			self,
+			factor,
+			source_id='',
+			name="MindwaveDecimated",
+			outlet=None,
+			srate=RAW_SRATE,
+			column=RAW_INDEX
+		):
+		"""
+		Initializes the DecimateStage.
+
+		:param int factor: Decimation factor, e.g. 4 turns 512Hz into 128Hz.
+		:param str source_id: Source ID of the decimated stream.
+		:param str name: Name of the decimated stream.
+		:param object outlet: If set, the decimated samples are pushed to
+			this outlet instead of pushing the decimated values to their
+			own stream.
+		:param float srate: Sampling rate of the raw values.
+		:param int column: Column of the raw values in the samples.
+		"""
+		super(DecimateStage, self).__init__(column)
+		if factor < 2:
+			raise Exception("Decimation factor must be at least 2, got: %s" % factor)
+
+		self.factor = int(factor)
+		self.source_id = source_id
+		self.name = name
+		self.srate = srate
+		self.outlet = outlet
+		self.replace = outlet is not None
+
+		self.taps = design_decimator(self.factor)
+		# Delay, in seconds, of the linear-phase filter
+		self.delay = (len(self.taps) - 1) / 2.0 / srate
+
+		self._history = None
+		self._phase = 0
+
+		# Samples without raw values waiting for the raw values to
+		# catch up, and the time that the raw values have reached
+		self._held = None
+		self._held_timestamps = np.empty(0)
+		self._reached = None
+
+	def setup_outlet(self):
+		"""
+		Sets up the decimated stream, unless the samples are pushed
+		to another outlet.
+		"""
+		if not self.replace:
+			self.outlet = make_stream_outlet(
+				self.name,
+				"EEG",
+				["Fp1"],
+				"microvolts",
+				self.srate / self.factor,
+				self.source_id
+			)
+		return self.outlet
+
+	def decimate(self, values):
+		"""
+		Returns the positions of the values that are kept, and their
+		filtered values. Continues from the previous values.
+		:param np.ndarray values: Raw values.
+		"""
+		if self._history is None:
+			# Start as if the first value had always been there
+			self._history = np.full(len(self.taps) - 1, values[0], dtype=np.float64)
+
+		positions = np.arange(self._phase, len(values), self.factor)
+		self._phase = self._phase + len(positions) * self.factor - len(values)
+
+		signal = np.concatenate((self._history, values))
+		self._history = signal[len(signal) - len(self._history):]
+		if not len(positions):
+			return positions, np.empty(0)
+
+		# Each window ends at a kept value
+		windows = np.lib.stride_tricks.sliding_window_view(signal, len(self.taps))
+		return positions, windows[positions] @ self.taps[::-1]
+
+	def process(self, values, timestamps):
+		"""
+		Pushes the decimated values to the decimated stream.
+		"""
+		positions, decimated = self.decimate(values)
+		if len(positions):
+			self.outlet.push_chunk(
+				decimated[:, np.newaxis],
+				(timestamps[positions] - self.delay).tolist()
+			)
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Decimates the raw value of a sample, if it has one.
+		"""
+		if self.replace:
+			self.push_chunk([sample], [timestamp])
+		else:
+			super(DecimateStage, self).push_sample(sample, timestamp)
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Decimates the raw values of a chunk of samples.
+		"""
+		if not self.replace:
+			return super(DecimateStage, self).push_chunk(samples, timestamps)
+
+		samples = np.array(samples, dtype=np.float64)
+		timestamps = np.array(timestamps, dtype=np.float64)
+		raw = ~np.isnan(samples[:, self.column])
+		present = np.flatnonzero(raw)
+		kept = present[:0]
+		if len(present):
+			# The next raw values kept will be later than this
+			self._reached = timestamps[present[-1]] - self.delay
+			positions, decimated = self.decimate(samples[present, self.column])
+			kept = present[positions]
+			samples[kept, self.column] = decimated
+			timestamps[kept] -= self.delay
+
+		if self._held is None:
+			self._held = np.empty((0, samples.shape[1]))
+		self._held = np.concatenate((self._held, samples[~raw]))
+		self._held_timestamps = np.concatenate((self._held_timestamps, timestamps[~raw]))
+		released = 0
+		if self._reached is not None:
+			released = np.searchsorted(self._held_timestamps, self._reached, side="right")
+
+		self._push_ordered(
+			np.concatenate((self._held[:released], samples[kept])),
+			np.concatenate((self._held_timestamps[:released], timestamps[kept]))
+		)
+		self._held = self._held[released:]
+		self._held_timestamps = self._held_timestamps[released:]
+
+	def _push_ordered(self, samples, timestamps):
+		"""
+		Pushes samples to the outlet, sorted by their timestamps.
+		"""
+		if len(samples):
+			order = np.argsort(timestamps, kind="stable")
+			self.outlet.push_chunk(samples[order], timestamps[order].tolist())
+
+	def flush(self):
+		"""
+		Pushes the samples that are held back, and flushes the outlet.
+		"""
+		if self.replace and self._held is not None:
+			self._push_ordered(self._held, self._held_timestamps)
+			self._held = self._held[:0]
+			self._held_timestamps = self._held_timestamps[:0]
+		super(DecimateStage, self).flush()
+
+
+class _RollingSums(object):
+	"""
+	Sums of the last values of a stream over windows of fixed sizes.
+	A ring buffer holds the running total after each value, so each
+	value is only added once and a window sum is the difference of
+	two totals.
+	"""
+	def __init__(self, size):
+		"""
+		:param int size: Size of the largest window.
+		"""
+		self._totals = np.zeros(size + 1, dtype=np.float64)
+		self._count = 0
+
+	def update(self, values, windows):
+		"""
+		Adds values and returns, for each window size, the sums of the
+		windows that end at each of the values, and the number of
+		values in those windows (fewer at the start of the stream).
+		:param np.ndarray values: New values of the stream.
+		:param list windows: Sizes of the windows, at most `size`.
+		"""
+		ring = len(self._totals)
+		ends = self._count + 1 + np.arange(len(values))
+		totals = self._totals[self._count % ring] + np.cumsum(values)
+
+		results = []
+		for window in windows:
+			starts = np.maximum(ends - window, 0)
+			old = starts <= self._count
+			lagged = np.empty(len(values), dtype=np.float64)
+			lagged[old] = self._totals[starts[old] % ring]
+			lagged[~old] = totals[starts[~old] - self._count - 1]
+			results.append((totals - lagged, ends - starts))
+
+		self._totals[ends[-ring:] % ring] = totals[-ring:]
+		self._count = ends[-1]
+		# Only the differences of the totals matter, they are brought
+		# back near 0 so that they keep their precision
+		if abs(totals[-1]) > 1e12:
+			self._totals -= totals[-1]
+		return results
+
+
+class _Runs(object):
+	"""
+	Finds where the runs of flagged values start and end, in a mask
+	that is given in chunks. Runs shorter than `min_length` are ignored.
+	"""
+	def __init__(self, min_length=1):
+		"""
+		:param int min_length: Number of values a run needs.
+		"""
+		self.min_length = min_length
+		self.start = None
+		self.last = None
+		self.length = 0
+
+	def update(self, mask, timestamps):
+		"""
+		Returns the runs that got long enough, as `(start,)`, and
+		those that ended, as `(start, end)`, in the order they happened.
+		:param np.ndarray mask: Whether each value is flagged.
+		:param np.ndarray timestamps: Timestamp of each value.
+		"""
+		edges = np.diff(np.concatenate(([self.length > 0], mask)).astype(np.int8))
+		starts = list(np.flatnonzero(edges == 1))
+		ends = list(np.flatnonzero(edges == -1))
+		if self.length:
+			# The last run of the previous chunk goes on
+			starts.insert(0, None)
+
+		runs = []
+		for ind, start in enumerate(starts):
+			end = ends[ind] if ind < len(ends) else None
+			if start is not None:
+				self.start = timestamps[start]
+				self.length = 0
+
+			before = self.length
+			self.length += (len(mask) if end is None else end) - (start or 0)
+			if before < self.min_length <= self.length:
+				runs.append((self.start,))
+
+			if end is not None:
+				if self.length >= self.min_length:
+					runs.append((self.start, timestamps[end - 1] if end else self.last))
+				self.length = 0
+
+		if len(mask) and mask[-1]:
+			self.last = timestamps[-1]
+		return runs
+
+
+class QualityStage(RawStage):
+	"""
+	Detects artifacts in the raw values: clipping, flatlines, steps,
+	eye blinks, and power line noise. The events are pushed to an LSL
+	marker stream as JSON strings, and a quality score between 0 and 1
+	is pushed once per second with the share of each artifact.
+
+	The rolling statistics are kept as running totals from one chunk
+	to the next, so each raw value is only processed once. The blinks
+	are cross-checked against the `blinkStrength` values of ThinkGear,
+	and the `poorSignalLevel` values lower the quality score.
+	"""
+	def __init__(
+			self,
+			source_id,
+			name="MindwaveQuality",
+			srate=RAW_SRATE,
+			line_freq=60.0,
+			clip_level=2047.0,
+			flat_window=0.25,
+			flat_std=1.0,
+			step_ratio=10.0,
+			step_min=100.0,
+			blink_amplitude=150.0,
+			blink_duration=(0.05, 0.5),
+			blink_match=1.0,
+			line_ratio=0.5,
+			column=RAW_INDEX
+		):
+		"""
+		Initializes the QualityStage.
+
+		:param str source_id: Source ID of the quality stream, the
+			marker stream gets it with a `-markers` suffix.
+		:param str name: Name of the quality stream, the marker stream
+			gets it with a `Markers` suffix.
+		:param float srate: Sampling rate of the raw values.
+		:param float line_freq: Frequency of the power line in Hz,
+			usually 50 or 60, 0 to ignore the line noise.
+		:param float clip_level: Absolute raw value at which the signal
+			is clipped by the ADC of the headset.
+		:param float flat_window: Length, in seconds, of the windows
+			checked for flatlines.
+		:param float flat_std: Standard deviation under which a window
+			is flat.
+		:param float step_ratio: Ratio between the change from one raw
+			value to the next and its RMS over the last second above
+			which it is a step.
+		:param float step_min: Smallest change that is a step.
+		:param float blink_amplitude: Difference between the mean of the
+			last 40ms and the mean of the last second above which the
+			values can be part of a blink.
+		:param tuple blink_duration: Shortest and longest blinks, in seconds.
+		:param float blink_match: Time, in seconds, within which a blink
+			and a `blinkStrength` value are the same blink.
+		:param float line_ratio: Share of the power of a second at the
+			power line frequency above which the line noise dominates.
+		:param int column: Column of the raw values in the samples.
+		"""
+		super(QualityStage, self).__init__(column)
+		self.source_id = source_id
+		self.name = name
+		self.srate = srate
+		self.line_freq = line_freq
+		self.clip_level = clip_level
+		self.flat_std = flat_std
+		self.step_ratio = step_ratio
+		self.step_min = step_min
+		self.blink_amplitude = blink_amplitude
+		self.blink_duration = blink_duration
+		self.blink_match = blink_match
+		self.line_ratio = line_ratio
+		self.outlet = None
+		self.markers = None
+
+		self._second = int(round(srate))
+		self._long = self._second
+		self._short = max(int(round(0.04 * srate)), 1)
+		self._flat = max(int(round(flat_window * srate)), 2)
+		self._hold = max(int(round(0.1 * srate)), 1)
+
+		self._values = _RollingSums(max(self._long, self._flat))
+		self._squares = _RollingSums(self._flat)
+		self._changes = _RollingSums(self._long)
+		self._steps = _RollingSums(self._long)
+		self._previous = None
+
+		self._clipping = _Runs(3)
+		self._flatline = _Runs()
+		self._blinks = _Runs(max(int(round(blink_duration[0] * srate)), 1))
+		self._line_noise = _Runs()
+
+		# Phase of the power line at each value of a second, the
+		# seconds have a whole number of periods so the mean cancels
+		self._phasor = np.exp(
+			-2j * np.pi * line_freq * np.arange(self._second) / srate
+		)
+		self._filled = 0
+		self._sums = np.zeros(10, dtype=np.float64)
+
+		self._detected = collections.deque()
+		self._thinkgear = collections.deque()
+		self._poor_signal = 0.0
+		self._latest = None
+
+	def setup_outlet(self):
+		"""
+		Sets up the quality stream and the marker stream.
+		"""
+		self.outlet = make_stream_outlet(
+			self.name,
+			"Quality",
+			QUALITY_LABELS,
+			"a.u.",
+			self.srate / self._second,
+			self.source_id
+		)
+		self.markers = make_stream_outlet(
+			self.name + "Markers",
+			"Markers",
+			["event"],
+			"",
+			lsl.IRREGULAR_RATE,
+			self.source_id + "-markers",
+			fmt=lsl.cf_string
+		)
+		return self.outlet
+
+	def mark(self, timestamp, event, **values):
+		"""
+		Pushes an event to the marker stream.
+		:param float timestamp: Time at which the event started.
+		:param str event: Name of the event.
+		"""
+		values["event"] = event
+		self.markers.push_sample([json.dumps(values)], float(timestamp))
+
+	def _mark_runs(self, event, runs, lead=0.0):
+		"""
+		Pushes the start and the end of each run of an artifact.
+		:param float lead: Time, in seconds, between the start of an
+			artifact and the first value flagged, for the artifacts
+			found over windows.
+		"""
+		for run in runs:
+			if len(run) == 1:
+				self.mark(run[0] - lead, event, state="start")
+			else:
+				self.mark(run[1], event, state="end", duration=float(run[1] - run[0] + lead))
+
+	def _note_thinkgear(self, blinks, poor_signal, timestamps):
+		"""
+		Keeps the `blinkStrength` values for the cross-check, and the
+		latest `poorSignalLevel` value.
+		"""
+		present = ~np.isnan(blinks)
+		if present.any():
+			self._thinkgear.extend(zip(
+				np.asarray(timestamps, dtype=np.float64)[present], blinks[present]
+			))
+		present = np.flatnonzero(~np.isnan(poor_signal))
+		if len(present):
+			self._poor_signal = poor_signal[present[-1]]
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Processes the raw value of a sample, if it has one.
+		"""
+		self._note_thinkgear(
+			np.array([sample[BLINK_INDEX]], dtype=np.float64),
+			np.array([sample[POOR_SIGNAL_INDEX]], dtype=np.float64),
+			[timestamp]
+		)
+		super(QualityStage, self).push_sample(sample, timestamp)
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Processes the raw values of a chunk of samples.
+		"""
+		samples = np.asarray(samples, dtype=np.float64)
+		self._note_thinkgear(
+			samples[:, BLINK_INDEX], samples[:, POOR_SIGNAL_INDEX], timestamps
+		)
+		super(QualityStage, self).push_chunk(samples, timestamps)
+
+	def detect(self, values):
+		"""
+		Flags the artifacts of a batch of raw values, continuing from
+		the previous ones.
+		:param np.ndarray values: Raw values.
+		:return: Masks of the clipped, flat, step, and blink values,
+			and the steps.
+		"""
+		(long_sums, long_sizes), (short_sums, short_sizes), (flat_sums, flat_sizes) = \
+			self._values.update(values, [self._long, self._short, self._flat])
+		(squares, _), = self._squares.update(values ** 2, [self._flat])
+
+		clipped = np.abs(values) >= self.clip_level
+
+		means = flat_sums / flat_sizes
+		variances = squares / flat_sizes - means ** 2
+		flat = (flat_sizes == self._flat) & (variances < self.flat_std ** 2)
+
+		# The RMS of the changes over the last second, without the
+		# current one, is the scale that a step is compared to
+		previous = values[0] if self._previous is None else self._previous
+		changes = np.diff(np.concatenate(([previous], values)))
+		self._previous = values[-1]
+		(change_sums, change_sizes), = self._changes.update(changes ** 2, [self._long])
+		scale = np.sqrt(np.maximum(change_sums - changes ** 2, 0) / np.maximum(change_sizes - 1, 1))
+		steps = np.abs(changes) > np.maximum(self.step_ratio * scale, self.step_min)
+		# The values right after a step are flagged with it, and the
+		# mean of the last second is off for a while after it
+		(held, _), (shifted, _) = self._steps.update(steps, [self._hold, self._long])
+
+		blinks = np.abs(
+			short_sums / short_sizes - long_sums / long_sizes
+		) > self.blink_amplitude
+
+		return clipped, flat, held > 0, blinks & (shifted == 0), changes[steps]
+
+	def _match_blinks(self, runs):
+		"""
+		Pushes the blinks once the `blinkStrength` values that could
+		match them had time to arrive. The `blinkStrength` values that
+		don't match a blink in the raw values are pushed too.
+		"""
+		for run in runs:
+			if len(run) == 2 and run[1] - run[0] <= self.blink_duration[1]:
+				self._detected.append(run)
+
+		while self._detected and self._detected[0][1] + self.blink_match < self._latest:
+			start, end = self._detected.popleft()
+			strength = None
+			for ind, (timestamp, value) in enumerate(self._thinkgear):
+				if start - self.blink_match <= timestamp <= end + self.blink_match:
+					strength = float(value)
+					del self._thinkgear[ind]
+					break
+			self.mark(
+				start,
+				"blink",
+				duration=float(end - start),
+				strength=strength,
+				detected=True
+			)
+
+		# Any blink that could match the oldest value would have ended
+		wait = self.blink_duration[1] + 2 * self.blink_match
+		while self._thinkgear and self._thinkgear[0][0] + wait < self._latest:
+			if self._detected and self._detected[0][0] - self.blink_match <= self._thinkgear[0][0]:
+				break
+			timestamp, value = self._thinkgear.popleft()
+			self.mark(timestamp, "blink", strength=float(value), detected=False)
+
+	def process(self, values, timestamps):
+		"""
+		Pushes the artifacts found in the raw values as events, and the
+		quality score of each second they complete.
+		"""
+		self._latest = timestamps[-1]
+		clipped, flat, steps, blinks, changes = self.detect(values)
+
+		self._mark_runs("clipping", self._clipping.update(clipped, timestamps))
+		self._mark_runs(
+			"flatline", self._flatline.update(flat, timestamps), (self._flat - 1) / self.srate
+		)
+		step_starts = np.flatnonzero(np.diff(np.concatenate(([False], steps)).astype(np.int8)) == 1)
+		for timestamp, change in zip(timestamps[step_starts], changes):
+			self.mark(timestamp, "step", size=float(change))
+		self._match_blinks(self._blinks.update(blinks, timestamps))
+
+		# Sums of each second, the first one continues the current second
+		index = self._filled + np.arange(len(values))
+		seconds = index // self._second
+		phasor = self._phasor[index % self._second]
+		count = seconds[-1] + 1
+		sums = np.stack([
+			np.bincount(seconds, weights=weights, minlength=count)
+			for weights in (
+				np.ones(len(values)),
+				clipped | flat | steps | blinks,
+				clipped,
+				flat,
+				steps,
+				blinks,
+				values,
+				values ** 2,
+				values * phasor.real,
+				values * phasor.imag,
+			)
+		], axis=1)
+		sums[0] += self._sums
+
+		self._filled = (index[-1] + 1) % self._second
+		complete = count if self._filled == 0 else count - 1
+		self._sums = sums[complete] if complete < count else np.zeros(len(self._sums))
+		if complete:
+			ends = np.flatnonzero((index + 1) % self._second == 0)
+			self._push_seconds(sums[:complete], timestamps[ends])
+
+	def _push_seconds(self, sums, timestamps):
+		"""
+		Pushes the quality score of each complete second, with the
+		timestamp of its last raw value.
+		"""
+		size, bad, clipped, flat, steps, blinks, total, squares, real, imag = sums.T
+		variances = squares / size - (total / size) ** 2
+		with np.errstate(invalid="ignore", divide="ignore"):
+			line = 2 * (real ** 2 + imag ** 2) / size ** 2 / variances
+		line = np.clip(np.nan_to_num(line), 0, 1) if self.line_freq else np.zeros(len(size))
+
+		self._mark_runs(
+			"line_noise",
+			self._line_noise.update(line > self.line_ratio, timestamps),
+			(self._second - 1) / self.srate
+		)
+
+		quality = (1 - bad / size) * (1 - line) * (1 - min(self._poor_signal, 200) / 200.0)
+		self.outlet.push_chunk(
+			np.stack([
+				quality,
+				clipped / size,
+				flat / size,
+				steps / size,
+				blinks / size,
+				line,
+			], axis=1),
+			timestamps.tolist()
+		)
@@ -0,0 +1,522 @@
+"""
+Runs many ThinkGear Connector endpoints across worker processes, so
+that decoding the samples isn't limited to a single core. Each worker
+runs a `MultiHeadsetRunner` for its share of the endpoints and owns
+their outlets, while the supervisor restarts the workers that crash
+or hang, and gathers their health.
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from mindwavelsl.compression import split_codec
+from mindwavelsl.connectors import Backoff
+from mindwavelsl.logger import MindwaveLogger, setup_logging
+from mindwavelsl.metrics import format_line
+
+log = MindwaveLogger("mindwave-supervisor")
+
+
+def shard_endpoints(endpoints, workers):
+	"""
+	Splits the endpoints between the workers, in turn, so that each
+	worker gets the same number of headsets give or take one.
+	:param list endpoints: List of (host, port) pairs.
+	:param int workers: Number of workers.
+	"""
+	return [endpoints[ind::workers] for ind in range(workers) if endpoints[ind::workers]]
+
+
+def restart_output_path(path, restarts):
+	"""
+	Returns the file output path of a restarted worker, so that the
+	files of the previous runs aren't overwritten.
+	:param str path: Path given through `--output`, it can be
+		a directory or a file.
+	:param int restarts: Number of restarts of the worker.
+	"""
+	if not path or not restarts:
+		return path
+
+	base, codec_ext = split_codec(path)
+	root, ext = os.path.splitext(base)
+	if ext in ('.csv', '.npy', '.xdf'):
+		return "%s-restart%s%s%s" % (root, restarts, ext, codec_ext)
+	return os.path.join(path, "restart-%s" % restarts)
+
+
+async def _run_until_stopped(runner, heartbeat=None):
+	"""
+	Runs the endpoints of a worker until they all stop, or until the
+	worker is interrupted or terminated. The endpoints are cancelled
+	at their next `await`, so their outlets get closed.
+	:param coroutine heartbeat: Coroutine run on the same event loop
+		as the endpoints until they stop.
+	"""
+	import asyncio
+
+	task = asyncio.ensure_future(runner.run_async())
+	beat = asyncio.ensure_future(heartbeat) if heartbeat is not None else None
+	stopping = asyncio.Event()
+
+	def stop():
+		stopping.set()
+		task.cancel()
+
+	loop = asyncio.get_running_loop()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		try:
+			loop.add_signal_handler(signum, stop)
+		except NotImplementedError:
+			# Not available on Windows, where Ctrl+C interrupts the loop
+			pass
+
+	try:
+		while not task.done():
+			await asyncio.wait([task], timeout=0.5)
+			# A cancellation can be lost when it races with a read
+			# that completes in `asyncio.wait_for`, so it's repeated
+			if stopping.is_set() and not task.done():
+				task.cancel()
+		if not task.cancelled():
+			task.result()
+	finally:
+		if beat is not None:
+			beat.cancel()
+
+
+class HealthProbe(object):
+	"""
+	Outlet that counts the samples pushed for a headset, and marks
+	the gap left in its data by a restarted worker.
+	"""
+	def __init__(self, mwlsl, gap_start=None):
+		"""
+		Initializes the HealthProbe.
+
+		:param MindwaveLSL mwlsl: Instance of the headset.
+		:param float gap_start: Timestamp of the last sample pushed by
+			the previous worker, if it was restarted.
+		"""
+		self.mwlsl = mwlsl
+		self.samples = 0
+		self.last_timestamp = None
+		self.gap_start = gap_start
+
+	def push_sample(self, sample, timestamp=0.0):
+		if self.gap_start is not None:
+			self.mwlsl.mark_gap(self.gap_start, timestamp)
+			self.gap_start = None
+		self.samples += 1
+		self.last_timestamp = timestamp
+
+	def push_chunk(self, samples, timestamps):
+		if not len(timestamps):
+			return
+		if self.gap_start is not None:
+			self.mwlsl.mark_gap(self.gap_start, timestamps[0])
+			self.gap_start = None
+		self.samples += len(timestamps)
+		self.last_timestamp = float(timestamps[-1])
+
+	def report(self):
+		"""
+		Returns the health of the headset.
+		"""
+		return {
+			"endpoint": "%s:%s" % (self.mwlsl.host, self.mwlsl.port),
+			"samples": self.samples,
+			"gaps": self.mwlsl.gaps,
+			"last_timestamp": self.last_timestamp,
+		}
+
+
+async def _report(shard, probes, headsets, reports, interval):
+	"""
+	Sends the health of a worker to the supervisor, with the metrics
+	of its headsets when they are enabled. It runs on the event loop
+	of the headsets, so a worker whose loop is stuck stops reporting
+	and gets restarted.
+	"""
+	import asyncio
+
+	while True:
+		families = collections.OrderedDict()
+		for mwlsl, _ in headsets:
+			if mwlsl.metrics is None:
+				continue
+			for name, (kind, lines) in mwlsl.metrics.collect().items():
+				families.setdefault(name, (kind, []))[1].extend(lines)
+
+		reports.put({
+			"shard": shard,
+			"pid": os.getpid(),
+			"headsets": [probe.report() for probe in probes],
+			"families": families,
+		})
+		await asyncio.sleep(interval)
+
+
+def run_worker(shard, endpoints, settings, reports, gap_starts, log_level="INFO", interval=1.0):
+	"""
+	Runs the endpoints of a worker process until they all stop. The
+	worker exits with an error if it crashes, so that it's restarted.
+
+	:param int shard: Index of the worker.
+	:param list endpoints: List of (host, port) pairs.
+	:param dict settings: Settings of the `MultiHeadsetRunner`.
+	:param multiprocessing.Queue reports: Queue that the health
+		reports are sent to.
+	:param dict gap_starts: Timestamp of the last sample of each
+		endpoint, keyed by `host:port`, when restarting a worker.
+	:param str log_level: Level of the messages that get logged.
+	:param float interval: Time, in seconds, between health reports.
+	"""
+	import asyncio
+	from mindwavelsl.runner import MultiHeadsetRunner
+
+	setup_logging(log_level)
+	# The supervisor stops reading the reports when it stops the
+	# workers, the last ones are dropped rather than blocking the exit
+	reports.cancel_join_thread()
+
+	runner = MultiHeadsetRunner(endpoints, **settings)
+	runner.setup()
+
+	probes = []
+	for mwlsl, _ in runner.headsets:
+		probe = HealthProbe(mwlsl, gap_starts.get("%s:%s" % (mwlsl.host, mwlsl.port)))
+		mwlsl.add_outlet(probe)
+		probes.append(probe)
+
+	try:
+		asyncio.run(_run_until_stopped(
+			runner, _report(shard, probes, runner.headsets, reports, interval)
+		))
+	except KeyboardInterrupt:
+		pass
+
+
+class _Worker(object):
+	"""
+	State of a worker process, kept by the supervisor.
+	"""
+	def __init__(self, shard, endpoints):
+		self.shard = shard
+		self.endpoints = endpoints
+		self.process = None
+		self.started = 0
+		self.last_report = None
+		self.report = None
+		self.families = {}
+		self.restarts = 0
+		self.previous_samples = 0
+		self.gap_starts = {}
+		self.restart_at = None
+		self.terminated_at = None
+		self.done = False
+		self.backoff = Backoff(initial=1.0, maximum=30.0)
+
+	def collect(self):
+		"""
+		Returns the last metrics reported by the worker, so that they
+		can be served with `metrics.MetricsServer`.
+		"""
+		return self.families
+
+
+class ShardSupervisor(object):
+	"""
+	Splits ThinkGear Connector endpoints between worker processes,
+	and restarts the workers that crash or stop reporting their
+	health. The workers each own the outlets of their endpoints.
+	"""
+	def __init__(
+			self,
+			endpoints,
+			workers=0,
+			source_id="mindwavelsl",
+			report_interval=1.0,
+			heartbeat_timeout=10.0,
+			stop_timeout=5.0,
+			summary_interval=60.0,
+			**kwargs
+		):
+		"""
+		Initializes the ShardSupervisor.
+
+		:param list endpoints: List of (host, port) pairs.
+		:param int workers: Number of worker processes, by default one
+			per core, and at most one per endpoint.
+		:param str source_id: Prefix of the source IDs of the streams,
+			so that LSL inlets resume them after a worker restarts.
+		:param float report_interval: Time, in seconds, between two
+			health reports of a worker.
+		:param float heartbeat_timeout: Time, in seconds, without a
+			health report after which a worker is restarted.
+		:param float stop_timeout: Time, in seconds, given to the
+			workers to close their outlets when stopping.
+		:param float summary_interval: Time, in seconds, between two
+			logged summaries of the health of the workers.
+		:param kwargs: Other settings for the `MindwaveLSL` outlets.
+		"""
+		workers = workers or os.cpu_count() or 1
+		self.workers = [
+			_Worker(shard, assigned)
+			for shard, assigned in enumerate(shard_endpoints(endpoints, workers))
+		]
+		self.report_interval = report_interval
+		self.heartbeat_timeout = heartbeat_timeout
+		self.stop_timeout = stop_timeout
+		self.summary_interval = summary_interval
+
+		self._settings = dict(kwargs, source_id=source_id)
+		self._context = multiprocessing.get_context("spawn")
+		self._reports = self._context.Queue()
+		self._stopping = False
+		self._last_summary = 0
+		self._summary_samples = 0
+
+	def _start(self, worker):
+		"""
+		Starts the process of a worker. When restarting it, the time of
+		the last samples pushed by the previous one is passed on to
+		mark the gaps.
+		"""
+		settings = dict(self._settings)
+		settings["file_outlet_path"] = restart_output_path(
+			settings.get("file_outlet_path", ''), worker.restarts
+		)
+
+		worker.process = self._context.Process(
+			target=run_worker,
+			args=(
+				worker.shard,
+				worker.endpoints,
+				settings,
+				self._reports,
+				worker.gap_starts,
+				logging.getLevelName(log.logger.getEffectiveLevel()),
+				self.report_interval,
+			),
+			name="mindwavelsl-worker-%s" % worker.shard,
+			daemon=True
+		)
+		worker.process.start()
+		worker.started = time.monotonic()
+		worker.last_report = None
+		worker.restart_at = None
+		worker.terminated_at = None
+		log.info(
+			"Started worker %s (pid %s) for %s",
+			worker.shard,
+			worker.process.pid,
+			", ".join("%s:%s" % endpoint for endpoint in worker.endpoints)
+		)
+
+	def start(self):
+		"""
+		Starts all the workers.
+		"""
+		for worker in self.workers:
+			self._start(worker)
+		self._last_summary = time.monotonic()
+
+	def _receive(self, timeout):
+		"""
+		Stores the health reports sent by the workers.
+		"""
+		try:
+			report = self._reports.get(timeout=timeout)
+			while True:
+				worker = self.workers[report["shard"]]
+				if worker.process is not None and report["pid"] == worker.process.pid:
+					worker.report = report
+					worker.families = report["families"]
+					worker.last_report = time.monotonic()
+				report = self._reports.get_nowait()
+		except queue.Empty:
+			pass
+
+	def _check(self, worker):
+		"""
+		Restarts a worker if it crashed or if it stopped reporting its
+		health. Returns False once the worker is done.
+		"""
+		if worker.done:
+			return False
+
+		now = time.monotonic()
+		if worker.process is None:
+			if now >= worker.restart_at:
+				self._start(worker)
+			return True
+
+		if worker.process.is_alive():
+			if now - worker.started > worker.backoff.maximum:
+				worker.backoff.reset()
+
+			last_report = worker.last_report or worker.started
+			if worker.terminated_at is not None:
+				if now - worker.terminated_at > self.stop_timeout:
+					worker.process.kill()
+			elif now - last_report > self.heartbeat_timeout:
+				log.warning(
+					"Worker %s (pid %s) didn't report for %.1fs, restarting it",
+					worker.shard, worker.process.pid, now - last_report
+				)
+				worker.process.terminate()
+				worker.terminated_at = now
+			return True
+
+		exitcode = worker.process.exitcode
+		worker.process = None
+		worker.families = {}
+		if worker.report is not None:
+			for headset in worker.report["headsets"]:
+				worker.previous_samples += headset["samples"]
+				if headset["last_timestamp"] is not None:
+					worker.gap_starts[headset["endpoint"]] = headset["last_timestamp"]
+			worker.report = None
+		if exitcode == 0 and worker.terminated_at is None:
+			log.info("Worker %s finished", worker.shard)
+			worker.done = True
+			return False
+
+		worker.restarts += 1
+		delay = worker.backoff.next()
+		worker.restart_at = now + delay
+		log.warning(
+			"Worker %s stopped with exit code %s, restarting it in %.1fs",
+			worker.shard, exitcode, delay
+		)
+		return True
+
+	def _summarize(self):
+		"""
+		Logs the health of the workers once per `summary_interval`.
+		"""
+		now = time.monotonic()
+		if now - self._last_summary < self.summary_interval:
+			return
+
+		health = self.health()
+		samples = sum(worker.previous_samples for worker in self.workers) + sum(
+			headset["samples"] for worker in health for headset in worker["headsets"]
+		)
+		log.info(
+			"%s/%s workers up, %s restarts, %.0f samples/s",
+			sum(worker["up"] for worker in health),
+			len(health),
+			sum(worker["restarts"] for worker in health),
+			(samples - self._summary_samples) / (now - self._last_summary)
+		)
+		self._summary_samples = samples
+		self._last_summary = now
+
+	def health(self):
+		"""
+		Returns the health of each worker: whether it's running and
+		reporting, its restarts, the age of its last report, and the
+		last report of each of its headsets.
+		"""
+		now = time.monotonic()
+		health = []
+		for worker in self.workers:
+			age = None if worker.last_report is None else now - worker.last_report
+			health.append({
+				"shard": worker.shard,
+				"pid": worker.process.pid if worker.process is not None else None,
+				"up": bool(
+					worker.process is not None
+					and worker.process.is_alive()
+					and age is not None
+					and age <= self.heartbeat_timeout
+				),
+				"restarts": worker.restarts,
+				"heartbeat_age": age,
+				"headsets": worker.report["headsets"] if worker.report else [],
+			})
+		return health
+
+	def collect(self):
+		"""
+		Returns the metrics of the workers as a dict of name to
+		(kind, lines), like `metrics.Metrics.collect`.
+		"""
+		families = collections.OrderedDict()
+
+		def add(name, kind, labels, value):
+			families.setdefault(name, (kind, []))[1].append(format_line(name, labels, value))
+
+		for worker in self.health():
+			labels = (("worker", worker["shard"]),)
+			add("worker_up", "gauge", labels, int(worker["up"]))
+			add("worker_restarts_total", "counter", labels, worker["restarts"])
+			if worker["heartbeat_age"] is not None:
+				add("worker_heartbeat_age_seconds", "gauge", labels, worker["heartbeat_age"])
+			for headset in worker["headsets"]:
+				add(
+					"headset_samples_total",
+					"counter",
+					labels + (("endpoint", headset["endpoint"]),),
+					headset["samples"]
+				)
+		return families
+
+	def metrics_list(self):
+		"""
+		Returns the metrics of the supervisor and of each worker, for
+		`metrics.MetricsServer`.
+		"""
+		return [self] + self.workers
+
+	def supervise(self, timeout=0.1):
+		"""
+		Gathers the health reports, and restarts the workers that need
+		it. Returns False once all the workers are done.
+		:param float timeout: Maximum time, in seconds, spent waiting
+			for the health reports.
+		"""
+		self._receive(timeout)
+		running = [self._check(worker) for worker in self.workers]
+		self._summarize()
+		return any(running)
+
+	def run(self):
+		"""
+		Starts the workers and supervises them until they are all done,
+		or until interrupted.
+		"""
+		if not any(worker.process for worker in self.workers):
+			self.start()
+		try:
+			while not self._stopping and self.supervise():
+				pass
+		finally:
+			self.stop()
+
+	def stop(self):
+		"""
+		Stops the workers, giving them `stop_timeout` seconds to close
+		their outlets.
+		"""
+		self._stopping = True
+		processes = [
+			worker.process for worker in self.workers
+			if worker.process is not None and worker.process.is_alive()
+		]
+		for process in processes:
+			process.terminate()
+
+		deadline = time.monotonic() + self.stop_timeout
+		for process in processes:
+			process.join(max(deadline - time.monotonic(), 0))
+			if process.is_alive():
+				log.warning("Worker pid %s didn't stop, killing it", process.pid)
+				process.kill()
+				process.join()
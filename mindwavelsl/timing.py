@@ -0,0 +1,93 @@
+"""
+Used to correct the timestamps of the samples before they are pushed.
+"""
+from mindwavelsl.constants import RAW_SRATE
+
+
+class Dejitter(object):
+	"""
+	Smooths the timestamps of a regularly sampled stream. A running
+	linear regression of the arrival time against the sample index is
+	fitted with recursive least squares, so the jitter of the link is
+	removed while slow clock drift is still followed.
+	"""
+	def __init__(self, srate=RAW_SRATE, halftime=90.0, max_error=1.0):
+		"""
+		Initializes the Dejitter.
+
+		:param float srate: Nominal sampling rate of the stream.
+		:param float halftime: Time, in seconds, after which the weight
+			of a sample in the regression is halved.
+		:param float max_error: If an arrival time is further than this
+			many seconds from the fit (e.g. after a gap in the data),
+			the fit is restarted.
+		"""
+		self.srate = srate
+		self.max_error = max_error
+		self.resets = 0
+
+		# Last timestamp returned, the timestamps never go back
+		self._previous = None
+		self._step = 1e-3 / srate
+
+		self._forget = 2 ** (-1.0 / (halftime * srate))
+		self.reset()
+
+	def reset(self):
+		"""
+		Restarts the fit from the next sample.
+		"""
+		self._start = None
+		self._index = 0
+
+		# Intercept and slope of the fit, and their covariance. The
+		# fit starts from the first arrival time at the nominal rate,
+		# weighted as about a second of samples for the intercept and
+		# more for the slope, so that the first bursts of the link
+		# don't bend it.
+		self._w0 = 0.0
+		self._w1 = 1.0 / self.srate
+		self._p00 = 1.0 / self.srate
+		self._p01 = 0.0
+		self._p11 = 1e-6 / self.srate ** 2
+
+	def update(self, timestamp):
+		"""
+		Adds the arrival time of the next sample to the fit and
+		returns its smoothed timestamp, which is always later than
+		the previous one.
+
+		:param float timestamp: Arrival time of the sample.
+		"""
+		if self._start is None:
+			self._start = timestamp
+
+		n = self._index
+		y = timestamp - self._start
+		error = y - (self._w0 + self._w1 * n)
+		if n and abs(error) > self.max_error:
+			self.resets += 1
+			self.reset()
+			return self.update(timestamp)
+
+		# Recursive least squares update with x = (1, n)
+		px0 = self._p00 + self._p01 * n
+		px1 = self._p01 + self._p11 * n
+		gain = 1.0 / (self._forget + px0 + px1 * n)
+		g0 = px0 * gain
+		g1 = px1 * gain
+
+		self._w0 += g0 * error
+		self._w1 += g1 * error
+
+		forget = self._forget
+		self._p00 = (self._p00 - g0 * px0) / forget
+		self._p01 = (self._p01 - g0 * px1) / forget
+		self._p11 = (self._p11 - g1 * px1) / forget
+
+		self._index += 1
+		fitted = self._start + self._w0 + self._w1 * n
+		if self._previous is not None:
+			fitted = max(fitted, self._previous + self._step)
+		self._previous = fitted
+		return fitted
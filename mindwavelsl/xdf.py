@@ -0,0 +1,504 @@
+"""
+File output in the XDF format (https://github.com/sccn/xdf), the format
+written by LabRecorder. The files can be loaded with `pyxdf.load_xdf`,
+or read one chunk at a time with `read_samples`.
+"""
+import numpy as np
+import os
+import pylsl as lsl
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+from mindwavelsl.logger import MindwaveLogger
+
+log = MindwaveLogger("mindwave-xdf")
+
+MAGIC = b"XDF:"
+
+# Chunk tags
+FILE_HEADER = 1
+STREAM_HEADER = 2
+SAMPLES = 3
+CLOCK_OFFSET = 4
+BOUNDARY = 5
+STREAM_FOOTER = 6
+
+# NumPy types of the numeric channel formats
+FORMATS = {
+	"float32": "<f4",
+	"double64": "<f8",
+	"int8": "i1",
+	"int16": "<i2",
+	"int32": "<i4",
+	"int64": "<i8",
+}
+
+# Fixed UUID of the boundary chunks, used by readers to find the next
+# chunk in a damaged file
+BOUNDARY_UUID = bytes([
+	0x43, 0xA5, 0x46, 0xDC, 0xCB, 0xF5, 0x41, 0x0F,
+	0xB3, 0x0E, 0xD5, 0x46, 0x73, 0x83, 0xCB, 0xE4
+])
+
+
+def varlen(value):
+	"""
+	Encodes a length or a count as a variable length integer: the
+	number of bytes it uses (1, 4, or 8), followed by the integer.
+	"""
+	if value < 1 << 8:
+		return struct.pack("<BB", 1, value)
+	if value < 1 << 32:
+		return struct.pack("<BI", 4, value)
+	return struct.pack("<BQ", 8, value)
+
+
+def chunk(tag, content):
+	"""
+	Returns an XDF chunk holding the given content.
+	:param int tag: Type of the chunk, e.g. `SAMPLES`.
+	:param bytes content: Content of the chunk.
+	"""
+	return varlen(len(content) + 2) + struct.pack("<H", tag) + content
+
+
+def read_varlen(data, offset=0):
+	"""
+	Decodes a variable length integer, and returns it with the
+	offset of the data that follows it.
+	"""
+	size = data[offset]
+	value = int.from_bytes(data[offset + 1:offset + 1 + size], "little")
+	return value, offset + 1 + size
+
+
+def read_chunks(f):
+	"""
+	Reads the chunks of an XDF file one at a time.
+	:param file f: File opened in binary mode.
+	:return: Generator of (tag, content) pairs.
+	"""
+	if f.read(len(MAGIC)) != MAGIC:
+		raise Exception("Not an XDF file: %s" % getattr(f, "name", f))
+
+	while True:
+		size = f.read(1)
+		if not size:
+			return
+		length = int.from_bytes(f.read(size[0]), "little")
+		content = f.read(length)
+		if len(content) < length:
+			# The file was cut while writing the last chunk
+			return
+		yield int.from_bytes(content[:2], "little"), content[2:]
+
+
+def parse_info(xml):
+	"""
+	Returns the fields of a StreamHeader used to read its samples: the
+	name, type, channel count, nominal rate, channel format, and the
+	label of each channel.
+	"""
+	info = ET.fromstring(xml)
+	labels = [
+		label.text for label in info.findall("./desc/channels/channel/label")
+	]
+	count = int(info.findtext("channel_count", "0"))
+	return {
+		"name": info.findtext("name", ""),
+		"type": info.findtext("type", ""),
+		"channel_count": count,
+		"nominal_srate": float(info.findtext("nominal_srate", "0")),
+		"channel_format": info.findtext("channel_format", ""),
+		"labels": labels if len(labels) == count else [str(ind) for ind in range(count)],
+	}
+
+
+def _decode_samples(content, info, last_timestamp):
+	"""
+	Decodes the samples of a Samples chunk. The samples without a
+	timestamp get one from the previous sample and the nominal rate.
+	"""
+	count, offset = read_varlen(content, 4)
+	dtype = np.dtype(FORMATS[info["channel_format"]])
+	channels = info["channel_count"]
+
+	# When all the samples have a timestamp, the records have a fixed
+	# size and are all decoded at once
+	records = np.dtype([
+		("timestamp_bytes", "u1"),
+		("timestamp", "<f8"),
+		("values", dtype, (channels,)),
+	])
+	if len(content) - offset == count * records.itemsize:
+		block = np.frombuffer(content, dtype=records, count=count, offset=offset)
+		if (block["timestamp_bytes"] == 8).all():
+			return block["timestamp"].copy(), block["values"].astype(np.float64)
+
+	step = 1.0 / info["nominal_srate"] if info["nominal_srate"] else 0.0
+	timestamps = np.empty(count)
+	values = np.empty((count, channels))
+	for ind in range(count):
+		if content[offset] == 8:
+			last_timestamp = struct.unpack_from("<d", content, offset + 1)[0]
+			offset += 9
+		else:
+			last_timestamp = (last_timestamp or 0.0) + step
+			offset += 1
+		timestamps[ind] = last_timestamp
+		values[ind] = np.frombuffer(content, dtype=dtype, count=channels, offset=offset)
+		offset += dtype.itemsize * channels
+	return timestamps, values
+
+
+def read_samples(path, select=None):
+	"""
+	Reads the samples of an XDF file one Samples chunk at a time, so
+	that files larger than the memory can be read. The timestamps are
+	the ones recorded, without the clock offsets applied.
+
+	:param str path: Path to the XDF file.
+	:param callable select: Function given the info of each stream
+		(see `parse_info`), returning True for the streams to read.
+		All the numeric streams are read if not set.
+	:return: Generator of (info, timestamps, values) for each chunk.
+	"""
+	streams = {}
+	last_timestamps = {}
+	with open(path, "rb") as f:
+		for tag, content in read_chunks(f):
+			if tag == STREAM_HEADER:
+				info = parse_info(content[4:])
+				if info["channel_format"] in FORMATS and (select is None or select(info)):
+					streams[struct.unpack_from("<I", content)[0]] = info
+			elif tag == SAMPLES:
+				stream_id = struct.unpack_from("<I", content)[0]
+				info = streams.get(stream_id)
+				if info is None:
+					continue
+				timestamps, values = _decode_samples(
+					content, info, last_timestamps.get(stream_id)
+				)
+				if len(timestamps):
+					last_timestamps[stream_id] = timestamps[-1]
+					yield info, timestamps, values
+
+
+def to_xml(element):
+	"""
+	Returns the XML document of an element.
+	"""
+	return b'<?xml version="1.0"?>' + ET.tostring(element)
+
+
+class _XmlElement(object):
+	"""
+	Wraps an `ElementTree` element with the methods of the LSL stream
+	descriptions that `_Channel.append_to` uses, so that the channels
+	are described the same way in the XDF file and in the LSL stream.
+	"""
+	def __init__(self, element):
+		self.element = element
+
+	def append_child(self, name):
+		return _XmlElement(ET.SubElement(self.element, name))
+
+	def append_child_value(self, name, value):
+		ET.SubElement(self.element, name).text = str(value)
+		return self
+
+
+class XdfFileOutlet(object):
+	"""
+	Used to output gathered data to an XDF file with a timestamp for
+	each sample. Samples are gathered in a preallocated block that is
+	encoded as a single Samples chunk, and the chunks are written to
+	the file by a background thread.
+	"""
+	def __init__(
+			self,
+			path,
+			source_id='',
+			name="Mindwave",
+			stype="Gaze",
+			block_size=4096,
+			flush_interval=1.0,
+			clock_offset_interval=5.0
+		):
+		"""
+		Initialize the XdfFileOutlet.
+
+		:param str path: Path to the output location.
+		:param str source_id: Source ID of the stream.
+		:param str name: Name of the stream.
+		:param str stype: Type of the stream.
+		:param int block_size: Number of samples written in each
+			Samples chunk.
+		:param float flush_interval: Maximum time, in seconds, that
+			samples are kept in memory before they are written.
+		:param float clock_offset_interval: Time, in seconds, between
+			two ClockOffset chunks.
+		"""
+		self.path = path
+		self.file = 'mindwave-output.xdf'
+		self.source_id = source_id
+		self.name = name
+		self.stype = stype
+		self.block_size = block_size
+		self.flush_interval = flush_interval
+		self.clock_offset_interval = clock_offset_interval
+		self.stream_id = 1
+
+		self._header = []
+		self._channels = []
+		self._filehandler = None
+		self._block = None
+		self._timestamps = None
+		self._values = None
+		self._count = 0
+		self._last_flush = 0
+		self._last_offset = 0
+
+		self._chunks = None
+		self._writer = None
+
+		self._first_timestamp = None
+		self._last_timestamp = None
+		self._sample_count = 0
+		self._clock_offsets = []
+
+	def _make_dirs(self):
+		"""
+		Makes the output directory.
+		"""
+		if self.path.endswith('.xdf'):
+			path, file = os.path.split(self.path)
+			self.path = path
+			self.file = file
+		os.makedirs(self.path or '.', exist_ok=True)
+
+	def _file_header(self):
+		"""
+		Returns the FileHeader chunk.
+		"""
+		info = ET.Element("info")
+		ET.SubElement(info, "version").text = "1.0"
+		ET.SubElement(info, "datetime").text = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+		return chunk(FILE_HEADER, to_xml(info))
+
+	def _stream_header(self):
+		"""
+		Returns the StreamHeader chunk, describing the stream like
+		its LSL outlet.
+		"""
+		info = ET.Element("info")
+		for key, value in (
+			("name", self.name),
+			("type", self.stype),
+			("channel_count", len(self._header)),
+			("nominal_srate", lsl.IRREGULAR_RATE),
+			("channel_format", "double64"),
+			("source_id", self.source_id),
+			("version", "1.1"),
+			("created_at", lsl.local_clock()),
+			("uid", str(uuid.uuid4())),
+			("session_id", "default"),
+			("hostname", socket.gethostname()),
+		):
+			ET.SubElement(info, key).text = str(value)
+
+		desc = _XmlElement(ET.SubElement(info, "desc"))
+		desc.append_child_value("mindwavelsl-version", "1.0")
+		xml_channels = desc.append_child("channels")
+		for chan in self._channels:
+			chan.append_to(xml_channels)
+
+		return chunk(
+			STREAM_HEADER, struct.pack("<I", self.stream_id) + to_xml(info)
+		)
+
+	def _clock_offset(self):
+		"""
+		Returns a ClockOffset chunk, followed by a Boundary chunk. The
+		timestamps come from the local clock, so the offset is 0.
+		"""
+		now = lsl.local_clock()
+		self._clock_offsets.append((now, 0.0))
+		self._last_offset = now
+		return chunk(
+			CLOCK_OFFSET, struct.pack("<Idd", self.stream_id, now, 0.0)
+		) + chunk(BOUNDARY, BOUNDARY_UUID)
+
+	def _stream_footer(self):
+		"""
+		Returns the StreamFooter chunk.
+		"""
+		info = ET.Element("info")
+		for key, value in (
+			("first_timestamp", self._first_timestamp or 0.0),
+			("last_timestamp", self._last_timestamp or 0.0),
+			("sample_count", self._sample_count),
+		):
+			ET.SubElement(info, key).text = repr(value)
+
+		offsets = ET.SubElement(info, "clock_offsets")
+		for collected, value in self._clock_offsets:
+			offset = ET.SubElement(offsets, "offset")
+			ET.SubElement(offset, "time").text = repr(collected)
+			ET.SubElement(offset, "value").text = repr(value)
+
+		return chunk(
+			STREAM_FOOTER, struct.pack("<I", self.stream_id) + to_xml(info)
+		)
+
+	def _write(self):
+		"""
+		Writes the chunks to the file until `None` is queued.
+		"""
+		while True:
+			data = self._chunks.get()
+			if data is None:
+				break
+			try:
+				self._filehandler.write(data)
+				if self._chunks.empty():
+					self._filehandler.flush()
+			except Exception as e:
+				log.error("Unknow error occured while WRITING the XDF file")
+				log.error(
+					"%s - %s", e.__class__.__name__, e
+				)
+
+	def set_header(self, header):
+		"""
+		Sets up the names of the data fields.
+		:param list header: Name of each of the data columns.
+		"""
+		self._header = header
+
+	def set_channels(self, channels):
+		"""
+		Sets the `_Channel` objects describing each data field.
+		:param list channels: Channel for each data column.
+		"""
+		self._channels = channels
+
+	def setup_outlet(self):
+		"""
+		Sets up the file that data will be written to, and starts the
+		thread writing to it. An existing file is overwritten.
+		"""
+		if not self._header:
+			raise Exception("XdfFileOutlet header is empty.")
+
+		self._make_dirs()
+
+		# Each record holds the number of bytes of its timestamp,
+		# the timestamp, and the values, like in a Samples chunk
+		self._block = np.zeros(self.block_size, dtype=np.dtype([
+			("timestamp_bytes", "u1"),
+			("timestamp", "<f8"),
+			("values", "<f8", (len(self._header),)),
+		]))
+		self._block["timestamp_bytes"] = 8
+		self._timestamps = self._block["timestamp"]
+		self._values = self._block["values"]
+
+		self._filehandler = open(os.path.join(self.path, self.file), "wb")
+		self._filehandler.write(MAGIC + self._file_header() + self._stream_header())
+
+		self._chunks = queue.SimpleQueue()
+		self._chunks.put(self._clock_offset())
+		self._writer = threading.Thread(target=self._write, daemon=True)
+		self._writer.start()
+
+		self._last_flush = time.monotonic()
+
+	def push_sample(self, sample, timestamp=0.0):
+		"""
+		Push a sample that conforms to the given header.
+		:param list sample: Data sample to write.
+		:param float timestamp: Time at which the sample was read.
+		"""
+		self._timestamps[self._count] = timestamp
+		self._values[self._count] = sample
+		self._count += 1
+
+		if (
+			self._count == self.block_size
+			or time.monotonic() - self._last_flush >= self.flush_interval
+		):
+			self.flush()
+
+	def push_chunk(self, samples, timestamps):
+		"""
+		Push multiple samples that conform to the given header.
+		:param np.ndarray samples: Data samples to write.
+		:param list timestamps: Time at which each sample was read.
+		"""
+		samples = np.asarray(samples, dtype=np.float64)
+		timestamps = np.asarray(timestamps, dtype=np.float64)
+
+		start = 0
+		while start < len(samples):
+			count = min(self.block_size - self._count, len(samples) - start)
+			self._timestamps[self._count:self._count + count] = timestamps[start:start + count]
+			self._values[self._count:self._count + count] = samples[start:start + count]
+
+			self._count += count
+			start += count
+			if self._count == self.block_size:
+				self.flush()
+
+		self.poll()
+
+	def poll(self):
+		"""
+		Writes the gathered samples if they have been waiting for too long.
+		"""
+		if self._count and time.monotonic() - self._last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		"""
+		Queues the gathered samples as a Samples chunk, and a
+		ClockOffset chunk when the last one is too old.
+		"""
+		if self._count:
+			block = self._block[:self._count]
+			if self._first_timestamp is None:
+				self._first_timestamp = float(block[0]["timestamp"])
+			self._last_timestamp = float(block[-1]["timestamp"])
+			self._sample_count += self._count
+
+			self._chunks.put(chunk(
+				SAMPLES,
+				struct.pack("<I", self.stream_id)
+				+ varlen(self._count)
+				+ block.tobytes()
+			))
+			self._count = 0
+
+		if lsl.local_clock() - self._last_offset >= self.clock_offset_interval:
+			self._chunks.put(self._clock_offset())
+		self._last_flush = time.monotonic()
+
+	def close(self):
+		"""
+		Writes the remaining samples and the StreamFooter, and closes
+		the file once the writer thread is done.
+		"""
+		if self._filehandler is None:
+			return
+		self.flush()
+		self._chunks.put(self._stream_footer())
+		self._chunks.put(None)
+		self._writer.join()
+
+		self._filehandler.close()
+		self._filehandler = None
@@ -37,9 +37,16 @@ setup(
         'pylsl',
         'pyserial'
     ],
+    extras_require={
+        'filters': ['scipy'],
+        'compression': ['zstandard', 'lz4'],
+    },
     entry_points="""
     # -*- Entry points: -*-
     [console_scripts]
     mindwavelsl = mindwavelsl.mindwavelsl:main
+    mindwavelsl-convert = mindwavelsl.binary:main
+    mindwavelsl-simulate = mindwavelsl.simulator:main
+    mindwavelsl-analyze = mindwavelsl.analyze:main
     """,
 )
\ No newline at end of file
@@ -0,0 +1,28 @@
+import numpy as np
+
+from mindwavelsl.timing import Dejitter
+
+
+def test_dejitter_burst():
+	srate = 512.0
+	dejitter = Dejitter(srate)
+
+	# One burst of samples that all arrive at the same time
+	timestamps = np.array([dejitter.update(100.0) for _ in range(32)])
+
+	steps = np.diff(timestamps)
+	assert np.all(steps > 0)
+	assert np.allclose(steps, 1.0 / srate, rtol=0.1)
+
+
+def test_dejitter_never_goes_back():
+	srate = 512.0
+	dejitter = Dejitter(srate)
+	rng = np.random.default_rng(0)
+
+	timestamps = []
+	for chunk in range(200):
+		arrival = (chunk + 1) * 32 / srate + rng.uniform(0, 0.03)
+		timestamps += [dejitter.update(arrival) for _ in range(32)]
+
+	assert np.all(np.diff(timestamps) > 0)